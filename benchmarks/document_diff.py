@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Measure how long it takes to diff two snapshots of a document that differ in one task.
+
+    python benchmarks/document_diff.py [--tasks 100000] [--repeat 3]
+
+Both snapshots are built from the same synthetic document data, the newer one
+has one renamed task and one changed assignment. The cold diff includes
+building the task tree hashes of both snapshots, the warm diffs reuse the
+hashes the documents cache until they change.
+"""
+
+import time
+import argparse
+
+import synthetic
+import omniplan
+
+
+def timed_diff(old_document, new_document):
+    start = time.time()
+    diff = omniplan.DocumentDiff(old_document, new_document)
+    return diff, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    old_document = omniplan.OmniPlanDocument('synthetic', document_data=synthetic.document_data(args.tasks))
+    new_document = omniplan.OmniPlanDocument('synthetic', document_data=synthetic.document_data(args.tasks))
+    changed_task = new_document.task_map[max(new_document.task_map)]
+    changed_task.name = changed_task.name + ' renamed'
+    assigned_task = next(assignment.task for assignment in new_document.all_resource_assignments())
+    assigned_task.resource_assignments[0].units = 0.5
+
+    diff, cold_seconds = timed_diff(old_document, new_document)
+    warm_seconds = [timed_diff(old_document, new_document)[1] for i in range(args.repeat)]
+
+    print '{} tasks, {} resources, {} assignments, {} dependencies'.format(
+        len(new_document.task_map), len(new_document.resource_map),
+        sum(1 for assignment in new_document.all_resource_assignments()), sum(1 for dependency in new_document.all_dependencies()))
+    print 'changed task ids: {}'.format(sorted(diff.changed_task_ids()))
+    print 'cold diff (building hashes): {:.3f}s'.format(cold_seconds)
+    print 'warm diff (cached hashes):   {:.3f}s best of {}'.format(min(warm_seconds), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Compare the size and parse time of the plist and JSON document data transports.
+
+    python benchmarks/json_transport.py [--tasks 20000]
+
+The same synthetic document data is written as the XML plist that the plist
+transport returns and as the compact JSON that the JSON query script emits,
+then each text is parsed the way OmniPlanDocument does it.
+"""
+
+import json
+import time
+import argparse
+import plistlib
+import calendar
+
+import synthetic
+import omniplan
+
+
+def local_time_text(value):
+    # the JSON query script emits dates in local time
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(calendar.timegm(value.timetuple())))
+
+
+def timed(function, *arguments):
+    start = time.time()
+    result = function(*arguments)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=20000)
+    args = parser.parse_args()
+
+    document_data = synthetic.document_data(args.tasks)
+    plist_text = plistlib.writePlistToString(document_data)
+    json_text = json.dumps(document_data, default=local_time_text, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    plist_data, plist_seconds = timed(plistlib.readPlistFromString, plist_text)
+    json_data, json_seconds = timed(omniplan.JsonTransport.decode, json_text)
+    plist_document = omniplan.OmniPlanDocument('synthetic', document_data=plist_data)
+    json_document = omniplan.OmniPlanDocument('synthetic', document_data=json_data)
+
+    print '{} tasks'.format(len(plist_document.task_map))
+    print 'plist: {:.1f} MB, parsed in {:.2f}s'.format(len(plist_text) / 1024.0 / 1024, plist_seconds)
+    print 'JSON:  {:.1f} MB, parsed in {:.2f}s'.format(len(json_text) / 1024.0 / 1024, json_seconds)
+    print 'identical models: {}'.format(plist_document.diff(json_document).is_empty())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Measure the memory of the task model per task, with and without interning.
+
+    python benchmarks/model_memory.py [--tasks 50000]
+
+The document data goes through a plist round trip first, so that every string
+is a separate object as it is when read from OmniPlan. The size counts every
+distinct object reachable from the tasks and resources, without the raw
+document data that the document also keeps.
+"""
+
+import gc
+import sys
+import time
+import types
+import argparse
+import plistlib
+
+import synthetic
+import omniplan
+
+
+def model_bytes(document):
+    roots = list(document.tasks) + document.resource_map.values()
+    seen = set([id(document)] + [id(root) for root in roots])
+    stack = roots
+    total = 0
+    while stack:
+        item = stack.pop()
+        total += sys.getsizeof(item)
+        for referent in gc.get_referents(item):
+            if id(referent) in seen or isinstance(referent, (type, types.ModuleType, types.FunctionType)):
+                continue
+            seen.add(id(referent))
+            stack.append(referent)
+    return total
+
+
+def load_document(plist_data):
+    document_data = plistlib.readPlistFromString(plist_data)
+    start = time.time()
+    document = omniplan.OmniPlanDocument('synthetic', document_data=document_data)
+    return document, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=50000)
+    args = parser.parse_args()
+
+    plist_data = plistlib.writePlistToString(synthetic.document_data(args.tasks))
+    document, interned_seconds = load_document(plist_data)
+    interned_bytes = model_bytes(document)
+    task_count = len(document.task_map)
+    del document
+
+    omniplan.InternedValues.intern = lambda self, value: value
+    omniplan.WorkDayTimeInterval.CACHE_SIZE = 0
+    omniplan.WorkDayTimeInterval.cache.clear()
+    document, plain_seconds = load_document(plist_data)
+    plain_bytes = model_bytes(document)
+
+    print '{} tasks'.format(task_count)
+    print 'without interning: {:.2f} KB per task, model built in {:.2f}s'.format(plain_bytes / 1024.0 / task_count, plain_seconds)
+    print 'with interning:    {:.2f} KB per task, model built in {:.2f}s'.format(interned_bytes / 1024.0 / task_count, interned_seconds)
+    print 'saved:             {:.2f} KB per task ({:.0%})'.format((plain_bytes - interned_bytes) / 1024.0 / task_count, 1 - float(interned_bytes) / plain_bytes)
+
+
+if __name__ == '__main__':
+    main()
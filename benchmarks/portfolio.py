@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Measure how Portfolio.run() scales with the number of worker processes.
+
+    python benchmarks/portfolio.py [--documents 8] [--tasks 20000] [--processes 1,2,4]
+
+The documents are written as pickled document data cache files to a
+temporary directory. The time of each run is printed together with the
+speedup over the single process run, and the size of a returned aggregate
+is compared with the size of the pickled document data.
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import cPickle as pickle
+
+import synthetic
+import omniplan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--documents', type=int, default=8)
+    parser.add_argument('--tasks', type=int, default=20000)
+    parser.add_argument('--processes', default=','.join(str(count) for count in sorted(set([1, 2, multiprocessing.cpu_count()]))))
+    args = parser.parse_args()
+
+    temp_directory = tempfile.mkdtemp()
+    try:
+        paths = []
+        for index in range(args.documents):
+            path = os.path.join(temp_directory, 'document-{}.dat'.format(index))
+            with open(path, 'wb') as f:
+                pickle.dump([synthetic.document_data(args.tasks, seed=index), None], f, pickle.HIGHEST_PROTOCOL)
+            paths.append(path)
+
+        print '{} documents of {} tasks, {} CPUs'.format(args.documents, args.tasks, multiprocessing.cpu_count())
+        serial_seconds = None
+        for processes in [int(count) for count in args.processes.split(',')]:
+            start = time.time()
+            result = omniplan.Portfolio(paths, custom_data_keys=['Team'], processes=processes).run()
+            seconds = time.time() - start
+            serial_seconds = serial_seconds or seconds
+            print '{} processes: {:.2f}s, speedup {:.2f}x, {}'.format(processes, seconds, serial_seconds / seconds, result)
+
+        document = omniplan.Portfolio.load_document(paths[0])
+        aggregate = omniplan.Portfolio.document_aggregate(document, ['Team'])
+        print 'returned aggregate: {:.1f} KB, pickled document data: {:.1f} MB'.format(len(pickle.dumps(aggregate, pickle.HIGHEST_PROTOCOL)) / 1024.0, os.path.getsize(paths[0]) / 1024.0 / 1024)
+    finally:
+        shutil.rmtree(temp_directory)
+
+
+if __name__ == '__main__':
+    main()
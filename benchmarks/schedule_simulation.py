@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""Time ScheduleSimulation.run() on a synthetic document.
+
+    python benchmarks/schedule_simulation.py [--tasks 1000] [--trials 10000] [--processes 1]
+"""
+
+import time
+import argparse
+
+import synthetic
+import omniplan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--trials', type=int, default=10000)
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+
+    document = omniplan.OmniPlanDocument('synthetic', document_data=synthetic.document_data(args.tasks, dependency_count=2))
+    simulation = omniplan.ScheduleSimulation(document)
+    start = time.time()
+    result = simulation.run(trials=args.trials, processes=args.processes, seed=1)
+    elapsed = time.time() - start
+    print '{} tasks x {} trials: {:.2f}s, {:.2f}us per task and trial'.format(args.tasks, args.trials, elapsed, elapsed / (args.tasks * args.trials) * 1e6)
+    print result
+
+
+if __name__ == '__main__':
+    main()
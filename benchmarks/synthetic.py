@@ -0,0 +1,75 @@
+"""Synthetic OmniPlan document data for the benchmark scripts in this directory.
+
+The data has the same shape as the document data read from OmniPlan, so it can
+be passed to OmniPlanDocument(name, document_data=...).
+"""
+
+import os
+import sys
+import random
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def task_data(id, name, effort_days=1, child_tasks=None, custom_data=None, prerequisite_ids=None):
+    return {
+        'id': id,
+        'name': name,
+        'outline_number': str(id),
+        'completed_effort': 0,
+        'remaining_effort': int(effort_days * 28800),
+        'effort': int(effort_days * 28800),
+        'duration': int(effort_days * 28800),
+        'total_cost': 0,
+        'priority': 0,
+        'starting_date': datetime.datetime(2017, 10, 2, 9),
+        'ending_date': '',
+        'starting_constraint_date': '',
+        'ending_constraint_date': '',
+        'task_status': 'OPTo',
+        'task_type': 'OPTG' if child_tasks else 'OPTS',
+        'custom_data': [{'name': key, 'value': value} for key, value in (custom_data or {}).items()],
+        'prerequisites': [{'prerequisite_task_id': prerequisite_id, 'dependent_task_id': id, 'dependency_type': 'FS'} for prerequisite_id in prerequisite_ids or []],
+        'child_tasks': child_tasks or [],
+    }
+
+
+def document_data(task_count, group_size=20, dependency_count=1, resource_count=10, seed=0):
+    """Return document data with task_count leaf tasks in groups of group_size.
+
+    Every leaf task has dependency_count prerequisites among the tasks before
+    it, a few custom data values drawn from small sets and one resource
+    assignment.
+    """
+    generator = random.Random(seed)
+    groups = []
+    leaf_task_ids = []
+    next_id = 1
+    for group_start in range(0, task_count, group_size):
+        group_id = next_id
+        next_id += 1
+        child_tasks = []
+        for index in range(min(group_size, task_count - group_start)):
+            prerequisite_ids = generator.sample(leaf_task_ids, min(dependency_count, len(leaf_task_ids)))
+            custom_data = {
+                'Team': 'Team {}'.format(generator.randrange(8)),
+                'Status': generator.choice(['Open', 'In Progress', 'Blocked', 'Done']),
+                'TicketID': 'PRJ-{}'.format(next_id),
+            }
+            child_tasks.append(task_data(next_id, 'Task {}'.format(next_id), effort_days=generator.choice([0.5, 1, 2, 3, 5]), custom_data=custom_data, prerequisite_ids=prerequisite_ids))
+            leaf_task_ids.append(next_id)
+            next_id += 1
+        groups.append(task_data(group_id, 'Group {}'.format(group_id), child_tasks=child_tasks))
+
+    resources = []
+    for resource_index in range(resource_count):
+        assigned_task_ids = leaf_task_ids[resource_index::resource_count]
+        resources.append({'id': resource_index + 1, 'name': 'Resource {}'.format(resource_index + 1), 'task_assignments': [{'task_id': task_id, 'units': 1.0} for task_id in assigned_task_ids]})
+
+    return {
+        'child_tasks': groups,
+        'resources': resources,
+        'selected_task_ids': [],
+        'selected_resource_ids': [],
+    }
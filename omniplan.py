@@ -43,17 +43,66 @@ Here is a simple usage example::
     task.completed_effort = WorkDayTimeInterval(days=1.0)
     task.commit_changes()
 
+For large documents, the data can be transferred from OmniPlan as compact JSON
+instead of an XML property list, the resulting model is the same::
+
+    document = OmniPlanDocument('Project.oplx', transport='json')
+
+Documents can also be loaded from an .oplx bundle on disk without OmniPlan
+running, committed changes are then written back into the bundle::
+
+    document = OmniPlanDocument.from_oplx_bundle('Project.oplx')
+    document.task_for_id(1234).effort = WorkDayTimeInterval(workdays=2)
+    document.commit_changes()
+
+A document loaded from a bundle can be kept up to date with changes saved to
+the bundle by OmniPlan or other processes::
+
+    document.watch(lambda task_ids: invalidate_caches(task_ids))
+
+The task, resource, assignment and dependency data of a document can also be
+streamed as JSON lines or CSV from the command line::
+
+    python -m omniplan export --document "Project.oplx" --records tasks,assignments --fields id,name,effort,custom:TicketID
+
 """
 
 # autopep8 -i --ignore E501 xxx
 
 import subprocess
 import plistlib
-import pickle
+import cPickle as pickle
 import struct
 import datetime
 import collections
 import sys
+import argparse
+import json
+import csv
+import operator
+import os
+import errno
+import select
+import ctypes
+import ctypes.util
+import threading
+import time
+import calendar
+import heapq
+import array
+import itertools
+import math
+import random
+import multiprocessing
+import multiprocessing.pool
+import sqlite3
+import tempfile
+import mmap
+import re
+import xml.parsers.expat
+import xml.sax.saxutils
+import xml.etree.ElementTree as ElementTree
+import xml.etree.cElementTree as cElementTree
 
 class FourCharacterCode(object):
 
@@ -86,19 +135,104 @@ class AppleScript(object):
 #        print self.stdout
         return plistlib.readPlistFromString(self.stdout)
 
+    def json_result(self):
+        if not self.stdout:
+            raise Exception("AppleScript code did not produce any output, unable to parse as JSON")
+        return JsonTransport.decode(self.stdout)
+
+
+class JsonTransport(object):
+    """Decodes document data that the query script emitted as JSON instead of as a plist.
+
+    The script writes the JSON text itself instead of going through System
+    Events, which saves an inter-application round trip and is much smaller
+    and faster to parse than the XML plist. The decoded data is converted to
+    the types plistlib produces: ASCII strings become str and the local time
+    dates of the script become naive UTC datetimes.
+    """
+
+    date_keys = set(['starting_date', 'ending_date', 'starting_constraint_date', 'ending_constraint_date'])
+
+    @classmethod
+    def decode(cls, text):
+        return json.loads(text, object_hook=cls.object_hook)
+
+    @classmethod
+    def object_hook(cls, json_object):
+        record = {}
+        for key, value in json_object.iteritems():
+            if isinstance(value, unicode):
+                value = cls.utc_date(value) if key in cls.date_keys and value else cls.plist_string(value)
+            record[cls.plist_string(key)] = value
+        return record
+
+    @staticmethod
+    def plist_string(value):
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+
+    @staticmethod
+    def utc_date(value):
+        local_time = OplxBundle.parse_date(value)
+        return datetime.datetime.utcfromtimestamp(time.mktime(local_time.timetuple()[:8] + (-1,)))
+
+
+class InternedValues(object):
+    """A table that shares one object for equal strings, also for the keys and
+    values of dictionaries.
+
+    Custom data names and values, status and type codes and dependency types
+    repeat across the tasks of a document, and the plist parser creates a
+    separate string object for every occurrence. Each document has its own
+    table, so it is freed together with the document.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def intern(self, value):
+        if isinstance(value, dict):
+            return {self.intern(key): self.intern(item) for key, item in value.items()}
+        if not isinstance(value, basestring):
+            return value
+        return self.values.setdefault(value, value)
+
 
 class WorkDayTimeInterval(object):
+    """An immutable amount of work time, instances are shared for common values."""
+
+    __slots__ = ('_seconds',)
 
     SECONDS_PER_WORKDAY = 8 * 60 * 60
+    CACHE_SIZE = 4096
 
-    def __init__(self, seconds=None, workdays=None):
+    cache = {}
 
-        self._seconds = 0
+    def __new__(cls, seconds=None, workdays=None):
+        value = 0
 
         if seconds:
-            self._seconds = seconds
+            value = seconds
         elif workdays:
-            self._seconds = workdays * self.SECONDS_PER_WORKDAY
+            value = workdays * cls.SECONDS_PER_WORKDAY
+
+        # keyed on the type as well, 14400 == 14400.0 but days() differs
+        key = (type(value), value)
+        instance = cls.cache.get(key)
+        if instance is None:
+            instance = super(WorkDayTimeInterval, cls).__new__(cls)
+            object.__setattr__(instance, '_seconds', value)
+            if len(cls.cache) < cls.CACHE_SIZE:
+                cls.cache[key] = instance
+        return instance
+
+    def __setattr__(self, key, value):
+        raise AttributeError('WorkDayTimeInterval is immutable')
+
+    def __reduce__(self):
+        return (WorkDayTimeInterval, (self._seconds,))
 
     def seconds(self):
         return self._seconds
@@ -107,32 +241,70 @@ class WorkDayTimeInterval(object):
         return self._seconds / self.SECONDS_PER_WORKDAY
 
     def __eq__(self, other):
+        if not isinstance(other, WorkDayTimeInterval):
+            return False
         return self._seconds == other._seconds
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash(self._seconds)
+
     def __repr__(self):
         return '<WorkDayTimeInterval {:.1f} days>'.format(self.days())
 
 
 class TimeInterval(object):
+    """An immutable calendar time span, instances are shared for common values."""
+
+    __slots__ = ('_seconds',)
 
     SECONDS_PER_DAY = 24 * 60 * 60
+    CACHE_SIZE = 4096
+
+    cache = {}
 
-    def __init__(self, seconds=None, days=None):
-        self.seconds = 0
+    def __new__(cls, seconds=None, days=None):
+        value = 0
 
         if seconds:
-            self.seconds = seconds
+            value = seconds
         elif days:
-            self.seconds = days * self.SECONDS_PER_DAY
+            value = days * cls.SECONDS_PER_DAY
+
+        # keyed on the type as well, 14400 == 14400.0 but days() differs
+        key = (type(value), value)
+        instance = cls.cache.get(key)
+        if instance is None:
+            instance = super(TimeInterval, cls).__new__(cls)
+            object.__setattr__(instance, '_seconds', value)
+            if len(cls.cache) < cls.CACHE_SIZE:
+                cls.cache[key] = instance
+        return instance
+
+    def __setattr__(self, key, value):
+        raise AttributeError('TimeInterval is immutable')
+
+    def __reduce__(self):
+        return (TimeInterval, (self._seconds,))
 
     def seconds(self):
-        return self.seconds
+        return self._seconds
 
     def days(self):
-        return self.seconds / self.SECONDS_PER_DAY
+        return self._seconds / self.SECONDS_PER_DAY
+
+    def __eq__(self, other):
+        if not isinstance(other, TimeInterval):
+            return False
+        return self._seconds == other._seconds
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._seconds)
 
     def __repr__(self):
         return '<TimeInterval {:.1f} days>'.format(self.days())
@@ -208,10 +380,34 @@ class UTCDateValueConverter(AbstractValueConverter):
 # orange red blue purple green black light blue
 
 class TaskChangeRecord(object):
+    """An abstract base class for a pending change to a task. Subclasses set
+    self.task and implement change_applescript_code() to commit the change to
+    a document open in OmniPlan and apply_to_oplx_task_element() to write it
+    back to an .oplx bundle.
+    """
 
     def targets_document(self):
         return False
 
+    def change_applescript_code(self):
+        pass
+
+    def apply_to_oplx_task_element(self, element):
+        """Apply the change to the <task> element of the task in an .oplx bundle's scenario XML.
+        The base implementation leaves the element unchanged.
+        """
+        pass
+
+    def coalescing_key(self):
+        """Records of a task with the same non-None key are merged into one."""
+        return None
+
+    def coalesce(self, newer_record):
+        pass
+
+    def is_noop(self):
+        return False
+
 
 class SimplePropertyTaskChangeRecord(TaskChangeRecord):
 
@@ -225,6 +421,17 @@ class SimplePropertyTaskChangeRecord(TaskChangeRecord):
         applescript_property_name = self.task.applescript_name_for_property(self.property_name)
         return """set {} to {}""".format(applescript_property_name, applescript_value)
 
+    def apply_to_oplx_task_element(self, element):
+        value = self.task.converted_value_for_property(self.property_name)
+        element_name = Task.mutable_simple_properties[self.property_name]['oplx_element_name']
+        OplxBundle.set_child_element_text(element, element_name, OplxBundle.xml_value(value))
+
+    def coalescing_key(self):
+        return ('property', self.property_name)
+
+    def is_noop(self):
+        return getattr(self.task, self.property_name) == self.old_value
+
     def __repr__(self):
         return u'<Property change for task {}: property "{}", old value "{}", current value "{}">'.format(self.task, self.property_name, self.old_value, getattr(self.task, self.property_name))
 
@@ -255,6 +462,23 @@ class SetColorTaskChangeRecord(TaskChangeRecord):
         """.format(c.r * max, c.g * max, c.b * max, c.a * max)
         return script_code
 
+    def apply_to_oplx_task_element(self, element):
+        style = OplxBundle.child_element(element, 'style')
+        fill = next((value for value in style.findall('value') if value.get('key') == 'font-fill'), None)
+        if fill is None:
+            fill = OplxBundle.append_child_element(style, 'value', {'key': 'font-fill'})
+        for color in list(fill):
+            fill.remove(color)
+        c = self.color
+        attributes = collections.OrderedDict([('space', 'srgb'), ('r', c.r), ('g', c.g), ('b', c.b), ('a', c.a)])
+        OplxBundle.append_child_element(fill, 'color', collections.OrderedDict((key, OplxBundle.xml_value(value)) for key, value in attributes.items()))
+
+    def coalescing_key(self):
+        return ('color',)
+
+    def coalesce(self, newer_record):
+        self.color = newer_record.color
+
     def __repr__(self):
         return u'<Change color for task {} to {}>'.format(self.task, self.color)
 
@@ -263,6 +487,7 @@ class AddResourceAssignmentTaskChangeRecord(TaskChangeRecord):
 
     def __init__(self, resource_assignment):
         self.resource_assignment = resource_assignment
+        self.task = resource_assignment.task
 
     def change_applescript_code(self):
         return """assign resource {} to task {} units {}""".format(self.resource_assignment.resource.id, self.resource_assignment.task.id, self.resource_assignment.units)
@@ -270,24 +495,95 @@ class AddResourceAssignmentTaskChangeRecord(TaskChangeRecord):
     def targets_document(self):
         return True
 
+    def apply_to_oplx_task_element(self, element):
+        resource_element_id = OplxBundle.element_id('r', self.resource_assignment.resource.id)
+        if any(assignment.get('idref') == resource_element_id for assignment in element.findall('assignment')):
+            return
+        attributes = {'idref': resource_element_id}
+        if self.resource_assignment.units != 1:
+            attributes['units'] = OplxBundle.xml_value(self.resource_assignment.units)
+        OplxBundle.append_child_element(element, 'assignment', attributes)
+
     def __repr__(self):
         return u'<Add resource assignment for task {}: resource {}>'.format(self.resource_assignment.task, self.resource_assignment.resource)
 
 
 class SetCustomDataValueTaskChangeRecord(TaskChangeRecord):
 
-    def __init__(self, task, name, value):
+    def __init__(self, task, name, value, old_value=None):
         self.name = name
         self.value = value
+        self.old_value = old_value
         self.task = task
 
     def change_applescript_code(self):
         return """make custom data entry with properties {{name:"{}", value:"{}"}}""".format(self.name, self.value)
 
+    def apply_to_oplx_task_element(self, element):
+        user_data = OplxBundle.child_element(element, 'user-data')
+        children = list(user_data)
+        for key, value in zip(children[::2], children[1::2]):
+            if key.text == self.name:
+                value.text = self.value
+                return
+        OplxBundle.append_child_element(user_data, 'key').text = self.name
+        OplxBundle.append_child_element(user_data, 'string').text = self.value
+
+    def coalescing_key(self):
+        return ('custom_data', self.name)
+
+    def coalesce(self, newer_record):
+        self.value = newer_record.value
+
+    def is_noop(self):
+        return self.value == self.old_value
+
     def __repr__(self):
         return u'<Set custom data value change for task {}: name "{}", value "{}">'.format(self.task, self.name, self.value)
 
 
+class SetDateTaskChangeRecord(TaskChangeRecord):
+    """Sets a date property of a task to a value that is carried by the record itself."""
+
+    date_properties = {
+        'starting_constraint_date': {'applescript_property_name': 'start after date', 'oplx_element_name': 'start-no-earlier-than'},
+    }
+
+    def __init__(self, task, property_name, value):
+        self.task = task
+        self.property_name = property_name
+        self.old_value = getattr(task, property_name, None)
+        self.value = value
+
+    def change_applescript_code(self):
+        # AppleScript dates are in local time and date literals depend on the locale
+        local_time = time.localtime(calendar.timegm(self.value.utctimetuple()))
+        return """
+            set changed_date to current date
+            set day of changed_date to 1
+            set year of changed_date to {}
+            set month of changed_date to {}
+            set day of changed_date to {}
+            set time of changed_date to {}
+            set {} to changed_date
+        """.format(local_time.tm_year, local_time.tm_mon, local_time.tm_mday, local_time.tm_hour * 3600 + local_time.tm_min * 60 + local_time.tm_sec, self.date_properties[self.property_name]['applescript_property_name'])
+
+    def apply_to_oplx_task_element(self, element):
+        OplxBundle.set_child_element_text(element, self.date_properties[self.property_name]['oplx_element_name'], OplxBundle.xml_value(self.value.astimezone(UTCDateValueConverter.utc).replace(tzinfo=None)))
+
+    def coalescing_key(self):
+        return ('property', self.property_name)
+
+    def coalesce(self, newer_record):
+        self.value = newer_record.value
+
+    def is_noop(self):
+        return self.value == self.old_value
+
+    def __repr__(self):
+        return u'<Date change for task {}: property "{}", old value "{}", new value "{}">'.format(self.task, self.property_name, self.old_value, self.value)
+
+
 class TaskCollection(object):
     """An abstract base class for classes that are containers for sets of tasks in a project."""
 
@@ -355,6 +651,37 @@ class TaskCollection(object):
         self.add_task(task)
         return task
 
+    def create_tasks(self, properties_list):
+        """Create several tasks with one script and read them back with another one."""
+        if not properties_list:
+            return []
+        make_task_strings = []
+        for properties in properties_list:
+            applescript_property_pairs = [u'{}: {}'.format(applescript_property_name, applescript_value) for key, applescript_property_name, applescript_value in self.encoded_properties(properties)]
+            make_task_strings.append(u'set end of new_task_ids to id of (make new task with properties {{{}}})'.format(', '.join(applescript_property_pairs)))
+
+        make_tasks_string = u"""
+        set new_task_ids to {{}}
+        {}
+        set AppleScript's text item delimiters to ","
+        return new_task_ids as text
+        """.format('\n        '.join(make_task_strings))
+        create_tasks_code = self.applescript_target_wrapper().format(make_tasks_string)
+        cmd = AppleScript(create_tasks_code)
+        cmd.run()
+        if not cmd.stdout:
+            raise Exception('AppleScript code did not produce any output, unable to read the ids of {} new tasks'.format(len(properties_list)))
+        task_ids = [int(task_id) for task_id in cmd.stdout.split(',')]
+        if len(task_ids) != len(properties_list):
+            raise Exception('Created {} tasks but got {} task ids: {}'.format(len(properties_list), len(task_ids), cmd.stdout))
+
+        tasks = []
+        for task_data in ChunkedDocumentReader(self.document().name).read_chunk(task_ids):
+            task = Task(task_data, self)
+            self.add_task(task)
+            tasks.append(task)
+        return tasks
+
     def encoded_properties(self, properties):
         encoded_properties = []
         for key, value in properties.items():
@@ -382,11 +709,16 @@ class Task(TaskCollection):
     TASK_STATUS_OK = 'OPTo'
     TASK_STATUS_PAST_DUE = 'OPTp'
 
+    # custom data values are reported to task observers as "custom:<name>" properties
+    CUSTOM_DATA_PROPERTY_PREFIX = 'custom:'
+    # the property name reported to task observers for removed tasks
+    TASK_REMOVED = 'removed'
+
     simple_properties = set('completed_effort ending_constraint_date outline_number ending_date duration remaining_effort effort id name total_cost priority starting_date starting_constraint_date prerequisites custom_data task_type task_status'.split())
     mutable_simple_properties = {
-        'effort': {'quoted': False},
-        'name': {'quoted': True},
-        'completed_effort': {'quoted': False, 'applescript_property_name': 'completed effort'},
+        'effort': {'quoted': False, 'oplx_element_name': 'effort'},
+        'name': {'quoted': True, 'oplx_element_name': 'title'},
+        'completed_effort': {'quoted': False, 'applescript_property_name': 'completed effort', 'oplx_element_name': 'effort-done'},
     }
 
     property_value_converter_map = {
@@ -400,12 +732,17 @@ class Task(TaskCollection):
         'starting_date': UTCDateValueConverter,
     }
 
+    interned_properties = set(['task_status', 'task_type', 'custom_data'])
+
+    export_properties = 'outline_number name task_type task_status effort completed_effort remaining_effort duration total_cost priority starting_date ending_date starting_constraint_date ending_constraint_date custom_data'.split()
+
     def __init__(self, task_data, parent=None):
         super(Task, self).__init__(parent)
 
         self.resource_assignments = []
         self.prerequisites = []
         self.dependents = []
+        interned_values = self.document().interned_values
 
         for key, value in task_data.items():
             converter_class = self.value_converter_for_property(key)
@@ -417,6 +754,9 @@ class Task(TaskCollection):
                     print value
                     raise
 
+            if key in self.interned_properties:
+                value = interned_values.intern(value)
+
             if key in self.simple_properties:
                 setattr(self, key, value)
                 continue
@@ -442,20 +782,50 @@ class Task(TaskCollection):
         return None
 
     def __setattr__(self, key, value):
-        if key in self.mutable_simple_properties:
-            self.add_change_record(SimplePropertyTaskChangeRecord(self, key))
+        if key in self.mutable_simple_properties and 'change_records' in self.__dict__:
+            document = self.document()
+            with document.change_lock:
+                old_value = getattr(self, key)
+                self.append_change_record(SimplePropertyTaskChangeRecord(self, key))
+                super(Task, self).__setattr__(key, value)
+            document.task_changed(self)
+            document.task_property_changed(self, key, old_value, value)
+            return
         super(Task, self).__setattr__(key, value)
+        if key in self.simple_properties and 'change_records' in self.__dict__:
+            # properties set directly, without a change record, still change the subtree hashes
+            self.document().cached_task_tree_hashes = None
 
     def set_custom_data_value(self, name, value):
+        old_value = self.custom_data.get(name)
         self.custom_data[name] = value
         self.document().update_custom_data_value_to_task_map_for_task(self)
-        self.add_change_record(SetCustomDataValueTaskChangeRecord(self, name, value))
+        self.add_change_record(SetCustomDataValueTaskChangeRecord(self, name, value, old_value))
+        self.document().task_property_changed(self, self.CUSTOM_DATA_PROPERTY_PREFIX + name, old_value, value)
 
     def add_change_record(self, record):
         if not hasattr(self, 'change_records'):
             return
 
-        self.change_records.append(record)
+        document = self.document()
+        with document.change_lock:
+            self.append_change_record(record)
+        document.task_changed(self)
+
+    def append_change_record(self, record):
+        # Keep one record per task and property, it carries the original
+        # value and is compared against the final value at commit time
+        coalescing_key = record.coalescing_key()
+        existing_record = None
+        if coalescing_key is not None:
+            existing_record = next((r for r in self.change_records if r.coalescing_key() == coalescing_key), None)
+        if existing_record:
+            existing_record.coalesce(record)
+        else:
+            self.change_records.append(record)
+
+    def pending_change_records(self):
+        return [record for record in self.change_records if not record.is_noop()]
 
     def clear_change_records(self):
         del(self.change_records[:])
@@ -491,13 +861,15 @@ class Task(TaskCollection):
         value_description = cls.mutable_simple_properties.get(property_name)
         return value_description.get('applescript_property_name', property_name)
 
-    def applescript_target_wrapper(self):
-        task_target_code = u"""
+    def applescript_task_target_code(self):
+        return u"""
             tell task {}
                 {{}}
             end tell
         """.format(self.id)
-        return self.document().applescript_target_wrapper().format(task_target_code)
+
+    def applescript_target_wrapper(self):
+        return self.document().applescript_target_wrapper().format(self.applescript_task_target_code())
 
     #### Resources
 
@@ -508,6 +880,8 @@ class Task(TaskCollection):
         return [assignment.resource for assignment in self.resource_assignments]
 
     def assign_to_resource(self, resource):
+        if resource in self.assigned_resources():
+            return
         assignment = ResourceAssignment(resource, self)
         self.add_change_record(AddResourceAssignmentTaskChangeRecord(assignment))
 
@@ -537,30 +911,40 @@ class Task(TaskCollection):
     def has_dependencies(self):
         return self.has_dependents() or self.has_prerequisites()
 
-    def commit_changes(self, dry_run=False):
-        change_records = self.change_records
-
-        records_targeting_document = [record for record in change_records if record.targets_document()]
-        records_targeting_task = [record for record in change_records if not record.targets_document()]
+    def take_pending_change_records(self):
+        with self.document().change_lock:
+            change_records = self.pending_change_records()
+            self.clear_change_records()
+        return change_records
 
-        self.clear_change_records()
-
-        change_applescript_code = '\n'.join(change_record.change_applescript_code() for change_record in records_targeting_task)
-        change_applescript_code = self.applescript_target_wrapper().format(change_applescript_code)
+    def restore_change_records(self, change_records):
+        """Put back records taken with take_pending_change_records() that could not be
+        committed, newer records of the same property are coalesced into them.
+        """
+        with self.document().change_lock:
+            newer_change_records = list(self.change_records)
+            self.change_records[:] = change_records
+            for record in newer_change_records:
+                self.append_change_record(record)
 
-        doc_change_applescript_code = '\n'.join(change_record.change_applescript_code() for change_record in records_targeting_document)
-        doc_change_applescript_code = self.document().applescript_target_wrapper().format(doc_change_applescript_code)
+    def commit_changes(self, dry_run=False):
+        self.document().commit_tasks([self], dry_run=dry_run)
 
-        change_applescript_code += doc_change_applescript_code
-        # print change_applescript_code
+    #### Utilities
 
-        if dry_run:
-            print change_applescript_code
-        else:
-            cmd = AppleScript(change_applescript_code)
-            cmd.run()
+    def parent_task(self):
+        if isinstance(self.parent, Task):
+            return self.parent
+        return None
 
-    #### Utilities
+    def export_record(self):
+        parent_task = self.parent_task()
+        record = collections.OrderedDict()
+        record['id'] = self.id
+        record['parent_id'] = parent_task.id if parent_task else None
+        for property_name in self.export_properties:
+            record[property_name] = DocumentExporter.plain_value(getattr(self, property_name))
+        return record
 
     def __repr__(self):
         return u'<Task {0}: {1}>'.format(self.id, self.name)
@@ -576,6 +960,16 @@ class TaskDependency(object):
         prerequisite_task.add_dependent(self)
         dependent_task.add_prerequisite(self)
 
+    def export_record(self):
+        record = collections.OrderedDict()
+        record['prerequisite_task_id'] = self.prerequisite_task.id
+        record['dependent_task_id'] = self.dependent_task.id
+        record['dependency_type'] = self.dependency_type
+        return record
+
+    def __repr__(self):
+        return u'<TaskDependency {0} -> {1} ({2})>'.format(self.prerequisite_task, self.dependent_task, self.dependency_type)
+
 
 class Resource(object):
 
@@ -590,6 +984,12 @@ class Resource(object):
     def assigned_tasks(self):
         return [assignment.task for assignment in self.resource_assignments]
 
+    def export_record(self):
+        record = collections.OrderedDict()
+        record['id'] = self.id
+        record['name'] = self.name
+        return record
+
     def __repr__(self):
         return u'<Resource {0} {1}>'.format(self.id, self.name)
 
@@ -604,32 +1004,903 @@ class ResourceAssignment(object):
         resource._add_resource_assignment(self)
         task._add_resource_assignment(self)
 
+    def __setattr__(self, key, value):
+        super(ResourceAssignment, self).__setattr__(key, value)
+        if key == 'units' and 'task' in self.__dict__:
+            # units set directly still change the task's relation hash
+            self.task.document().cached_task_tree_hashes = None
+
+    def export_record(self):
+        record = collections.OrderedDict()
+        record['task_id'] = self.task.id
+        record['resource_id'] = self.resource.id
+        record['resource_name'] = self.resource.name
+        record['units'] = self.units
+        return record
+
     def __repr__(self):
         return u'<ResourceAssignment resource={0} unit={1} task={2}>'.format(self.resource, self.units, self.task)
 
 
+OplxScenarioInfo = collections.namedtuple('OplxScenarioInfo', 'id name filename')
+
+
+class OplxBundle(object):
+    """An OmniPlan .oplx document bundle on disk.
+
+    The scenario XML (Actual.xml) is read with an incremental parser that
+    discards every top-level element once it has been converted, and produces
+    the same document data structure as the AppleScript extraction. Changes are
+    written back with a streaming rewrite pass that only builds elements for the
+    <task> elements being changed, into a temporary file which then atomically
+    replaces the original. The change log is not updated.
+
+    A bundle can hold several scenarios, for example the actual schedule and
+    baselines, which are listed in __TOC.xml. Each OplxBundle instance reads
+    one scenario file, scenario_bundle() returns the instance for another one.
+    Instances for the scenarios of the same bundle share one table of task
+    names and dates, so the identical metadata of the scenarios is stored once.
+    """
+
+    XML_NAMESPACE = '{http://www.omnigroup.com/namespace/OmniPlan/v2}'
+    SCENARIO_FILENAME = 'Actual.xml'
+    CHANGELOG_FILENAME = '__changelog.xml'
+    TOC_FILENAME = '__TOC.xml'
+
+    task_type_map = {
+        'group': Task.TASK_TYPE_GROUP,
+        'milestone': Task.TASK_TYPE_MILESTOME,
+        'hammock': Task.TASK_TYPE_HAMMOCK,
+    }
+
+    def __init__(self, path, scenario_filename=None, shared_values=None):
+        self.path = path
+        self.scenario_path = os.path.join(path, scenario_filename or self.SCENARIO_FILENAME)
+        self.shared_values = shared_values if shared_values is not None else {}
+        self.changelog_path = os.path.join(path, self.CHANGELOG_FILENAME)
+
+    def __repr__(self):
+        return u'<OplxBundle {0}>'.format(self.path)
+
+    @staticmethod
+    def element_id(prefix, id):
+        return '{}{}'.format(prefix, id)
+
+    @staticmethod
+    def id_for_element_id(element_id):
+        return int(element_id[1:])
+
+    @staticmethod
+    def parse_date(value):
+        if not value:
+            return ''
+        # equivalent to strptime(value[:19], '%Y-%m-%dT%H:%M:%S'), which is much slower
+        return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]), int(value[17:19]))
+
+    def changelog_reader(self):
+        return ChangelogReader(self.changelog_path)
+
+    #### Scenarios
+
+    def scenario_infos(self):
+        """Return the OplxScenarioInfo of every scenario listed in __TOC.xml, and the
+        ID of the scenario that is being edited, which may be None.
+        """
+        ns = self.XML_NAMESPACE
+        toc_path = os.path.join(self.path, self.TOC_FILENAME)
+        if not os.path.exists(toc_path):
+            return [OplxScenarioInfo(None, os.path.splitext(self.SCENARIO_FILENAME)[0], self.SCENARIO_FILENAME)], None
+
+        scenario_infos = []
+        editing_scenario_id = None
+        for event, element in cElementTree.iterparse(toc_path):
+            if element.tag == ns + 'scenario' and element.get('filename'):
+                scenario_infos.append(OplxScenarioInfo(element.get('id'), element.get('name'), element.get('filename')))
+            elif element.tag == ns + 'editing-scenario':
+                editing_scenario_id = element.text
+        return scenario_infos, editing_scenario_id
+
+    def scenario_info(self, name):
+        """Return the OplxScenarioInfo of the scenario with the given name or ID."""
+        scenario_infos, editing_scenario_id = self.scenario_infos()
+        for scenario_info in scenario_infos:
+            if name in (scenario_info.name, scenario_info.id):
+                return scenario_info
+        raise Exception('No scenario "{}" in {}, available scenarios: {}'.format(name, self, ', '.join(info.name for info in scenario_infos)))
+
+    def editing_scenario_info(self):
+        scenario_infos, editing_scenario_id = self.scenario_infos()
+        for scenario_info in scenario_infos:
+            if scenario_info.id == editing_scenario_id:
+                return scenario_info
+        return scenario_infos[0]
+
+    def scenario_bundle(self, name):
+        """Return an OplxBundle for the scenario with the given name or ID that
+        shares its metadata table with this one.
+        """
+        return OplxBundle(self.path, self.scenario_info(name).filename, shared_values=self.shared_values)
+
+    def shared_value(self, value):
+        return self.shared_values.setdefault(value, value)
+
+    def shared_date(self, value):
+        if not value:
+            return ''
+        key = ('date', value)
+        date = self.shared_values.get(key)
+        if date is None:
+            date = self.shared_values[key] = self.parse_date(value)
+        return date
+
+    #### Reading
+
+    def read_document_data(self):
+        ns = self.XML_NAMESPACE
+        task_elements_data = {}
+        resources = []
+        top_task_id = None
+        project_start_date = ''
+
+        depth = 0
+        for event, element in cElementTree.iterparse(self.scenario_path, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+
+            if element.tag == ns + 'task':
+                task_elements_data[self.id_for_element_id(element.get('id'))] = self.task_element_data(element)
+            elif element.tag == ns + 'resource':
+                resource_id = self.id_for_element_id(element.get('id'))
+                if resource_id >= 0:
+                    resources.append({'id': resource_id, 'name': element.findtext(ns + 'name') or '', 'task_assignments': []})
+            elif element.tag == ns + 'top-task':
+                top_task_id = self.id_for_element_id(element.get('idref'))
+            elif element.tag == ns + 'start-date':
+                project_start_date = self.shared_date(element.text)
+            element.clear()
+
+        resource_map = dict((resource['id'], resource) for resource in resources)
+        for task_id, (task_data, child_task_ids, assignments) in task_elements_data.items():
+            for resource_id, units in assignments:
+                if resource_id in resource_map:
+                    resource_map[resource_id]['task_assignments'].append({'task_id': task_id, 'units': units})
+            if not task_data['starting_date']:
+                task_data['starting_date'] = project_start_date
+
+        return {
+            'child_tasks': self.task_data_tree(top_task_id, task_elements_data),
+            'resources': resources,
+            'selected_task_ids': [],
+            'selected_resource_ids': [],
+        }
+
+    def task_element_data(self, element):
+        ns = self.XML_NAMESPACE
+        task_id = self.id_for_element_id(element.get('id'))
+        effort = int(float(element.findtext(ns + 'effort') or 0))
+        completed_effort = int(float(element.findtext(ns + 'effort-done') or 0))
+
+        custom_data = []
+        user_data = element.find(ns + 'user-data')
+        if user_data is not None:
+            children = list(user_data)
+            for key, value in zip(children[::2], children[1::2]):
+                custom_data.append({'name': key.text or '', 'value': value.text or ''})
+
+        prerequisites = []
+        for prerequisite in element.findall(ns + 'prerequisite-task'):
+            prerequisites.append({
+                'prerequisite_task_id': self.id_for_element_id(prerequisite.get('idref')),
+                'dependent_task_id': task_id,
+                'dependency_type': prerequisite.get('kind', 'FS'),
+            })
+
+        assignments = []
+        for assignment in element.findall(ns + 'assignment'):
+            assignments.append((self.id_for_element_id(assignment.get('idref')), float(assignment.get('units', 1))))
+
+        task_data = {
+            'id': task_id,
+            'name': self.shared_value(element.findtext(ns + 'title') or ''),
+            'outline_number': '',
+            'effort': effort,
+            'completed_effort': completed_effort,
+            'remaining_effort': effort - completed_effort,
+            'duration': int(float(element.findtext(ns + 'duration') or effort)),
+            'total_cost': float(element.findtext(ns + 'static-cost') or 0),
+            'priority': int(element.findtext(ns + 'priority') or 0),
+            'starting_date': self.shared_date(element.findtext(ns + 'leveled-start') or element.findtext(ns + 'start-constraint-date')),
+            'ending_date': '',
+            'starting_constraint_date': self.shared_date(element.findtext(ns + 'start-no-earlier-than')),
+            'ending_constraint_date': self.shared_date(element.findtext(ns + 'end-no-later-than')),
+            'task_status': '',
+            'task_type': self.task_type_map.get(element.findtext(ns + 'type'), Task.TASK_TYPE_STANDARD),
+            'custom_data': custom_data,
+            'prerequisites': prerequisites,
+            'child_tasks': [],
+        }
+        child_task_ids = [self.id_for_element_id(child.get('idref')) for child in element.findall(ns + 'child-task')]
+        return task_data, child_task_ids, assignments
+
+    @staticmethod
+    def task_data_tree(top_task_id, task_elements_data):
+        if top_task_id not in task_elements_data:
+            return []
+        top_child_tasks = []
+        stack = [(top_task_id, top_child_tasks, '')]
+        while stack:
+            task_id, child_task_list, outline_prefix = stack.pop()
+            for index, child_task_id in enumerate(task_elements_data[task_id][1], 1):
+                child_task_data = task_elements_data[child_task_id][0]
+                child_task_data['outline_number'] = '{}{}'.format(outline_prefix, index)
+                child_task_list.append(child_task_data)
+                stack.append((child_task_id, child_task_data['child_tasks'], child_task_data['outline_number'] + '.'))
+        return top_child_tasks
+
+    #### Writing
+
+    @staticmethod
+    def xml_value(value):
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        return unicode(value)
+
+    @staticmethod
+    def child_element(element, tag):
+        child = element.find(tag)
+        if child is None:
+            child = OplxBundle.append_child_element(element, tag)
+        return child
+
+    @staticmethod
+    def append_child_element(element, tag, attributes=None):
+        # reuse the indentation of the existing children
+        children = list(element)
+        child = ElementTree.SubElement(element, tag, attributes or {})
+        if len(children):
+            child.tail = children[-1].tail
+            children[-1].tail = children[-2].tail if len(children) > 1 else element.text
+        return child
+
+    @staticmethod
+    def set_child_element_text(element, tag, text):
+        OplxBundle.child_element(element, tag).text = text
+
+    def apply_change_records(self, change_records, dry_run=False):
+        change_records_by_element_id = collections.OrderedDict()
+        for change_record in change_records:
+            change_records_by_element_id.setdefault(self.element_id('t', change_record.task.id), []).append(change_record)
+
+        if dry_run:
+            for element_id, records in change_records_by_element_id.items():
+                for change_record in records:
+                    print u'{}: {}'.format(element_id, change_record).encode('utf-8')
+            return
+
+        scenario_directory = os.path.dirname(self.scenario_path)
+        output = tempfile.NamedTemporaryFile(dir=scenario_directory, prefix='.' + os.path.basename(self.scenario_path), delete=False)
+        try:
+            with output:
+                OplxScenarioRewriter(self.scenario_path, change_records_by_element_id).rewrite(output)
+                output.flush()
+                os.fsync(output.fileno())
+            os.chmod(output.name, os.stat(self.scenario_path).st_mode & 0777)
+            os.rename(output.name, self.scenario_path)
+        except:
+            os.unlink(output.name)
+            raise
+
+
+class OplxScenarioRewriter(object):
+    """Copies a scenario XML document and applies change records to its top-level <task> elements.
+
+    A first streaming pass with expat records the byte range of every <task>
+    element with pending change records and builds an element tree for just
+    those tasks. A second pass copies the original bytes verbatim, replacing
+    each of those ranges with the serialized changed element.
+    """
+
+    READ_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, input_path, change_records_by_element_id):
+        self.input_path = input_path
+        self.change_records_by_element_id = change_records_by_element_id
+        self.replacements = []
+        self.depth = 0
+        self.element_stack = []
+        self.element_start_index = None
+
+    def rewrite(self, output):
+        self.find_task_elements()
+        missing_element_ids = set(self.change_records_by_element_id) - set(element.get('id') for start_index, end_index, element in self.replacements)
+        if missing_element_ids:
+            raise Exception('No top-level <task> element for change records of {} in {}, nothing was written'.format(', '.join(sorted(missing_element_ids)), self.input_path))
+        for start_index, end_index, element in self.replacements:
+            for change_record in self.change_records_by_element_id[element.get('id')]:
+                change_record.apply_to_oplx_task_element(element)
+
+        with open(self.input_path, 'rb') as f:
+            position = 0
+            for start_index, end_index, element in self.replacements:
+                self.copy_bytes(f, output, start_index - position)
+                output.write(self.serialized_element(element).encode('utf-8'))
+                f.seek(end_index)
+                position = end_index
+            self.copy_bytes(f, output, None)
+
+    def copy_bytes(self, input, output, length):
+        while length is None or length > 0:
+            chunk = input.read(self.READ_CHUNK_SIZE if length is None else min(length, self.READ_CHUNK_SIZE))
+            if not chunk:
+                break
+            output.write(chunk)
+            if length is not None:
+                length -= len(chunk)
+
+    def find_task_elements(self):
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.ordered_attributes = True
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.character_data
+        with open(self.input_path, 'rb') as f, open(self.input_path, 'rb') as self.peek_file:
+            while True:
+                chunk = f.read(self.READ_CHUNK_SIZE)
+                self.parser.Parse(chunk, not chunk)
+                if not chunk:
+                    break
+
+    def start_element(self, name, attribute_list):
+        self.depth += 1
+        attributes = collections.OrderedDict(zip(attribute_list[::2], attribute_list[1::2]))
+        if self.element_stack:
+            self.element_stack.append(ElementTree.SubElement(self.element_stack[-1], name, attributes))
+        elif self.depth == 2 and name == 'task' and attributes.get('id') in self.change_records_by_element_id:
+            self.element_start_index = self.parser.CurrentByteIndex
+            self.element_stack.append(ElementTree.Element(name, attributes))
+
+    def end_element(self, name):
+        self.depth -= 1
+        if not self.element_stack:
+            return
+        element = self.element_stack.pop()
+        if not self.element_stack:
+            # expat reports the end of an empty-element tag <task .../> after its "/>",
+            # and the end of any other element at the start of its end tag
+            end_index = self.parser.CurrentByteIndex
+            if len(element) or element.text or not self.is_empty_element_tag_end(end_index):
+                end_index += len('</{}>'.format(name).encode('utf-8'))
+            self.replacements.append((self.element_start_index, end_index, element))
+
+    def is_empty_element_tag_end(self, index):
+        self.peek_file.seek(index - 2)
+        return self.peek_file.read(2) == '/>'
+
+    def character_data(self, content):
+        if not self.element_stack:
+            return
+        element = self.element_stack[-1]
+        if len(element):
+            element[-1].tail = (element[-1].tail or '') + content
+        else:
+            element.text = (element.text or '') + content
+
+    @classmethod
+    def serialized_element(cls, element):
+        parts = [u'<', element.tag]
+        for key, value in element.attrib.items():
+            parts.append(u' {}={}'.format(key, xml.sax.saxutils.quoteattr(value)))
+        if not element.text and not len(element):
+            parts.append(u'/>')
+            return u''.join(parts)
+
+        parts.append(u'>')
+        if element.text:
+            parts.append(xml.sax.saxutils.escape(element.text))
+        for child in element:
+            parts.append(cls.serialized_element(child))
+            if child.tail:
+                parts.append(xml.sax.saxutils.escape(child.tail))
+        parts.append(u'</{}>'.format(element.tag))
+        return u''.join(parts)
+
+
+ChangelogChangeSet = collections.namedtuple('ChangelogChangeSet', 'user date changes')
+ChangelogChange = collections.namedtuple('ChangelogChange', 'idref task_id attribute type value')
+
+
+class ChangelogReader(object):
+    """Streams the change sets recorded in the __changelog.xml of an .oplx bundle.
+
+    Change sets are parsed incrementally and discarded once they have been
+    yielded, so memory use does not grow with the size of the change log.
+    Change sets are appended in chronological order, which lets since seek
+    with a binary search over the file to the first change set at or after
+    that date, and lets until stop reading at the first later change set.
+    Date values are returned as naive UTC datetimes.
+    """
+
+    CHANGE_SET_START = '<task-change-set '
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return u'<ChangelogReader {0}>'.format(self.path)
+
+    def change_sets(self, since=None, until=None):
+        ns = OplxBundle.XML_NAMESPACE
+        with open(self.path, 'rb') as f:
+            source = self.source_starting_at(f, since) if since else f
+            root = None
+            for event, element in cElementTree.iterparse(source, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    continue
+                if element.tag != ns + 'task-change-set':
+                    continue
+                date = OplxBundle.parse_date(element.get('date') or element.get('timestamp'))
+                if until and date and date > until:
+                    return
+                if not since or (date and date >= since):
+                    changes = [self.change(change_element) for change_element in element.findall(ns + 'change')]
+                    yield ChangelogChangeSet(element.get('user'), date, changes)
+                root.clear()
+
+    @staticmethod
+    def change(element):
+        idref = element.get('idref')
+        task_id = OplxBundle.id_for_element_id(idref) if idref and idref.startswith('t') else None
+        value_type = element.get('type')
+        value = element.get('to')
+        if value_type == 'date':
+            value = OplxBundle.parse_date(value)
+        return ChangelogChange(idref, task_id, element.get('attribute'), value_type, value)
+
+    def source_starting_at(self, f, since):
+        """Return a file-like object with the XML header of the change log followed
+        by its contents from the first change set at or after since.
+        """
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return f
+        contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        first_offset = contents.find(self.CHANGE_SET_START)
+        if first_offset < 0:
+            contents.close()
+            f.seek(0)
+            return f
+
+        low, high = first_offset, size
+        while low < high:
+            middle = (low + high) // 2
+            offset = contents.find(self.CHANGE_SET_START, middle)
+            if offset < 0:
+                high = middle
+                continue
+            date = self.change_set_date(contents, offset)
+            if date is not None and date < since:
+                low = offset + 1
+            else:
+                high = middle
+        offset = contents.find(self.CHANGE_SET_START, low)
+        header = contents[:first_offset]
+        contents.close()
+        if offset < 0:
+            offset = size
+        f.seek(offset)
+        return ConcatenatedReader(header, f)
+
+    @staticmethod
+    def change_set_date(contents, offset):
+        tag_end = contents.find('>', offset)
+        match = re.search(r'\sdate="([^"]+)"', contents[offset:tag_end])
+        return OplxBundle.parse_date(match.group(1)) if match else None
+
+    def statistics(self, since=None, until=None):
+        """Compute ChangelogStatistics in one pass over the change sets."""
+        statistics = ChangelogStatistics()
+        for change_set in self.change_sets(since=since, until=until):
+            statistics.add_change_set(change_set)
+        return statistics
+
+
+class ConcatenatedReader(object):
+    """A minimal file-like object that reads a string followed by the rest of a file."""
+
+    def __init__(self, prefix, f):
+        self.prefix = prefix
+        self.f = f
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.f.read(size)
+        if size < 0 or size >= len(self.prefix):
+            data, self.prefix = self.prefix, ''
+            return data + self.f.read(size - len(data) if size >= 0 else -1)
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+
+class ChangelogStatistics(object):
+    """Aggregates of change log change sets that are updated one change set at a time.
+
+    Edits are counted per change, weeks start on Monday. The date history of a
+    task attribute lists the (change date, new date) pairs of each change
+    that moved that date.
+    """
+
+    def __init__(self):
+        self.change_set_count = 0
+        self.edits_per_user_week = collections.Counter()
+        self.task_churn = collections.Counter()
+        self.date_history = {}
+
+    def add_change_set(self, change_set):
+        self.change_set_count += 1
+        week = None
+        if change_set.date:
+            week = change_set.date.date() - datetime.timedelta(days=change_set.date.weekday())
+        self.edits_per_user_week[(change_set.user, week)] += len(change_set.changes)
+        for change in change_set.changes:
+            if change.task_id is None:
+                continue
+            self.task_churn[change.task_id] += 1
+            if change.type == 'date' and change.value:
+                history = self.date_history.setdefault((change.task_id, change.attribute), [])
+                if not history or history[-1][1] != change.value:
+                    history.append((change_set.date, change.value))
+
+    def most_churned_tasks(self, count=10):
+        """Return (task ID, number of changes) pairs for the most changed tasks."""
+        return self.task_churn.most_common(count)
+
+    def slip_days(self, task_id, attribute):
+        """Return how many calendar days the date attribute of a task moved between
+        its first and its last recorded value.
+        """
+        history = self.date_history.get((task_id, attribute))
+        if not history:
+            return 0.0
+        return (history[-1][1] - history[0][1]).total_seconds() / TimeInterval.SECONDS_PER_DAY
+
+    def slipped_tasks(self, attribute, days=0):
+        """Return (task ID, slip days) pairs of the tasks whose date attribute moved
+        later by more than days, most slipped first.
+        """
+        slips = []
+        for task_id, history_attribute in self.date_history:
+            if history_attribute == attribute:
+                slip_days = self.slip_days(task_id, attribute)
+                if slip_days > days:
+                    slips.append((task_id, slip_days))
+        return sorted(slips, key=lambda slip: (-slip[1], slip[0]))
+
+
+class WriteBehindCommitError(Exception):
+    """Raised by WriteBehindCommitter.flush() when batches failed to commit. The
+    change records of failed_tasks are pending again and are committed with the
+    next commit of those tasks.
+    """
+
+    def __init__(self, errors, failed_tasks):
+        super(WriteBehindCommitError, self).__init__('{} write-behind commit(s) failed, first error: {}'.format(len(errors), errors[0]))
+        self.errors = errors
+        self.failed_tasks = failed_tasks
+
+
+class WriteBehindCommitter(object):
+    """Commits the changes of a document's tasks from a background thread.
+
+    Tasks with new change records are kept in an insertion ordered dirty set.
+    The thread commits them in batches of up to batch_size tasks as soon as a
+    full batch is pending or the oldest dirty task has waited max_delay seconds.
+    Marking a new task dirty blocks while max_pending tasks are waiting. Only
+    one batch is in flight at a time, so the changes of a task are always
+    committed in the order they were made. The changes of a batch that fails
+    to commit stay pending on its tasks, and flush() hands the tasks back in a
+    WriteBehindCommitError. While the committer is enabled, the document's
+    commit_changes() flushes it instead of committing in parallel.
+    """
+
+    def __init__(self, document, batch_size=50, max_delay=2.0, max_pending=1000):
+        self.document = document
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+
+        self.condition = threading.Condition()
+        self.dirty_tasks = collections.OrderedDict()
+        self.batch_in_flight = False
+        self.flush_requested = False
+        self.closed = False
+        self.errors = []
+        self.failed_tasks = []
+
+        self.thread = threading.Thread(target=self.run, name='omniplan-write-behind')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def mark_dirty(self, task):
+        with self.condition:
+            if self.closed:
+                raise Exception('Write-behind committer for {} is closed'.format(self.document))
+            while task not in self.dirty_tasks and len(self.dirty_tasks) >= self.max_pending:
+                self.condition.wait()
+            if task not in self.dirty_tasks:
+                self.dirty_tasks[task] = time.time()
+                self.condition.notify_all()
+
+    def next_batch(self):
+        with self.condition:
+            while True:
+                if self.dirty_tasks:
+                    oldest_age = time.time() - next(self.dirty_tasks.itervalues())
+                    if self.closed or self.flush_requested or len(self.dirty_tasks) >= self.batch_size or oldest_age >= self.max_delay:
+                        break
+                    self.condition.wait(self.max_delay - oldest_age)
+                elif self.closed:
+                    return None
+                else:
+                    self.condition.wait()
+
+            batch = []
+            while self.dirty_tasks and len(batch) < self.batch_size:
+                batch.append(self.dirty_tasks.popitem(last=False)[0])
+            self.batch_in_flight = True
+            self.condition.notify_all()
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            try:
+                self.document.commit_tasks(batch)
+            except Exception as e:
+                print >> sys.stderr, 'Write-behind commit of {} tasks failed: {}'.format(len(batch), e)
+                with self.condition:
+                    self.errors.append(e)
+                    self.failed_tasks.extend(batch)
+            with self.condition:
+                self.batch_in_flight = False
+                self.condition.notify_all()
+
+    def flush(self):
+        """Wait until all pending changes are committed."""
+        with self.condition:
+            self.flush_requested = True
+            self.condition.notify_all()
+            while self.dirty_tasks or self.batch_in_flight:
+                self.condition.wait()
+            self.flush_requested = False
+            errors, self.errors = self.errors, []
+            failed_tasks, self.failed_tasks = self.failed_tasks, []
+        if errors:
+            raise WriteBehindCommitError(errors, failed_tasks)
+
+    def close(self):
+        """Commit all pending changes and stop the background thread."""
+        try:
+            self.flush()
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+            self.thread.join()
+
+
+class InotifyChangeSource(object):
+    """Waits for changes to files in one directory with the Linux inotify API."""
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, directory, filenames):
+        self.filenames = set(filenames)
+        libc_path = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_path, use_errno=True) if libc_path else None
+        if not libc or not hasattr(libc, 'inotify_init'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, directory.encode('utf-8') if isinstance(directory, unicode) else directory, mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed for {}'.format(directory))
+
+    def wait(self, timeout):
+        """Return True if one of the files changed within timeout seconds."""
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                return False
+            if self.read_changed_filenames() & self.filenames:
+                return True
+
+    def read_changed_filenames(self):
+        data = os.read(self.fd, 65536)
+        filenames = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            filenames.add(data[offset:offset + name_length].rstrip('\0'))
+            offset += name_length
+        return filenames
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingChangeSource(object):
+    """Waits for changes to files by comparing their modification times and sizes."""
+
+    def __init__(self, paths, interval=1.0):
+        self.paths = paths
+        self.interval = interval
+        self.signatures = self.file_signatures()
+
+    def file_signatures(self):
+        signatures = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                signatures.append((stat.st_mtime, stat.st_size, stat.st_ino))
+            except OSError:
+                signatures.append(None)
+        return signatures
+
+    def wait(self, timeout):
+        """Return True if one of the files changed within timeout seconds."""
+        deadline = time.time() + timeout
+        while True:
+            signatures = self.file_signatures()
+            if signatures != self.signatures:
+                self.signatures = signatures
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class BundleWatcher(object):
+    """Keeps a document loaded from an .oplx bundle up to date with changes saved to the bundle.
+
+    The scenario and change log files are watched with inotify where it is
+    available and by polling their modification times otherwise. A burst of
+    saves is handled once after no further change was seen for debounce
+    seconds. The bundle is then read again and diffed against the document.
+    If only task properties changed, the changed tasks are updated in place,
+    otherwise the document's tasks, resources and dependencies are rebuilt.
+    Subscribers are called from the watcher thread with the set of changed
+    task IDs. Changes read from the bundle do not create change records and
+    replace uncommitted local changes of the same tasks.
+    """
+
+    def __init__(self, document, debounce=0.5, poll_interval=1.0, use_inotify=True):
+        self.document = document
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.subscribers = []
+        self.errors = []
+        self.stopped = threading.Event()
+
+        bundle = document.bundle
+        self.change_source = None
+        if use_inotify:
+            try:
+                self.change_source = InotifyChangeSource(bundle.path, [os.path.basename(bundle.scenario_path), os.path.basename(bundle.changelog_path)])
+            except OSError:
+                pass
+        if not self.change_source:
+            self.change_source = PollingChangeSource([bundle.scenario_path, bundle.changelog_path], interval=poll_interval)
+
+        self.thread = threading.Thread(target=self.run, name='omniplan-bundle-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def run(self):
+        while not self.stopped.is_set():
+            if not self.change_source.wait(self.poll_interval):
+                continue
+            while not self.stopped.is_set() and self.change_source.wait(self.debounce):
+                pass
+            if self.stopped.is_set():
+                return
+            try:
+                self.reload()
+            except Exception as e:
+                print >> sys.stderr, 'Reloading {} failed: {}'.format(self.document.bundle, e)
+                self.errors.append(e)
+
+    def reload(self):
+        """Apply the changes saved to the bundle to the document and notify the
+        subscribers, returns the set of changed task IDs.
+        """
+        document_data = self.document.bundle.read_document_data()
+        changed_task_ids = self.document.apply_external_document_data(document_data)
+        if changed_task_ids:
+            for callback in list(self.subscribers):
+                callback(changed_task_ids)
+        return changed_task_ids
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.change_source.close()
+
+
 class OmniPlanDocument(TaskCollection):
 
-    def __init__(self, name, allow_cache=False):
+    def __init__(self, name, allow_cache=False, document_data=None, transport='plist'):
         super(OmniPlanDocument, self).__init__()
+        if transport not in ('plist', 'json'):
+            raise Exception('Unknown transport "{}", expected plist or json'.format(transport))
         self.name = name
+        self.transport = transport
         self.document_data_raw = None
         self.document_data = None
         self.selected_tasks = []
         self.selected_resources = []
 
         self.custom_data_value_to_task_map = {}
+        self.custom_data_value_to_task_map_entries = set()
         self.task_map = {}
         self.resource_map = {}
-
-        self.read_document(allow_cache=allow_cache)
+        self.cached_task_tree_hashes = None
+        self.bundle = None
+        self.task_observers = []
+        self.change_lock = threading.RLock()
+        # serializes taking and applying change records, so that the changes of
+        # a task are applied in order by foreground and write-behind commits
+        self.commit_lock = threading.Lock()
+        self.write_behind_committer = None
+        self.bundle_watcher = None
+        self.scenario_documents = {}
+        self.search_indexes = {}
+        self.interned_values = InternedValues()
+
+        if document_data is None:
+            self.read_document(allow_cache=allow_cache)
+        else:
+            self.document_data = document_data
         self.parse_document_data()
 
     def __repr__(self):
         return u'<OmniPlanDocument {0}>'.format(self.name)
 
     def read_document(self, allow_cache=False):
-        script_code = self.omniplan_document_data_query_applescript_code()
+        if self.transport == 'json':
+            script_code = self.omniplan_document_data_json_query_applescript_code()
+        else:
+            script_code = self.omniplan_document_data_query_applescript_code()
 
         if allow_cache:
             try:
@@ -650,7 +1921,7 @@ class OmniPlanDocument(TaskCollection):
                     print >> sys.stderr, 'Failed execution of script "{}" for command: {}'.format(path, cmd.run_cmd(self.name))
                 raise Exception('Unable to get project data for OmniPlan document "{}", make sure that it is already open in OmniPlan'.format(self.name))
             self.document_data_raw = cmd.stdout
-            self.document_data = cmd.plist_result()
+            self.document_data = cmd.json_result() if self.transport == 'json' else cmd.plist_result()
             if allow_cache:
                 with open('/tmp/omniplan-cache.dat', 'w') as f:
                     pickle.dump([self.document_data, self.document_data_raw], f)
@@ -665,6 +1936,55 @@ class OmniPlanDocument(TaskCollection):
         end tell
         """.format(self.name)
 
+    def commit_changes(self, dry_run=False):
+        """Commit the pending changes of all tasks in one batch, or wait for
+        the write-behind committer to commit them if it is enabled."""
+        if self.write_behind_committer and not dry_run:
+            self.write_behind_committer.flush()
+            return
+        self.commit_tasks([task for task in self.all_tasks() if task.change_records], dry_run=dry_run)
+
+    def commit_tasks(self, tasks, dry_run=False):
+        with self.commit_lock:
+            change_records = []
+            for task in tasks:
+                change_records.extend(task.take_pending_change_records())
+            if not change_records:
+                return
+
+            try:
+                if self.bundle:
+                    self.bundle.apply_change_records(change_records, dry_run=dry_run)
+                    return
+
+                change_applescript_code = self.change_applescript_code(change_records)
+                if dry_run:
+                    print change_applescript_code
+                else:
+                    cmd = AppleScript(change_applescript_code)
+                    cmd.run()
+            except:
+                # keep the changes pending so that a later commit can retry them
+                change_records_by_task = collections.OrderedDict()
+                for change_record in change_records:
+                    change_records_by_task.setdefault(change_record.task, []).append(change_record)
+                for task, task_change_records in change_records_by_task.items():
+                    task.restore_change_records(task_change_records)
+                raise
+
+    def change_applescript_code(self, change_records):
+        task_change_code = collections.OrderedDict()
+        document_change_code = []
+        for change_record in change_records:
+            if change_record.targets_document():
+                document_change_code.append(change_record.change_applescript_code())
+            else:
+                task_change_code.setdefault(change_record.task, []).append(change_record.change_applescript_code())
+
+        change_code = [task.applescript_task_target_code().format('\n'.join(code)) for task, code in task_change_code.items()]
+        change_code.extend(document_change_code)
+        return self.applescript_target_wrapper().format('\n'.join(change_code))
+
     def parse_document_data(self):
         self.add_tasks_for_task_data_list(self.document_data['child_tasks'])
         self.parse_resources()
@@ -678,7 +1998,7 @@ class OmniPlanDocument(TaskCollection):
             for dependency_data_item in prerequisite_infos:
                 prerequisite_task = self.task_for_id(dependency_data_item['prerequisite_task_id'])
                 dependent_task = self.task_for_id(dependency_data_item['dependent_task_id'])
-                dependency_type = dependency_data_item['dependency_type']
+                dependency_type = self.interned_values.intern(dependency_data_item['dependency_type'])
                 dependency = TaskDependency(prerequisite_task, dependent_task, dependency_type)
 
     def parse_resources(self):
@@ -699,13 +2019,199 @@ class OmniPlanDocument(TaskCollection):
 
     def task_added(self, task):
         self.task_map[task.id] = task
+        self.cached_task_tree_hashes = None
+        self.task_property_changed(task, None, None, None)
         self.update_custom_data_value_to_task_map_for_task(task)
 
+    def task_changed(self, task):
+        self.cached_task_tree_hashes = None
+        if self.write_behind_committer:
+            self.write_behind_committer.mark_dirty(task)
+
+    def enable_write_behind(self, batch_size=50, max_delay=2.0, max_pending=1000):
+        """Commit changed tasks in the background instead of on each commit_changes() call.
+
+        See WriteBehindCommitter, call flush() or close() to wait for pending changes.
+        """
+        if not self.write_behind_committer:
+            self.write_behind_committer = WriteBehindCommitter(self, batch_size=batch_size, max_delay=max_delay, max_pending=max_pending)
+        return self.write_behind_committer
+
+    def flush(self):
+        if self.write_behind_committer:
+            self.write_behind_committer.flush()
+
+    def close(self):
+        if self.bundle_watcher:
+            self.bundle_watcher.close()
+            self.bundle_watcher = None
+        if self.write_behind_committer:
+            committer = self.write_behind_committer
+            committer.close()
+            self.write_behind_committer = None
+
+    def watch(self, callback=None, debounce=0.5, poll_interval=1.0, use_inotify=True):
+        """Keep a document loaded from an .oplx bundle up to date with changes saved
+        to the bundle, see BundleWatcher. callback is called with the set of
+        changed task IDs. Call close() to stop watching.
+        """
+        if not self.bundle:
+            raise Exception('Only documents loaded from an .oplx bundle can be watched: {}'.format(self))
+        if not self.bundle_watcher:
+            self.bundle_watcher = BundleWatcher(self, debounce=debounce, poll_interval=poll_interval, use_inotify=use_inotify)
+        if callback:
+            self.bundle_watcher.subscribe(callback)
+        return self.bundle_watcher
+
+    def apply_external_document_data(self, document_data):
+        """Bring the document up to date with document data read from outside,
+        without creating change records. Returns the set of changed task IDs.
+        """
+        new_document = OmniPlanDocument(self.name, document_data=document_data)
+        diff = self.diff(new_document)
+        if diff.is_empty():
+            return set()
+
+        structural_changes = (
+            diff.added_tasks, diff.removed_tasks, diff.moved_tasks,
+            diff.added_resources, diff.removed_resources, diff.modified_resources,
+            diff.added_assignments, diff.removed_assignments, diff.modified_assignments,
+            diff.added_dependencies, diff.removed_dependencies, diff.modified_dependencies,
+        )
+        if any(structural_changes):
+            self.rebuild(document_data, new_document)
+        else:
+            changes = []
+            with self.change_lock:
+                for modification in diff.modified_tasks:
+                    task = self.task_map[modification.old_task.id]
+                    changes.extend((task, property_name, old_value, new_value) for property_name, old_value, new_value in self.update_task_in_place(task, modification.new_task))
+                self.cached_task_tree_hashes = None
+            self.notify_task_observers(changes)
+        return diff.changed_task_ids()
+
+    def rebuild(self, document_data, new_document=None):
+        """Replace the tasks, resources and dependencies with those of document_data.
+
+        The new model is built separately and swapped in under the change lock,
+        so the document is never seen half rebuilt. Task observers are then told
+        that all previous tasks were removed and all new tasks were added.
+        """
+        if new_document is None:
+            new_document = OmniPlanDocument(self.name, document_data=document_data)
+        with self.change_lock:
+            removed_tasks = list(self.descendants())
+            for task in new_document.tasks:
+                task.parent = self
+            self.tasks = new_document.tasks
+            self.task_map = new_document.task_map
+            self.resource_map = new_document.resource_map
+            self.custom_data_value_to_task_map = new_document.custom_data_value_to_task_map
+            self.custom_data_value_to_task_map_entries = new_document.custom_data_value_to_task_map_entries
+            self.selected_tasks = new_document.selected_tasks
+            self.selected_resources = new_document.selected_resources
+            self.interned_values = new_document.interned_values
+            self.cached_task_tree_hashes = None
+            self.document_data = document_data
+
+        # child tasks before their parent task, the order in which tasks are added while parsing
+        changes = [(task, Task.TASK_REMOVED, None, None) for task in reversed(removed_tasks)]
+        changes.extend((task, None, None, None) for task in reversed(list(self.descendants())))
+        self.notify_task_observers(changes)
+
+    def update_task_in_place(self, task, new_task):
+        """Copy the property values of new_task to task and return the changes
+        as (property_name, old_value, new_value) tuples.
+        """
+        changed_properties = []
+        for property_name in Task.simple_properties - set(['prerequisites', 'custom_data']):
+            old_value, new_value = getattr(task, property_name), getattr(new_task, property_name)
+            if old_value != new_value:
+                task.__dict__[property_name] = new_value
+                changed_properties.append((property_name, old_value, new_value))
+
+        old_custom_data = task.custom_data
+        if old_custom_data != new_task.custom_data:
+            for key, value in old_custom_data.items():
+                tasks = self.tasks_for_custom_data_value(key, value)
+                if task in tasks:
+                    tasks.remove(task)
+                    self.custom_data_value_to_task_map_entries.discard((key, value, id(task)))
+            task.custom_data = dict(new_task.custom_data)
+            self.update_custom_data_value_to_task_map_for_task(task)
+            for key in sorted(set(old_custom_data) | set(task.custom_data)):
+                if old_custom_data.get(key) != task.custom_data.get(key):
+                    changed_properties.append((Task.CUSTOM_DATA_PROPERTY_PREFIX + key, old_custom_data.get(key), task.custom_data.get(key)))
+        return changed_properties
+
+    def sync(self, records, key='custom:TicketID', dry_run=False):
+        """Make the document match external records with the smallest set of
+        changes, see TaskSync. Returns a SyncReport.
+        """
+        return TaskSync(self, key=key).sync(records, dry_run=dry_run)
+
+    def add_task_observer(self, observer):
+        """Register a callable that is called with (task, property_name, old_value, new_value)
+        whenever a mutable task property or custom data value changes. Custom data
+        property names have the form "custom:<name>". For newly added tasks the
+        property name and values are None, for removed tasks the property name
+        is Task.TASK_REMOVED and the values are None.
+        """
+        self.task_observers.append(observer)
+
+    def remove_task_observer(self, observer):
+        self.task_observers.remove(observer)
+
+    def task_property_changed(self, task, property_name, old_value, new_value):
+        for observer in self.task_observers:
+            observer(task, property_name, old_value, new_value)
+
+    def notify_task_observers(self, changes):
+        """Send a list of (task, property_name, old_value, new_value) changes to all
+        observers. A failing observer does not keep the others from seeing the
+        changes, the first error is raised at the end.
+        """
+        exc_info = None
+        for observer in list(self.task_observers):
+            try:
+                for change in changes:
+                    observer(*change)
+            except Exception:
+                exc_info = exc_info or sys.exc_info()
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def search_index(self, custom_data_keys=()):
+        """Return the TaskSearchIndex over task names, outline numbers and the
+        given custom data fields, it is built on first use and then kept up to
+        date as tasks change.
+        """
+        custom_data_keys = tuple(sorted(custom_data_keys))
+        search_index = self.search_indexes.get(custom_data_keys)
+        if search_index is None:
+            search_index = self.search_indexes[custom_data_keys] = TaskSearchIndex(self, custom_data_keys)
+        return search_index
+
+    def rollup_engine(self, custom_aggregates=None):
+        return RollupEngine(self, custom_aggregates=custom_aggregates)
+
+    def resource_load(self, start, end, bucket='day'):
+        return ResourceLoad(self, start, end, bucket=bucket)
+
+    def level_resources(self, capacity=1.0):
+        return ResourceLeveler(self, capacity=capacity).level()
+
+    def task_tree_hashes(self):
+        if self.cached_task_tree_hashes is None:
+            self.cached_task_tree_hashes = TaskTreeHashes(self)
+        return self.cached_task_tree_hashes
+
     def update_custom_data_value_to_task_map_for_task(self, task):
         for key, value in task.custom_data.items():
-            tasks = self.custom_data_value_to_task_map.setdefault(key, {}).setdefault(value, [])
-            if task not in tasks:
-                tasks.append(task)
+            entry = (key, value, id(task))
+            if entry not in self.custom_data_value_to_task_map_entries:
+                self.custom_data_value_to_task_map_entries.add(entry)
+                self.custom_data_value_to_task_map.setdefault(key, {}).setdefault(value, []).append(task)
 
     def tasks_for_custom_data_value(self, key, value):
         return self.custom_data_value_to_task_map.get(key, {}).get(value, [])
@@ -741,24 +2247,103 @@ class OmniPlanDocument(TaskCollection):
         return self.descendants()
 
     @classmethod
-    def first_open_document(cls):
-        return cls(cls.first_open_document_name())
+    def shared(cls, name, **options):
+        """Load a document through the process-wide DocumentLoader, concurrent
+        callers share a single extraction and its result.
+        """
+        return document_loader.load(name, **options)
 
     @classmethod
-    def first_open_document_name(cls):
-        document_name = cls.xth_open_document_name(1)
+    def read_chunked(cls, name, **options):
+        """Load a document with a ChunkedDocumentReader, which reads the subtrees
+        of the top-level tasks in parallel batches instead of in one script.
+        """
+        return cls(name, document_data=ChunkedDocumentReader(name, **options).read_document_data())
 
-        if not document_name:
-            raise Exception('Unable to get name of frontmost document')
+    @classmethod
+    def from_oplx_bundle(cls, path, scenario=None):
+        """Load a document from an .oplx bundle on disk instead of the OmniPlan application.
 
-        return document_name
+        scenario is the name or ID of the scenario to load, by default the
+        scenario in Actual.xml. Other scenarios of the bundle can then be loaded
+        with scenario(). Committed changes of the returned document are written
+        back into the bundle.
+        """
+        bundle = OplxBundle(path)
+        if scenario:
+            bundle = bundle.scenario_bundle(scenario)
+        return cls.from_bundle(bundle)
 
     @classmethod
-    def xth_open_document_name(cls, n):
-        script_code = """
-        tell application "OmniPlan"
-            try
-                return name of document of window {0}
+    def from_bundle(cls, bundle):
+        document = cls(os.path.basename(os.path.normpath(bundle.path)), document_data=bundle.read_document_data())
+        document.bundle = bundle
+        return document
+
+    def scenario_names(self):
+        if not self.bundle:
+            return []
+        return [scenario_info.name for scenario_info in self.bundle.scenario_infos()[0]]
+
+    def scenario(self, name):
+        """Return the document for another scenario of the bundle this document was
+        loaded from, for example a baseline. Scenarios are loaded on first use.
+        """
+        if not self.bundle:
+            raise Exception('Only documents loaded from an .oplx bundle have scenarios: {}'.format(self))
+        scenario_info = self.bundle.scenario_info(name)
+        scenario_path = os.path.join(self.bundle.path, scenario_info.filename)
+        if scenario_path == self.bundle.scenario_path:
+            return self
+        document = self.scenario_documents.get(scenario_path)
+        if document is None:
+            document = self.scenario_documents[scenario_path] = OmniPlanDocument.from_bundle(self.bundle.scenario_bundle(name))
+        return document
+
+    def variance(self, baseline):
+        """Compare this document to a baseline scenario, given as a document or a
+        scenario name, and return a ScenarioVariance.
+        """
+        if not isinstance(baseline, OmniPlanDocument):
+            baseline = self.scenario(baseline)
+        return ScenarioVariance(self, baseline)
+
+    def all_resources(self):
+        return sorted(self.resource_map.values(), key=lambda resource: resource.id)
+
+    def all_resource_assignments(self):
+        for resource in self.all_resources():
+            for assignment in resource.resource_assignments:
+                yield assignment
+
+    def all_dependencies(self):
+        for task in self.all_tasks():
+            for dependency in task.prerequisites:
+                yield dependency
+
+    def diff(self, other):
+        """Compare this document to a newer snapshot of it and return a DocumentDiff."""
+        return DocumentDiff(self, other)
+
+    @classmethod
+    def first_open_document(cls):
+        return cls(cls.first_open_document_name())
+
+    @classmethod
+    def first_open_document_name(cls):
+        document_name = cls.xth_open_document_name(1)
+
+        if not document_name:
+            raise Exception('Unable to get name of frontmost document')
+
+        return document_name
+
+    @classmethod
+    def xth_open_document_name(cls, n):
+        script_code = """
+        tell application "OmniPlan"
+            try
+                return name of document of window {0}
             on error
                 try
                     return name of document {0}
@@ -856,6 +2441,237 @@ class OmniPlanDocument(TaskCollection):
 
         return doc_query_code + cls.omniplan_applescript_utils_code()
 
+    @classmethod
+    def omniplan_document_data_json_query_applescript_code(cls):
+        doc_query_code = r"""
+        on run argv
+            set document_name to item 1 of argv
+
+            tell application "OmniPlan"
+                try
+                    set |document| to document document_name
+                on error
+                    return ""
+                end try
+
+                set task_items to {}
+                repeat with child_task in child tasks of |document|
+                    set end of task_items to my json_for_task(child_task)
+                end repeat
+                set resources_json to my json_for_resources(|document|)
+                set selection_data to my get_selection_for_document(|document|)
+            end tell
+
+            return "{\"child_tasks\":" & my json_list(task_items) & ",\"resources\":" & resources_json & ",\"selected_task_ids\":" & my json_number_list(selected_task_ids of selection_data) & ",\"selected_resource_ids\":" & my json_number_list(selected_resource_ids of selection_data) & "}"
+        end run
+        """
+
+        return doc_query_code + cls.omniplan_applescript_utils_code() + cls.omniplan_applescript_json_utils_code()
+
+    @classmethod
+    def omniplan_applescript_json_utils_code(cls):
+        return r"""
+on json_for_task(task)
+	using terms from application "OmniPlan"
+		tell |task|
+			set child_task_items to {}
+			repeat with child_task in child tasks
+				set end of child_task_items to my json_for_task(child_task)
+			end repeat
+			set prerequisite_items to {}
+			repeat with |dependency| in prerequisites
+				tell |dependency|
+					set end of prerequisite_items to "{\"dependency_type\":" & my json_string(dependency type as rich text) & ",\"dependent_task_id\":" & my json_number(id of dependent task) & ",\"prerequisite_task_id\":" & my json_number(id of prerequisite task) & ",\"lead_percentage\":" & my json_value(lead percentage) & ",\"lead_time\":" & my json_value(lead time) & "}"
+				end tell
+			end repeat
+			set custom_data_items to {}
+			repeat with entry in custom data entries
+				set end of custom_data_items to "{\"name\":" & my json_string(name of entry) & ",\"value\":" & my json_value(value of entry) & "}"
+			end repeat
+			return "{\"id\":" & my json_number(id) & ",\"name\":" & my json_string(name) & ",\"completed_effort\":" & my json_value(completed effort) & ",\"duration\":" & my json_value(duration) & ",\"effort\":" & my json_value(effort) & ",\"ending_date\":" & my json_value(ending date) & ",\"ending_constraint_date\":" & my json_value(end before date) & ",\"outline_number\":" & my json_string(outline number) & ",\"priority\":" & my json_value(priority) & ",\"remaining_effort\":" & my json_value(remaining effort) & ",\"starting_constraint_date\":" & my json_value(start after date) & ",\"starting_date\":" & my json_value(starting date) & ",\"task_status\":" & my json_string(task status as rich text) & ",\"task_type\":" & my json_string(task type as rich text) & ",\"total_cost\":" & my json_value(total cost) & ",\"child_tasks\":" & my json_list(child_task_items) & ",\"custom_data\":" & my json_list(custom_data_items) & ",\"prerequisites\":" & my json_list(prerequisite_items) & "}"
+		end tell
+	end using terms from
+end json_for_task
+
+on json_for_resources(|document|)
+	using terms from application "OmniPlan"
+		set resource_items to {}
+		repeat with |resource| in resources of |document|
+			set assignment_items to {}
+			repeat with |assignment| in assignments of |resource|
+				tell |assignment|
+					set end of assignment_items to "{\"task_id\":" & my json_number(id of task of it) & ",\"units\":" & my json_value(units) & "}"
+				end tell
+			end repeat
+			tell |resource|
+				set end of resource_items to "{\"id\":" & my json_number(id) & ",\"name\":" & my json_string(name) & ",\"task_assignments\":" & my json_list(assignment_items) & "}"
+			end tell
+		end repeat
+		return my json_list(resource_items)
+	end using terms from
+end json_for_resources
+
+on json_value(value)
+	if value is missing value then
+		return "\"\""
+	end if
+	set value_class to class of value
+	if value_class is date then
+		return my json_date(value)
+	else if value_class is integer or value_class is real then
+		return my json_number(value)
+	else if value_class is boolean then
+		return value as text
+	end if
+	return my json_string(value)
+end json_value
+
+on json_number(value)
+	if class of value is integer then
+		return value as text
+	end if
+	return my replace_text(value as text, ",", ".")
+end json_number
+
+on json_number_list(values)
+	set json_items to {}
+	repeat with value in values
+		set end of json_items to my json_number(contents of value)
+	end repeat
+	return my json_list(json_items)
+end json_number_list
+
+on json_string(value)
+	set value to value as text
+	set value to my replace_text(value, "\\", "\\\\")
+	set value to my replace_text(value, "\"", "\\\"")
+	-- JSON strings cannot contain any of the control characters U+0000 to U+001F
+	repeat with code_point from 0 to 31
+		set control_character to character id code_point
+		if value contains control_character then
+			set value to my replace_text(value, control_character, "\\u00" & my hex_byte(code_point))
+		end if
+	end repeat
+	return "\"" & value & "\""
+end json_string
+
+on hex_byte(value)
+	set hex_digits to "0123456789abcdef"
+	return (character (value div 16 + 1) of hex_digits) & (character (value mod 16 + 1) of hex_digits)
+end hex_byte
+
+on json_date(value)
+	return "\"" & (year of value as text) & "-" & my zero_padded(month of value as integer) & "-" & my zero_padded(day of value) & "T" & my zero_padded(hours of value) & ":" & my zero_padded(minutes of value) & ":" & my zero_padded(seconds of value) & "\""
+end json_date
+
+on zero_padded(value)
+	return text -2 thru -1 of ("0" & value)
+end zero_padded
+
+on json_list(json_items)
+	set saved_delimiters to AppleScript's text item delimiters
+	set AppleScript's text item delimiters to ","
+	set json_text to "[" & (json_items as text) & "]"
+	set AppleScript's text item delimiters to saved_delimiters
+	return json_text
+end json_list
+
+on replace_text(value, search_text, replacement_text)
+	set saved_delimiters to AppleScript's text item delimiters
+	set AppleScript's text item delimiters to search_text
+	set text_items to text items of value
+	set AppleScript's text item delimiters to replacement_text
+	set value to text_items as text
+	set AppleScript's text item delimiters to saved_delimiters
+	return value
+end replace_text
+
+        """
+
+    @classmethod
+    def omniplan_top_level_task_ids_query_applescript_code(cls):
+        return """
+        on run argv
+            set document_name to item 1 of argv
+
+            tell application "OmniPlan"
+                try
+                    set |document| to document document_name
+                on error
+                    return ""
+                end try
+
+                set task_ids to id of child tasks of |document|
+            end tell
+
+            tell application "System Events"
+                set root_plist_item to make new property list item with properties {kind:record, value:{task_ids:task_ids}}
+            end tell
+
+            return text of root_plist_item
+        end run
+        """
+
+    @classmethod
+    def omniplan_task_subtrees_query_applescript_code(cls):
+        subtrees_query_code = """
+        on run argv
+            set document_name to item 1 of argv
+
+            tell application "OmniPlan"
+                try
+                    set |document| to document document_name
+                on error
+                    return ""
+                end try
+            end tell
+
+            set task_list to {}
+            repeat with task_id in rest of argv
+                tell application "OmniPlan"
+                    set |task| to task ((task_id as text) as number) of |document|
+                end tell
+                set end of task_list to my record_for_task(|task|)
+            end repeat
+
+            tell application "System Events"
+                set root_plist_item to make new property list item with properties {kind:record, value:{child_tasks:task_list}}
+            end tell
+
+            return text of root_plist_item
+        end run
+
+        """
+        return subtrees_query_code + cls.omniplan_applescript_utils_code()
+
+    @classmethod
+    def omniplan_document_metadata_query_applescript_code(cls):
+        metadata_query_code = """
+        on run argv
+            set document_name to item 1 of argv
+
+            tell application "OmniPlan"
+                try
+                    set |document| to document document_name
+                on error
+                    return ""
+                end try
+
+                set resource_list to my resource_list_for_document(|document|)
+                set selection_data to my get_selection_for_document(|document|)
+                set document_data to {|resources|:resource_list} & selection_data
+            end tell
+
+            tell application "System Events"
+                set root_plist_item to make new property list item with properties {kind:record, value:document_data}
+            end tell
+
+            return text of root_plist_item
+        end run
+
+        """
+        return metadata_query_code + cls.omniplan_applescript_utils_code()
+
     @classmethod
     def omniplan_applescript_utils_code(cls):
         return """
@@ -994,5 +2810,2245 @@ end replace_missing_value
         """
 
 
+class TaskTreeHashes(object):
+    """Per-task content hashes and Merkle hashes of the subtree below each task.
+
+    A task's content hash covers its own properties, its relation hash its
+    resource assignments and prerequisites. Its subtree hash covers both and
+    the subtree hashes of its child tasks in order, so two tasks with equal
+    subtree hashes have identical subtrees. The outline number is left out
+    because it changes for every following task when a task is inserted.
+    Resource names are left out too, DocumentDiff compares resources itself.
+
+    The hashes are built from Python's own hash() of the property values, they
+    are only meant to be compared within one process.
+    """
+
+    hashed_properties = operator.attrgetter('id', 'name', 'task_type', 'task_status', 'remaining_effort', 'duration', 'total_cost', 'priority', 'starting_date', 'ending_date', 'starting_constraint_date', 'ending_constraint_date')
+
+    def __init__(self, document):
+        self.content_hashes = {}
+        self.relation_hashes = {}
+        self.subtree_hashes = {}
+        self.hash_document(document)
+
+    def content_hash(self, task):
+        return hash((self.hashed_properties(task), task.effort.seconds(), task.completed_effort.seconds(), frozenset(task.custom_data.items())))
+
+    @staticmethod
+    def relation_hash(task):
+        return hash((
+            tuple([(assignment.resource.id, assignment.units) for assignment in task.resource_assignments]),
+            tuple([(dependency.prerequisite_task.id, dependency.dependency_type) for dependency in task.prerequisites]),
+        ))
+
+    def hash_document(self, document):
+        # hash in reverse pre-order so child subtrees are always hashed before their parent
+        pre_order_tasks = []
+        stack = list(reversed(document.tasks))
+        while stack:
+            task = stack.pop()
+            pre_order_tasks.append(task)
+            stack.extend(reversed(task.tasks))
+
+        content_hashes = self.content_hashes
+        relation_hashes = self.relation_hashes
+        subtree_hashes = self.subtree_hashes
+        for task in reversed(pre_order_tasks):
+            content_hash = self.content_hash(task)
+            relation_hash = self.relation_hash(task)
+            content_hashes[task.id] = content_hash
+            relation_hashes[task.id] = relation_hash
+            if task.tasks:
+                subtree_hashes[task.id] = hash((content_hash, relation_hash, tuple([subtree_hashes[child_task.id] for child_task in task.tasks])))
+            else:
+                subtree_hashes[task.id] = hash((content_hash, relation_hash))
+
+
+TaskModification = collections.namedtuple('TaskModification', 'old_task new_task changed_properties')
+RecordModification = collections.namedtuple('RecordModification', 'key old_record new_record')
+
+
+class DocumentDiff(object):
+    """The differences between an older and a newer snapshot of a document.
+
+    Tasks are matched by ID. Subtrees whose Merkle hashes are equal in both
+    snapshots are skipped without looking at any of their tasks. Moved tasks
+    are tasks whose parent changed; changed_properties maps each changed
+    property name to an (old value, new value) pair. Resources are matched by
+    ID, assignments by (task ID, resource ID) and dependencies by
+    (prerequisite task ID, dependent task ID). Only the assignments and
+    prerequisites of added and removed tasks, of tasks whose relation hash
+    changed and of tasks assigned to a changed resource are compared, as
+    plain tuples, records are only exported for the differences.
+    """
+
+    def __init__(self, old_document, new_document):
+        self.old_document = old_document
+        self.new_document = new_document
+
+        self.added_tasks = []
+        self.removed_tasks = []
+        self.moved_tasks = []
+        self.modified_tasks = []
+
+        # IDs of the tasks whose assignments and prerequisites are compared
+        self.relation_task_ids = set()
+
+        self.diff_tasks()
+        self.added_resources, self.removed_resources, self.modified_resources = self.diff_items(
+            self.resources_by_key(old_document), self.resources_by_key(new_document), self.resource_values)
+        for modification in self.modified_resources:
+            resource_id, = modification.key
+            for document in (old_document, new_document):
+                self.relation_task_ids.update(assignment.task.id for assignment in document.resource_for_id(resource_id).resource_assignments)
+        self.diff_relations()
+
+    def diff_tasks(self):
+        old_task_map = self.old_document.task_map
+        old_hashes = self.old_document.task_tree_hashes()
+        new_hashes = self.new_document.task_tree_hashes()
+
+        stack = list(reversed(self.new_document.tasks))
+        while stack:
+            new_task = stack.pop()
+            old_task = old_task_map.get(new_task.id)
+            if old_task is None:
+                self.added_tasks.append(new_task)
+                self.relation_task_ids.add(new_task.id)
+                stack.extend(reversed(new_task.tasks))
+                continue
+
+            same_parent = self.parent_id(old_task) == self.parent_id(new_task)
+            if same_parent and old_hashes.subtree_hashes[old_task.id] == new_hashes.subtree_hashes[new_task.id]:
+                continue
+
+            if not same_parent:
+                self.moved_tasks.append((old_task, new_task))
+            if old_hashes.content_hashes[old_task.id] != new_hashes.content_hashes[new_task.id]:
+                self.modified_tasks.append(TaskModification(old_task, new_task, self.changed_properties(old_task.export_record(), new_task.export_record())))
+            if old_hashes.relation_hashes[old_task.id] != new_hashes.relation_hashes[new_task.id]:
+                self.relation_task_ids.add(new_task.id)
+            stack.extend(reversed(new_task.tasks))
+
+        new_task_map = self.new_document.task_map
+        removed_ids = set(old_task_map) - set(new_task_map)
+        self.removed_tasks = [old_task_map[id] for id in sorted(removed_ids)]
+        self.relation_task_ids.update(removed_ids)
+
+    def diff_relations(self):
+        old_assignments, new_assignments = {}, {}
+        old_dependencies, new_dependencies = {}, {}
+        for task_map, assignments, dependencies in ((self.old_document.task_map, old_assignments, old_dependencies), (self.new_document.task_map, new_assignments, new_dependencies)):
+            for task_id in self.relation_task_ids:
+                task = task_map.get(task_id)
+                if task is None:
+                    continue
+                for assignment in task.resource_assignments:
+                    assignments[(task_id, assignment.resource.id)] = assignment
+                for dependency in task.prerequisites:
+                    dependencies[(dependency.prerequisite_task.id, task_id)] = dependency
+
+        self.added_assignments, self.removed_assignments, self.modified_assignments = self.diff_items(old_assignments, new_assignments, self.assignment_values)
+        self.added_dependencies, self.removed_dependencies, self.modified_dependencies = self.diff_items(old_dependencies, new_dependencies, self.dependency_values)
+
+    @staticmethod
+    def parent_id(task):
+        parent_task = task.parent_task()
+        return parent_task.id if parent_task else None
+
+    @staticmethod
+    def changed_properties(old_record, new_record):
+        changed_properties = {}
+        for key, new_value in new_record.items():
+            if key in ('parent_id', 'outline_number'):
+                continue
+            old_value = old_record.get(key)
+            if old_value != new_value:
+                changed_properties[key] = (old_value, new_value)
+        return changed_properties
+
+    @staticmethod
+    def resources_by_key(document):
+        return dict(((resource_id,), resource) for resource_id, resource in document.resource_map.items())
+
+    # the values of the export records that are not part of the key
+
+    @staticmethod
+    def resource_values(resource):
+        return resource.name
+
+    @staticmethod
+    def assignment_values(assignment):
+        return assignment.resource.name, assignment.units
+
+    @staticmethod
+    def dependency_values(dependency):
+        return dependency.dependency_type
+
+    @staticmethod
+    def diff_items(old_items, new_items, item_values):
+        added = [new_items[key].export_record() for key in sorted(set(new_items) - set(old_items))]
+        removed = [old_items[key].export_record() for key in sorted(set(old_items) - set(new_items))]
+        modified = []
+        for key in sorted(set(old_items) & set(new_items)):
+            old_item, new_item = old_items[key], new_items[key]
+            if item_values(old_item) != item_values(new_item):
+                modified.append(RecordModification(key, old_item.export_record(), new_item.export_record()))
+        return added, removed, modified
+
+    def is_empty(self):
+        return not any((
+            self.added_tasks, self.removed_tasks, self.moved_tasks, self.modified_tasks,
+            self.added_resources, self.removed_resources, self.modified_resources,
+            self.added_assignments, self.removed_assignments, self.modified_assignments,
+            self.added_dependencies, self.removed_dependencies, self.modified_dependencies,
+        ))
+
+    def changed_task_ids(self):
+        task_ids = set(task.id for task in self.added_tasks + self.removed_tasks)
+        task_ids.update(new_task.id for old_task, new_task in self.moved_tasks)
+        task_ids.update(modification.new_task.id for modification in self.modified_tasks)
+        for record in self.added_assignments + self.removed_assignments:
+            task_ids.add(record['task_id'])
+        for modification in self.modified_assignments:
+            task_ids.add(modification.key[0])
+        for record in self.added_dependencies + self.removed_dependencies:
+            task_ids.update((record['prerequisite_task_id'], record['dependent_task_id']))
+        for modification in self.modified_dependencies:
+            task_ids.update(modification.key)
+        return task_ids
+
+    def __repr__(self):
+        return u'<DocumentDiff tasks +{} -{} ~{} moved {}>'.format(len(self.added_tasks), len(self.removed_tasks), len(self.modified_tasks), len(self.moved_tasks))
+
+
+class ScenarioVariance(object):
+    """Start, finish, effort and cost variance of the tasks of a document against a baseline.
+
+    The tasks present in both documents are aligned by ID into parallel arrays,
+    one per property and document. Each variance array is then computed in a
+    single element-wise pass over two of these arrays. Start and finish
+    variance are in calendar days, effort variance in work days and cost
+    variance in the document's currency. Positive values mean later, more work
+    or more expensive than the baseline. Tasks without a date have NaN date
+    variances.
+    """
+
+    def __init__(self, document, baseline_document):
+        self.document = document
+        self.baseline_document = baseline_document
+
+        task_ids = sorted(set(document.task_map) & set(baseline_document.task_map))
+        self.task_ids = array.array('l', task_ids)
+        self.added_task_ids = sorted(set(document.task_map) - set(baseline_document.task_map))
+        self.removed_task_ids = sorted(set(baseline_document.task_map) - set(document.task_map))
+
+        columns = self.columns(document, task_ids)
+        baseline_columns = self.columns(baseline_document, task_ids)
+        self.start_variance, self.finish_variance, self.effort_variance, self.cost_variance = [
+            self.difference(column, baseline_column, scale)
+            for column, baseline_column, scale in zip(columns, baseline_columns, (TimeInterval.SECONDS_PER_DAY, TimeInterval.SECONDS_PER_DAY, WorkDayTimeInterval.SECONDS_PER_WORKDAY, 1))
+        ]
+        self.index_for_task_id = dict((task_id, index) for index, task_id in enumerate(task_ids))
+
+    @classmethod
+    def columns(cls, document, task_ids):
+        tasks = [document.task_map[task_id] for task_id in task_ids]
+        return (
+            array.array('d', (cls.timestamp(task.starting_date) for task in tasks)),
+            array.array('d', (cls.timestamp(cls.finish_date(task)) for task in tasks)),
+            array.array('d', (task.effort.seconds() for task in tasks)),
+            array.array('d', (task.total_cost or 0 for task in tasks)),
+        )
+
+    @staticmethod
+    def finish_date(task):
+        if task.ending_date or not task.starting_date:
+            return task.ending_date
+        return WorkCalendar.add_workdays(task.starting_date, float(task.duration or task.effort.seconds()) / WorkDayTimeInterval.SECONDS_PER_WORKDAY)
+
+    @staticmethod
+    def timestamp(date):
+        if not date:
+            return float('nan')
+        return float(calendar.timegm(date.utctimetuple()))
+
+    @staticmethod
+    def difference(column, baseline_column, scale):
+        return array.array('d', itertools.imap(operator.div, itertools.imap(operator.sub, column, baseline_column), itertools.repeat(float(scale), len(column))))
+
+    def task_variance(self, task_id):
+        index = self.index_for_task_id[task_id]
+        return {
+            'start': self.start_variance[index],
+            'finish': self.finish_variance[index],
+            'effort': self.effort_variance[index],
+            'cost': self.cost_variance[index],
+        }
+
+    def slipped_task_ids(self, days=0):
+        """Return the IDs of the tasks finishing more than days later than in the baseline."""
+        return [task_id for task_id, variance in itertools.izip(self.task_ids, self.finish_variance) if variance > days]
+
+
+class TaskSearchIndex(object):
+    """A trigram index for substring and fuzzy search over task names, outline
+    numbers and selected custom data fields.
+
+    Texts are lower-cased with runs of whitespace collapsed, and every field
+    is split into the trigrams of its padded text. A query is ranked against
+    the candidate tasks that share at least one trigram with it by the best
+    Jaccard similarity of its trigram set and that of one of their fields,
+    and tasks that contain the query as a substring of a field rank first.
+    The index observes the document and re-indexes a task when its name or
+    an indexed custom data field changes, removed tasks are dropped from the
+    index.
+    """
+
+    def __init__(self, document, custom_data_keys=()):
+        self.document = document
+        self.custom_data_keys = tuple(custom_data_keys)
+        self.custom_data_property_names = set(Task.CUSTOM_DATA_PROPERTY_PREFIX + key for key in self.custom_data_keys)
+        self.postings = collections.defaultdict(set)
+        self.task_field_trigrams = {}
+        self.task_texts = {}
+        for task in document.all_tasks():
+            self.add_task(task)
+        document.add_task_observer(self.task_property_changed)
+
+    @staticmethod
+    def normalized_text(text):
+        return u' '.join(unicode(text).lower().split())
+
+    @staticmethod
+    def trigrams(text):
+        padded_text = u'  {} '.format(text)
+        return set(padded_text[i:i + 3] for i in xrange(len(padded_text) - 2))
+
+    def task_field_texts(self, task):
+        texts = [task.name, task.outline_number]
+        texts.extend(task.custom_data.get(key) for key in self.custom_data_keys)
+        return [self.normalized_text(text) for text in texts if text]
+
+    def add_task(self, task):
+        self.remove_task(task.id)
+        texts = self.task_field_texts(task)
+        field_trigrams = [self.trigrams(text) for text in texts]
+        for trigram in set().union(*field_trigrams):
+            self.postings[trigram].add(task.id)
+        self.task_field_trigrams[task.id] = field_trigrams
+        self.task_texts[task.id] = texts
+
+    def remove_task(self, task_id):
+        for trigram in set().union(*self.task_field_trigrams.pop(task_id, [])):
+            task_ids = self.postings[trigram]
+            task_ids.discard(task_id)
+            if not task_ids:
+                del self.postings[trigram]
+        self.task_texts.pop(task_id, None)
+
+    def task_property_changed(self, task, property_name, old_value, new_value):
+        if property_name == Task.TASK_REMOVED:
+            self.remove_task(task.id)
+        elif property_name is None or property_name == 'name' or property_name in self.custom_data_property_names:
+            self.add_task(task)
+
+    @staticmethod
+    def similarity(trigrams, other_trigrams):
+        shared_count = len(trigrams & other_trigrams)
+        return float(shared_count) / (len(trigrams) + len(other_trigrams) - shared_count)
+
+    def search(self, query, limit=10, min_score=0.2):
+        """Return up to limit (score, task) pairs for the best matches of query, best first."""
+        query = self.normalized_text(query)
+        if not query or limit <= 0:
+            return []
+        query_trigrams = self.trigrams(query)
+        # a field can only contain the query if it has all of its unpadded trigrams
+        inner_trigram_count = len(set(query[i:i + 3] for i in xrange(len(query) - 2)))
+        shared_counts = collections.Counter()
+        for trigram in query_trigrams:
+            shared_counts.update(self.postings.get(trigram, ()))
+
+        # Candidates are scored in order of shared trigrams, which bounds their
+        # score, until no remaining candidate can make it into the results
+        best_results = []
+        for task_id, shared_count in shared_counts.most_common():
+            score_bound = float(shared_count) / len(query_trigrams) + (1.0 if shared_count >= inner_trigram_count else 0.0)
+            if score_bound < min_score or (len(best_results) == limit and score_bound < best_results[0][0]):
+                break
+            task = self.document.task_map.get(task_id)
+            if task is None:
+                continue
+            score = max(self.similarity(query_trigrams, field_trigrams) for field_trigrams in self.task_field_trigrams[task_id])
+            if any(query in text for text in self.task_texts[task_id]):
+                score += 1.0
+            if score < min_score:
+                continue
+            if len(best_results) < limit:
+                heapq.heappush(best_results, (score, -task_id, task))
+            else:
+                heapq.heappushpop(best_results, (score, -task_id, task))
+        return [(score, task) for score, negative_task_id, task in sorted(best_results, reverse=True)]
+
+
+class RollupEngine(object):
+    """Effort, cost and progress totals for every group task and the whole document.
+
+    All totals are computed in one bottom-up pass over the task tree. Only
+    tasks without child tasks contribute values, and remaining effort is
+    derived as effort minus completed effort. The engine observes the document,
+    and when a task property changes only the totals of that task's ancestors
+    are updated. A newly added subtree is rolled up once and then added to
+    the totals of its ancestors.
+
+    custom_aggregates maps additional total names to functions that return a
+    task's number, for example custom_data_sum('Budget').
+    """
+
+    standard_aggregate_names = ['effort', 'completed_effort', 'remaining_effort', 'total_cost']
+
+    def __init__(self, document, custom_aggregates=None):
+        self.document = document
+        self.custom_aggregates = sorted((custom_aggregates or {}).items())
+        self.aggregate_names = self.standard_aggregate_names + [name for name, function in self.custom_aggregates]
+        self.compute()
+        document.add_task_observer(self.task_property_changed)
+
+    @staticmethod
+    def custom_data_sum(key):
+        def custom_data_value(task):
+            try:
+                return float(task.custom_data_value(key) or 0)
+            except ValueError:
+                return 0
+        return custom_data_value
+
+    def contribution(self, task):
+        if task.tasks:
+            return [0] * len(self.aggregate_names)
+        effort = task.effort.seconds()
+        completed_effort = task.completed_effort.seconds()
+        values = [effort, completed_effort, effort - completed_effort, task.total_cost or 0]
+        values.extend(function(task) for name, function in self.custom_aggregates)
+        return values
+
+    def compute(self):
+        self.contributions = {}
+        self.totals = {}
+        self.compute_subtree_totals(self.document.tasks)
+
+        document_totals = [0] * len(self.aggregate_names)
+        for task in self.document.tasks:
+            document_totals = map(operator.add, document_totals, self.totals[task.id])
+        self.document_totals = document_totals
+
+    def compute_subtree_totals(self, top_tasks):
+        pre_order_tasks = []
+        stack = list(reversed(top_tasks))
+        while stack:
+            task = stack.pop()
+            pre_order_tasks.append(task)
+            stack.extend(reversed(task.tasks))
+
+        for task in reversed(pre_order_tasks):
+            contribution = self.contribution(task)
+            self.contributions[task.id] = contribution
+            totals = list(contribution)
+            for child_task in task.tasks:
+                totals = map(operator.add, totals, self.totals[child_task.id])
+            self.totals[task.id] = totals
+
+    def task_property_changed(self, task, property_name, old_value, new_value):
+        if property_name == Task.TASK_REMOVED:
+            self.remove_task(task)
+            return
+        if property_name is not None:
+            self.update_contribution(task)
+            return
+
+        # Child tasks are added while their parent task is still being constructed,
+        # the whole new subtree is rolled up once when its top task is attached.
+        parent_task = task.parent_task()
+        if parent_task and getattr(parent_task, 'id', None) not in self.totals:
+            return
+        self.compute_subtree_totals([task])
+        self.add_to_totals(parent_task, self.totals[task.id])
+        # a newly added child task turns its parent into a group that no longer contributes itself
+        if parent_task:
+            self.update_contribution(parent_task)
+
+    def update_contribution(self, task):
+        zero = [0] * len(self.aggregate_names)
+        contribution = self.contribution(task)
+        delta = map(operator.sub, contribution, self.contributions.get(task.id, zero))
+        self.contributions[task.id] = contribution
+        if any(delta):
+            self.add_to_totals(task, delta)
+
+    def remove_task(self, task):
+        # removed child tasks are reported before their parent task
+        contribution = self.contributions.pop(task.id, None)
+        if contribution and any(contribution):
+            self.add_to_totals(task, [-value for value in contribution])
+        self.totals.pop(task.id, None)
+
+    def add_to_totals(self, task, delta):
+        """Add delta to the totals of task, its ancestors and the whole document."""
+        zero = [0] * len(self.aggregate_names)
+        while task:
+            self.totals[task.id] = map(operator.add, self.totals.get(task.id, zero), delta)
+            task = task.parent_task()
+        self.document_totals = map(operator.add, self.document_totals, delta)
+
+    def rollup(self, task=None):
+        """Return the totals for a task, or for the whole document if no task is given,
+        as a dictionary that also includes the percentage of completed effort.
+        """
+        values = self.totals[task.id] if task else self.document_totals
+        rollup = dict(zip(self.aggregate_names, values))
+        rollup['percent_done'] = 100.0 * rollup['completed_effort'] / rollup['effort'] if rollup['effort'] else 0.0
+        return rollup
+
+    def close(self):
+        self.document.remove_task_observer(self.task_property_changed)
+
+
+class WorkCalendar(object):
+    """Converts between dates and work days, with five 8 hour work days per week."""
+
+    WORKDAYS_PER_WEEK = 5
+
+    @classmethod
+    def add_workdays(cls, date, workdays):
+        whole_workdays = int(workdays)
+        date += datetime.timedelta(seconds=(workdays - whole_workdays) * WorkDayTimeInterval.SECONDS_PER_WORKDAY)
+        weeks, whole_workdays = divmod(whole_workdays, cls.WORKDAYS_PER_WEEK)
+        date += datetime.timedelta(weeks=weeks)
+        while whole_workdays or date.weekday() >= cls.WORKDAYS_PER_WEEK:
+            if date.weekday() < cls.WORKDAYS_PER_WEEK:
+                whole_workdays -= 1
+            date += datetime.timedelta(days=1)
+        return date
+
+    @classmethod
+    def workdays_between(cls, start_date, end_date):
+        """Return the number of whole work days from start_date to end_date."""
+        start_date = cls.to_date(start_date)
+        end_date = cls.to_date(end_date)
+        weeks, days = divmod((end_date - start_date).days, 7)
+        workdays = weeks * cls.WORKDAYS_PER_WEEK
+        for offset in range(days):
+            if (start_date + datetime.timedelta(days=offset)).weekday() < cls.WORKDAYS_PER_WEEK:
+                workdays += 1
+        return workdays
+
+    @staticmethod
+    def to_date(value):
+        if isinstance(value, datetime.datetime):
+            return value.date()
+        return value
+
+
+class ScheduleNetwork(object):
+    """The tasks without child tasks of a document in topological dependency order.
+
+    Dependencies of group tasks are expanded: a task inherits the prerequisites
+    of its ancestor groups, and a group prerequisite stands for all tasks
+    below it. Predecessors, durations and dependency types are kept in flat
+    lists indexed by position in the topological order, which is all a
+    scheduling pass needs and cheap to send to worker processes.
+    """
+
+    dependency_type_codes = set(['FS', 'SS', 'FF', 'SF'])
+
+    def __init__(self, document):
+        self.document = document
+        leaf_tasks = [task for task in document.all_tasks() if not task.tasks]
+        leaf_task_ids = dict((task.id, self.leaf_descendant_ids(task)) for task in document.all_tasks() if task.tasks)
+
+        prerequisites = {}
+        for task in leaf_tasks:
+            task_prerequisites = []
+            ancestor = task
+            while ancestor:
+                for dependency in ancestor.prerequisites:
+                    dependency_type = self.normalized_dependency_type(dependency.dependency_type)
+                    prerequisite_task = dependency.prerequisite_task
+                    for prerequisite_task_id in leaf_task_ids.get(prerequisite_task.id, [prerequisite_task.id]):
+                        task_prerequisites.append((prerequisite_task_id, dependency_type))
+                ancestor = ancestor.parent_task()
+            prerequisites[task.id] = task_prerequisites
+
+        self.tasks = self.topologically_sorted(leaf_tasks, prerequisites)
+        self.index_for_task_id = dict((task.id, index) for index, task in enumerate(self.tasks))
+        self.predecessors = [[(self.index_for_task_id[task_id], dependency_type) for task_id, dependency_type in prerequisites[task.id]] for task in self.tasks]
+        self.durations = [0 if task.task_type == Task.TASK_TYPE_MILESTOME else float(task.effort.seconds()) / WorkDayTimeInterval.SECONDS_PER_WORKDAY for task in self.tasks]
+
+        starting_dates = [task.starting_date for task in self.tasks if task.starting_date]
+        self.start_date = min(starting_dates) if starting_dates else datetime.datetime.utcnow().replace(tzinfo=UTCDateValueConverter.utc)
+
+    @staticmethod
+    def leaf_descendant_ids(task):
+        return [descendant.id for descendant in task.descendants() if not descendant.tasks]
+
+    @classmethod
+    def normalized_dependency_type(cls, dependency_type):
+        # bundles use "FS"-style codes, AppleScript returns e.g. "finish to start"
+        value = (dependency_type or '').strip()
+        if value.upper() in cls.dependency_type_codes:
+            return value.upper()
+        words = value.lower().split()
+        if len(words) >= 2:
+            code = (words[0][0] + words[-1][0]).upper()
+            if code in cls.dependency_type_codes:
+                return code
+        return 'FS'
+
+    @staticmethod
+    def topologically_sorted(tasks, prerequisites):
+        dependents = collections.defaultdict(list)
+        pending_counts = {}
+        for task in tasks:
+            pending_counts[task.id] = len(prerequisites[task.id])
+            for prerequisite_task_id, dependency_type in prerequisites[task.id]:
+                dependents[prerequisite_task_id].append(task.id)
+
+        task_map = dict((task.id, task) for task in tasks)
+        ready = collections.deque(task.id for task in tasks if not pending_counts[task.id])
+        sorted_tasks = []
+        while ready:
+            task_id = ready.popleft()
+            sorted_tasks.append(task_map[task_id])
+            for dependent_task_id in dependents[task_id]:
+                pending_counts[dependent_task_id] -= 1
+                if not pending_counts[dependent_task_id]:
+                    ready.append(dependent_task_id)
+
+        if len(sorted_tasks) != len(tasks):
+            raise Exception('Task dependencies contain a cycle')
+        return sorted_tasks
+
+    @staticmethod
+    def schedule_batch(duration_columns, predecessors, trial_count):
+        """Forward pass over a batch of trials at once: duration_columns holds an
+        array of sampled durations per task, and the start and finish work day
+        offsets are returned the same way, as one array per task.
+        """
+        zeros = array.array('d', itertools.repeat(0.0, trial_count))
+        starts = []
+        finishes = []
+        for index, durations in enumerate(duration_columns):
+            candidates = []
+            # FS and SS candidates are never negative, FF and SF ones can be and are bounded by the project start
+            bounded = True
+            for predecessor_index, dependency_type in predecessors[index]:
+                if dependency_type == 'FS':
+                    candidates.append(finishes[predecessor_index])
+                elif dependency_type == 'SS':
+                    candidates.append(starts[predecessor_index])
+                elif dependency_type == 'FF':
+                    candidates.append(array.array('d', itertools.imap(operator.sub, finishes[predecessor_index], durations)))
+                    bounded = False
+                else:
+                    candidates.append(array.array('d', itertools.imap(operator.sub, starts[predecessor_index], durations)))
+                    bounded = False
+            if not bounded:
+                candidates.append(zeros)
+
+            if not candidates:
+                start = zeros
+            elif len(candidates) == 1:
+                start = candidates[0]
+            else:
+                start = array.array('d', itertools.imap(max, *candidates))
+            starts.append(start)
+            finishes.append(array.array('d', itertools.imap(operator.add, start, durations)))
+        return starts, finishes
+
+    @staticmethod
+    def driver_index(duration_columns, predecessors, starts, finishes, index, trial):
+        """Return the index of the predecessor that determined the start of a task in one trial, or None."""
+        duration = duration_columns[index][trial]
+        start = 0.0
+        driver = None
+        for predecessor_index, dependency_type in predecessors[index]:
+            if dependency_type == 'FS':
+                candidate = finishes[predecessor_index][trial]
+            elif dependency_type == 'SS':
+                candidate = starts[predecessor_index][trial]
+            elif dependency_type == 'FF':
+                candidate = finishes[predecessor_index][trial] - duration
+            else:
+                candidate = starts[predecessor_index][trial] - duration
+            if candidate > start:
+                start = candidate
+                driver = predecessor_index
+        return driver
+
+
+def triangular_samples(generator, low, mode, high, count):
+    """Return an array of count samples from a triangular distribution.
+
+    (1 - c) * min(U, V) + c * max(U, V) of two uniform variables is triangular
+    on [0, 1] with mode c, and max(U, V) has the distribution of sqrt(W) with
+    min(U, V) uniform below it. That gives
+    low + sqrt(W1) * ((mode - low) + (high - mode) * W2), which only needs
+    arithmetic that can be mapped over whole arrays.
+    """
+    if high <= low:
+        return array.array('d', itertools.repeat(mode, count))
+    imap, repeat = itertools.imap, itertools.repeat
+    uniform = array.array('d', itertools.starmap(generator.random, repeat((), 2 * count)))
+    scales = imap((mode - low).__add__, imap((high - mode).__mul__, itertools.islice(uniform, count, None)))
+    return array.array('d', imap(low.__add__, imap(operator.mul, imap(math.sqrt, itertools.islice(uniform, count)), scales)))
+
+
+def simulate_schedule_batch(arguments):
+    # module level so that it can be sent to multiprocessing worker processes
+    duration_ranges, predecessors, trial_count, seed = arguments
+    generator = random.Random(seed)
+    duration_columns = [triangular_samples(generator, float(low), float(mode), float(high), trial_count) for low, mode, high in duration_ranges]
+    starts, finishes = ScheduleNetwork.schedule_batch(duration_columns, predecessors, trial_count)
+    critical_counts = [0] * len(duration_ranges)
+    if not finishes:
+        return [0.0] * trial_count, critical_counts
+
+    finish_offsets = []
+    for trial, trial_finishes in enumerate(itertools.izip(*finishes)):
+        finish_offset = max(trial_finishes)
+        finish_offsets.append(finish_offset)
+        # the first task that reaches the project finish ends the critical path of the trial
+        index = trial_finishes.index(finish_offset)
+        while index is not None:
+            critical_counts[index] += 1
+            index = ScheduleNetwork.driver_index(duration_columns, predecessors, starts, finishes, index, trial)
+    return finish_offsets, critical_counts
+
+
+class ScheduleSimulation(object):
+    """Monte Carlo simulation of the project finish date under effort uncertainty.
+
+    Each task's duration in work days is drawn from a triangular distribution.
+    The low and high values come from the custom data fields named by
+    low_custom_data_key/high_custom_data_key when a task has them, and are
+    otherwise the task's effort scaled by low_factor/high_factor. Trials are
+    split into batches that run in a pool of worker processes. Within a batch
+    the durations of each task are sampled for all trials at once, and the
+    schedule is propagated task by task over these columns of trials, so the
+    interpreter loops over tasks rather than over tasks times trials.
+
+    Tested at 1000 tasks times 10000 trials, about 10s in a single process,
+    with benchmarks/schedule_simulation.py.
+    """
+
+    def __init__(self, document, low_factor=0.8, high_factor=1.5, low_custom_data_key=None, high_custom_data_key=None):
+        self.network = ScheduleNetwork(document)
+        self.duration_ranges = []
+        for task, duration in zip(self.network.tasks, self.network.durations):
+            low = self.custom_data_workdays(task, low_custom_data_key)
+            high = self.custom_data_workdays(task, high_custom_data_key)
+            low = duration * low_factor if low is None else low
+            high = duration * high_factor if high is None else high
+            self.duration_ranges.append((min(low, duration), duration, max(high, duration)))
+
+    @staticmethod
+    def custom_data_workdays(task, key):
+        if not key:
+            return None
+        try:
+            return float(task.custom_data_value(key))
+        except (TypeError, ValueError):
+            return None
+
+    def run(self, trials=10000, processes=None, seed=None, batch_size=500):
+        seed = random.randrange(2**32) if seed is None else seed
+        batches = []
+        for batch_index, batch_start in enumerate(range(0, trials, batch_size)):
+            batches.append((self.duration_ranges, self.network.predecessors, min(batch_size, trials - batch_start), seed + batch_index))
+
+        if processes == 1:
+            batch_results = map(simulate_schedule_batch, batches)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                batch_results = pool.map(simulate_schedule_batch, batches)
+            finally:
+                pool.close()
+                pool.join()
+
+        finish_offsets = []
+        critical_counts = [0] * len(self.network.tasks)
+        for batch_finish_offsets, batch_critical_counts in batch_results:
+            finish_offsets.extend(batch_finish_offsets)
+            critical_counts = map(operator.add, critical_counts, batch_critical_counts)
+        return ScheduleSimulationResult(self.network, finish_offsets, critical_counts)
+
+
+class ScheduleSimulationResult(object):
+
+    def __init__(self, network, finish_offsets, critical_counts):
+        self.network = network
+        self.finish_offsets = sorted(finish_offsets)
+        self.trials = len(finish_offsets)
+        self.criticality = dict((task.id, float(count) / self.trials) for task, count in zip(network.tasks, critical_counts))
+
+    def finish_offset_percentile(self, percentile):
+        """Return the finish offset in work days from the project start that percentile percent of the trials meet."""
+        index = min(len(self.finish_offsets) - 1, max(0, int(math.ceil(percentile / 100.0 * len(self.finish_offsets))) - 1))
+        return self.finish_offsets[index]
+
+    def finish_date_percentile(self, percentile):
+        return WorkCalendar.add_workdays(self.network.start_date, self.finish_offset_percentile(percentile))
+
+    def finish_date_percentiles(self, percentiles=(50, 80, 95)):
+        return collections.OrderedDict((percentile, self.finish_date_percentile(percentile)) for percentile in percentiles)
+
+    def __repr__(self):
+        return u'<ScheduleSimulationResult {} trials, P50 {:.1f} P80 {:.1f} P95 {:.1f} work days>'.format(self.trials, self.finish_offset_percentile(50), self.finish_offset_percentile(80), self.finish_offset_percentile(95))
+
+
+class ResourceLoad(object):
+    """Allocated assignment units per resource and time bucket between two dates.
+
+    Every assignment adds its units to a per-resource difference array at the
+    task's first day and subtracts them after its last day, a running sum then
+    yields the daily allocation, with weekends left at zero. The value of a
+    'week' or 'month' bucket is the peak daily allocation within it, so
+    over-allocation is never averaged away.
+    """
+
+    def __init__(self, document, start, end, bucket='day'):
+        if bucket not in ('day', 'week', 'month'):
+            raise Exception('Unknown bucket "{}", expected day, week or month'.format(bucket))
+        self.bucket = bucket
+        self.start = WorkCalendar.to_date(start)
+        self.end = WorkCalendar.to_date(end)
+        self.resources = document.all_resources()
+
+        day_count = max(0, (self.end - self.start).days)
+        self.daily_units = [self.daily_units_for_resource(resource, day_count) for resource in self.resources]
+        self.bucket_starts, bucket_indexes = self.buckets(day_count)
+        self.matrix = [self.bucket_values(daily_units, bucket_indexes) for daily_units in self.daily_units]
+
+    def task_day_range(self, task):
+        if not task.starting_date:
+            return None
+        first_day = (task.starting_date.date() - self.start).days
+        ending_date = task.ending_date
+        if not ending_date:
+            duration = task.duration if isinstance(task.duration, (int, long, float)) else task.effort.seconds()
+            workdays = max(1, int(math.ceil(float(duration) / WorkDayTimeInterval.SECONDS_PER_WORKDAY)))
+            ending_date = WorkCalendar.add_workdays(task.starting_date, workdays - 1)
+        return first_day, (ending_date.date() - self.start).days
+
+    def daily_units_for_resource(self, resource, day_count):
+        differences = [0.0] * (day_count + 1)
+        for assignment in resource.resource_assignments:
+            day_range = self.task_day_range(assignment.task)
+            if not day_range:
+                continue
+            first_day, last_day = max(0, day_range[0]), min(day_count - 1, day_range[1])
+            if first_day > last_day:
+                continue
+            differences[first_day] += assignment.units
+            differences[last_day + 1] -= assignment.units
+
+        daily_units = []
+        units = 0.0
+        weekday = self.start.weekday()
+        for day in xrange(day_count):
+            units += differences[day]
+            daily_units.append(units if (weekday + day) % 7 < WorkCalendar.WORKDAYS_PER_WEEK else 0.0)
+        return daily_units
+
+    def buckets(self, day_count):
+        bucket_starts = []
+        bucket_indexes = []
+        for day in xrange(day_count):
+            date = self.start + datetime.timedelta(days=day)
+            if self.bucket == 'day':
+                is_bucket_start = True
+            elif self.bucket == 'week':
+                is_bucket_start = day % 7 == 0
+            else:
+                is_bucket_start = day == 0 or date.day == 1
+            if is_bucket_start:
+                bucket_starts.append(date)
+            bucket_indexes.append(len(bucket_starts) - 1)
+        return bucket_starts, bucket_indexes
+
+    def bucket_values(self, daily_units, bucket_indexes):
+        if self.bucket == 'day':
+            return list(daily_units)
+        values = [0.0] * len(self.bucket_starts)
+        for bucket_index, units in zip(bucket_indexes, daily_units):
+            if units > values[bucket_index]:
+                values[bucket_index] = units
+        return values
+
+    def bucket_end(self, bucket_index):
+        if bucket_index + 1 < len(self.bucket_starts):
+            return self.bucket_starts[bucket_index + 1]
+        return self.end
+
+    def units(self, resource, bucket_start):
+        return self.matrix[self.resources.index(resource)][self.bucket_starts.index(bucket_start)]
+
+    def over_allocations(self, capacity=1.0):
+        """Return (resource, window start, window end, peak units) tuples for every run of
+        consecutive buckets in which a resource is allocated above capacity. capacity can
+        be a number or a dictionary from resource ID to number.
+        """
+        over_allocations = []
+        for resource, values in zip(self.resources, self.matrix):
+            resource_capacity = capacity.get(resource.id, 1.0) if isinstance(capacity, dict) else capacity
+            window_start = None
+            for bucket_index, units in enumerate(values + [0.0]):
+                if units > resource_capacity:
+                    if window_start is None:
+                        window_start, peak = bucket_index, units
+                    peak = max(peak, units)
+                elif window_start is not None:
+                    over_allocations.append((resource, self.bucket_starts[window_start], self.bucket_end(bucket_index - 1), peak))
+                    window_start = None
+        return over_allocations
+
+    def __repr__(self):
+        return u'<ResourceLoad {} resources x {} {} buckets>'.format(len(self.resources), len(self.bucket_starts), self.bucket)
+
+
+class ResourceLeveler(object):
+    """Delays tasks so that no resource is allocated above its capacity on any work day.
+
+    This is a serial schedule generation scheme: tasks become eligible once all
+    of their prerequisites are scheduled, and the eligible task with the highest
+    priority (then the earliest original start) is taken from a heap and placed
+    at the first work day on or after its earliest start where all of its
+    resources have enough free capacity for its whole duration. Tasks are never
+    moved earlier than their current start. capacity can be a number or a
+    dictionary from resource ID to number.
+    """
+
+    def __init__(self, document, capacity=1.0):
+        self.document = document
+        self.capacity = capacity
+        self.network = ScheduleNetwork(document)
+
+    def resource_capacity(self, resource):
+        if isinstance(self.capacity, dict):
+            return self.capacity.get(resource.id, 1.0)
+        return self.capacity
+
+    def level(self):
+        network = self.network
+        tasks = network.tasks
+        durations = [int(math.ceil(duration)) for duration in network.durations]
+        earliest_starts = [WorkCalendar.workdays_between(network.start_date, task.starting_date) if task.starting_date else 0 for task in tasks]
+        demands = [[(assignment.resource.id, assignment.units, self.resource_capacity(assignment.resource)) for assignment in task.resource_assignments] for task in tasks]
+
+        successors = [[] for task in tasks]
+        pending_counts = [len(predecessors) for predecessors in network.predecessors]
+        for index, predecessors in enumerate(network.predecessors):
+            for predecessor_index, dependency_type in predecessors:
+                successors[predecessor_index].append(index)
+
+        ready = [(-(task.priority or 0), earliest_starts[index], index) for index, task in enumerate(tasks) if not pending_counts[index]]
+        heapq.heapify(ready)
+        usage = collections.defaultdict(list)
+        starts = [0] * len(tasks)
+        finishes = [0] * len(tasks)
+
+        while ready:
+            priority, earliest_start, index = heapq.heappop(ready)
+            duration = durations[index]
+            for predecessor_index, dependency_type in network.predecessors[index]:
+                if dependency_type == 'FS':
+                    candidate = finishes[predecessor_index]
+                elif dependency_type == 'SS':
+                    candidate = starts[predecessor_index]
+                elif dependency_type == 'FF':
+                    candidate = finishes[predecessor_index] - duration
+                else:
+                    candidate = starts[predecessor_index] - duration
+                earliest_start = max(earliest_start, candidate)
+
+            start = self.first_free_start(usage, demands[index], earliest_start, duration)
+            for resource_id, units, capacity in demands[index]:
+                resource_usage = usage[resource_id]
+                if len(resource_usage) < start + duration:
+                    resource_usage.extend([0.0] * (start + duration - len(resource_usage)))
+                for day in xrange(start, start + duration):
+                    resource_usage[day] += units
+            starts[index] = start
+            finishes[index] = start + duration
+
+            for successor_index in successors[index]:
+                pending_counts[successor_index] -= 1
+                if not pending_counts[successor_index]:
+                    heapq.heappush(ready, (-(tasks[successor_index].priority or 0), earliest_starts[successor_index], successor_index))
+
+        return LevelingResult(network, earliest_starts, starts)
+
+    @staticmethod
+    def first_free_start(usage, demands, earliest_start, duration):
+        start = earliest_start
+        while True:
+            conflict_day = None
+            for resource_id, units, capacity in demands:
+                # a single assignment above capacity can never fit, it is left where it is
+                if units > capacity:
+                    continue
+                resource_usage = usage[resource_id]
+                for day in xrange(start, min(start + duration, len(resource_usage))):
+                    if resource_usage[day] + units > capacity:
+                        conflict_day = day if conflict_day is None else max(conflict_day, day)
+                        break
+            if conflict_day is None:
+                return start
+            start = conflict_day + 1
+
+
+class LevelingResult(object):
+    """The outcome of ResourceLeveler.level(), with start dates as work day offsets from the project start."""
+
+    def __init__(self, network, original_starts, starts):
+        self.network = network
+        self.original_starts = original_starts
+        self.starts = starts
+
+    def proposed_start_dates(self):
+        # tasks are shifted from their own start date so that they keep their time of day
+        start_date = self.network.start_date
+        return collections.OrderedDict((task.id, WorkCalendar.add_workdays(task.starting_date or start_date, start - original_start)) for task, original_start, start in zip(self.network.tasks, self.original_starts, self.starts) if start != original_start)
+
+    def change_records(self):
+        task_map = self.network.document.task_map
+        return [SetDateTaskChangeRecord(task_map[task_id], 'starting_constraint_date', date) for task_id, date in self.proposed_start_dates().items()]
+
+    def apply(self):
+        """Add the change records to their tasks and update the start dates in the model,
+        the changes are written with the next commit.
+        """
+        for change_record in self.change_records():
+            task = change_record.task
+            task.add_change_record(change_record)
+            task.starting_constraint_date = change_record.value
+            task.starting_date = change_record.value
+
+    def __repr__(self):
+        return u'<LevelingResult {} of {} tasks moved>'.format(len(self.proposed_start_dates()), len(self.starts))
+
+
+class TaskSnapshot(collections.namedtuple('TaskSnapshot', ['id', 'parent_id', 'child_ids', 'prerequisite_ids', 'dependent_ids', 'resource_ids'] + Task.export_properties)):
+    """An immutable copy of a task's properties, custom_data is a sorted tuple of (name, value) pairs."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_task(cls, task):
+        parent_task = task.parent_task()
+        values = dict((property_name, getattr(task, property_name)) for property_name in Task.export_properties)
+        values['custom_data'] = tuple(sorted(task.custom_data.items()))
+        return cls(
+            id=task.id,
+            parent_id=parent_task.id if parent_task else None,
+            child_ids=tuple(child_task.id for child_task in task.tasks),
+            prerequisite_ids=tuple(dependency.prerequisite_task.id for dependency in task.prerequisites),
+            dependent_ids=tuple(dependency.dependent_task.id for dependency in task.dependents),
+            resource_ids=tuple(assignment.resource.id for assignment in task.resource_assignments),
+            **values)
+
+    def custom_data_value(self, key):
+        return dict(self.custom_data).get(key)
+
+    def __repr__(self):
+        return u'<TaskSnapshot {0}: {1}>'.format(self.id, self.name)
+
+
+class DocumentSnapshot(object):
+    """An immutable, lock-free readable view of a document's tasks.
+
+    Nothing in a snapshot is ever modified after it has been built, so any
+    number of threads can read it while a newer snapshot is prepared.
+    with_task_changes() returns a new snapshot that shares every unchanged
+    task and custom data index entry with this one.
+    """
+
+    def __init__(self, name, task_map, top_level_task_ids, custom_data_index, generation=0):
+        self.name = name
+        self.task_map = task_map
+        self.top_level_task_ids = top_level_task_ids
+        self.custom_data_index = custom_data_index
+        self.generation = generation
+
+    @classmethod
+    def from_document(cls, document, generation=0):
+        task_map = {}
+        custom_data_index = {}
+        for task in document.all_tasks():
+            task_map[task.id] = TaskSnapshot.from_task(task)
+            for key, value in task.custom_data.items():
+                value_map = custom_data_index.setdefault(key, {})
+                value_map[value] = value_map.get(value, ()) + (task.id,)
+        return cls(document.name, task_map, tuple(task.id for task in document.tasks), custom_data_index, generation)
+
+    def task_for_id(self, id):
+        return self.task_map[id]
+
+    def tasks_for_custom_data_value(self, key, value):
+        return [self.task_map[id] for id in self.custom_data_index.get(key, {}).get(value, ())]
+
+    def child_tasks(self, task=None):
+        child_ids = task.child_ids if task else self.top_level_task_ids
+        return [self.task_map[id] for id in child_ids]
+
+    def all_tasks(self):
+        stack = list(reversed(self.top_level_task_ids))
+        while stack:
+            task = self.task_map[stack.pop()]
+            yield task
+            stack.extend(reversed(task.child_ids))
+
+    def with_task_changes(self, changes):
+        """Return a new snapshot with changed task properties. changes maps task IDs
+        to dictionaries of property values, custom_data values are dictionaries.
+        """
+        task_map = dict(self.task_map)
+        custom_data_index = dict(self.custom_data_index)
+        copied_keys = set()
+        for task_id, properties in changes.items():
+            old_task = task_map[task_id]
+            properties = dict(properties)
+            if 'custom_data' in properties:
+                properties['custom_data'] = tuple(sorted(properties['custom_data'].items()))
+            new_task = old_task._replace(**properties)
+            task_map[task_id] = new_task
+            if new_task.custom_data == old_task.custom_data:
+                continue
+
+            for key, value in set(old_task.custom_data) ^ set(new_task.custom_data):
+                if key not in copied_keys:
+                    custom_data_index[key] = dict(custom_data_index.get(key, {}))
+                    copied_keys.add(key)
+            for key, value in set(old_task.custom_data) - set(new_task.custom_data):
+                task_ids = tuple(id for id in custom_data_index[key].get(value, ()) if id != task_id)
+                if task_ids:
+                    custom_data_index[key][value] = task_ids
+                else:
+                    custom_data_index[key].pop(value, None)
+            for key, value in set(new_task.custom_data) - set(old_task.custom_data):
+                custom_data_index[key][value] = custom_data_index[key].get(value, ()) + (task_id,)
+
+        return DocumentSnapshot(self.name, task_map, self.top_level_task_ids, custom_data_index, self.generation + 1)
+
+    def __repr__(self):
+        return u'<DocumentSnapshot {0} generation {1}>'.format(self.name, self.generation)
+
+
+class DocumentSnapshotHolder(object):
+    """Publishes the current DocumentSnapshot of a document to reader threads.
+
+    Readers call current() and keep using the snapshot they got, which is a
+    plain attribute read without any locking. Writers are serialized with a
+    lock, build the next snapshot and swap it in with a single assignment.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.write_lock = threading.Lock()
+
+    @classmethod
+    def for_document(cls, document):
+        return cls(DocumentSnapshot.from_document(document))
+
+    def current(self):
+        return self.snapshot
+
+    def update(self, changes):
+        with self.write_lock:
+            self.snapshot = self.snapshot.with_task_changes(changes)
+            return self.snapshot
+
+    def refresh(self, load_document):
+        """Build a snapshot of the document returned by load_document() and publish it."""
+        document = load_document()
+        with self.write_lock:
+            self.snapshot = DocumentSnapshot.from_document(document, generation=self.snapshot.generation + 1)
+            return self.snapshot
+
+
+class SharedModelPublisher(object):
+    """Publishes a read-only columnar copy of a document for other processes.
+
+    The model is written to a file in /dev/shm (or the temporary directory
+    where that does not exist) that readers map into memory, so all
+    processes share one copy of the pages. Task properties are stored as
+    columns of fixed size values in pre-order, all strings once in a string
+    table, and child tasks, dependencies, custom data and assignments as
+    compressed sparse row arrays: an offsets column per task into one flat
+    column. Each publish() writes a new generation file and then atomically
+    replaces the generation counter file, SharedModelReader switches over to
+    the new generation on its next refresh(). The previous generation is
+    kept so a reader that just read the counter can still open it, older
+    generations are unlinked, readers that still map them keep working.
+    """
+
+    MAGIC = 'OPSM'
+    VERSION = 1
+    header = struct.Struct('<4sIQI')
+    section_header = struct.Struct('<QQ')
+    generation_counter = struct.Struct('<Q')
+
+    # name, array typecode, columns are stored in the native byte order and
+    # sizes because readers are always on the same machine
+    sections = [
+        ('task_ids', 'l'), ('parent_indexes', 'l'),
+        ('names', 'l'), ('outline_numbers', 'l'), ('task_types', 'l'), ('task_statuses', 'l'),
+        ('efforts', 'd'), ('completed_efforts', 'd'), ('remaining_efforts', 'd'), ('durations', 'd'), ('total_costs', 'd'), ('priorities', 'l'),
+        ('starting_dates', 'd'), ('ending_dates', 'd'), ('starting_constraint_dates', 'd'), ('ending_constraint_dates', 'd'),
+        ('sorted_task_ids', 'l'), ('sorted_task_indexes', 'l'),
+        ('child_offsets', 'l'), ('children', 'l'),
+        ('prerequisite_offsets', 'l'), ('prerequisites', 'l'), ('dependency_types', 'l'),
+        ('dependent_offsets', 'l'), ('dependents', 'l'),
+        ('custom_data_offsets', 'l'), ('custom_data_keys', 'l'), ('custom_data_values', 'l'),
+        ('assignment_offsets', 'l'), ('assignment_resources', 'l'), ('assignment_units', 'd'),
+        ('resource_ids', 'l'), ('resource_names', 'l'),
+        ('string_offsets', 'l'), ('string_data', 'c'),
+    ]
+
+    def __init__(self, name, directory=None):
+        self.name = name
+        self.directory = directory or shared_model_directory()
+
+    def generation_path(self):
+        return os.path.join(self.directory, '{}.generation'.format(self.name))
+
+    def model_path(self, generation):
+        return os.path.join(self.directory, '{}.{}.model'.format(self.name, generation))
+
+    def current_generation(self):
+        return read_shared_model_generation(self.generation_path())
+
+    def publish(self, document):
+        """Write the model of document as the next generation and return its number."""
+        previous_generation = self.current_generation()
+        generation = previous_generation + 1
+        self.write_atomically(self.model_path(generation), self.model_data(document, generation))
+        self.write_atomically(self.generation_path(), self.generation_counter.pack(generation))
+        if previous_generation > 1:
+            try:
+                os.unlink(self.model_path(previous_generation - 1))
+            except OSError:
+                pass
+        return generation
+
+    def write_atomically(self, path, data):
+        output = tempfile.NamedTemporaryFile(dir=self.directory, prefix='.' + os.path.basename(path), delete=False)
+        try:
+            with output:
+                output.write(data)
+                output.flush()
+            os.rename(output.name, path)
+        except:
+            os.unlink(output.name)
+            raise
+
+    def model_data(self, document, generation):
+        columns = dict((name, array.array(typecode)) for name, typecode in self.sections)
+        strings = {}
+        string_list = []
+
+        def string_index(value):
+            value = value if isinstance(value, unicode) else unicode(value if value is not None else '')
+            index = strings.get(value)
+            if index is None:
+                index = strings[value] = len(string_list)
+                string_list.append(value)
+            return index
+
+        tasks = list(document.all_tasks())
+        index_for_task = dict((task, index) for index, task in enumerate(tasks))
+        resources = document.all_resources()
+        index_for_resource = dict((resource, index) for index, resource in enumerate(resources))
+        for resource in resources:
+            columns['resource_ids'].append(resource.id)
+            columns['resource_names'].append(string_index(resource.name))
+
+        for name in ('child_offsets', 'prerequisite_offsets', 'dependent_offsets', 'custom_data_offsets', 'assignment_offsets'):
+            columns[name].append(0)
+        for task in tasks:
+            parent_task = task.parent_task()
+            columns['task_ids'].append(task.id)
+            columns['parent_indexes'].append(index_for_task[parent_task] if parent_task else -1)
+            for property_name in ('name', 'outline_number', 'task_type', 'task_status'):
+                columns[SharedDocumentView.string_columns[property_name]].append(string_index(getattr(task, property_name)))
+            for property_name, column_name in SharedDocumentView.number_columns.items():
+                value = getattr(task, property_name)
+                if isinstance(value, WorkDayTimeInterval):
+                    value = value.seconds()
+                columns[column_name].append(int(value or 0) if columns[column_name].typecode == 'l' else float(value or 0))
+            for property_name, (column_name, tzinfo, missing_value) in SharedDocumentView.date_columns.items():
+                value = getattr(task, property_name)
+                columns[column_name].append(float(calendar.timegm(value.utctimetuple())) if value else float('nan'))
+
+            columns['children'].extend(index_for_task[child_task] for child_task in task.tasks)
+            columns['child_offsets'].append(len(columns['children']))
+            for dependency in task.prerequisites:
+                columns['prerequisites'].append(index_for_task[dependency.prerequisite_task])
+                columns['dependency_types'].append(string_index(dependency.dependency_type))
+            columns['prerequisite_offsets'].append(len(columns['prerequisites']))
+            columns['dependents'].extend(index_for_task[dependency.dependent_task] for dependency in task.dependents)
+            columns['dependent_offsets'].append(len(columns['dependents']))
+            for key, value in sorted(task.custom_data.items()):
+                columns['custom_data_keys'].append(string_index(key))
+                columns['custom_data_values'].append(string_index(value))
+            columns['custom_data_offsets'].append(len(columns['custom_data_keys']))
+            for assignment in task.resource_assignments:
+                columns['assignment_resources'].append(index_for_resource[assignment.resource])
+                columns['assignment_units'].append(assignment.units)
+            columns['assignment_offsets'].append(len(columns['assignment_resources']))
+
+        for task_id, index in sorted((task.id, index) for index, task in enumerate(tasks)):
+            columns['sorted_task_ids'].append(task_id)
+            columns['sorted_task_indexes'].append(index)
+
+        string_data = []
+        string_offset = 0
+        columns['string_offsets'].append(0)
+        for value in string_list:
+            encoded_value = value.encode('utf-8')
+            string_data.append(encoded_value)
+            string_offset += len(encoded_value)
+            columns['string_offsets'].append(string_offset)
+        columns['string_data'] = array.array('c', ''.join(string_data))
+
+        offset = self.header.size + self.section_header.size * len(self.sections)
+        section_headers = []
+        section_data = []
+        for name, typecode in self.sections:
+            padding = -offset % 8
+            data = columns[name].tostring()
+            section_data.append('\0' * padding + data)
+            offset += padding
+            section_headers.append(self.section_header.pack(offset, len(columns[name])))
+            offset += len(data)
+        return self.header.pack(self.MAGIC, self.VERSION, generation, len(self.sections)) + ''.join(section_headers) + ''.join(section_data)
+
+
+def shared_model_directory():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def read_shared_model_generation(path):
+    try:
+        with open(path, 'rb') as f:
+            return SharedModelPublisher.generation_counter.unpack(f.read(SharedModelPublisher.generation_counter.size))[0]
+    except (IOError, struct.error):
+        return 0
+
+
+class SharedModelReader(object):
+    """Attaches to a model published by SharedModelPublisher.
+
+    current() returns the SharedDocumentView of the generation mapped at
+    the last refresh(). A view stays valid and unchanged while it is used,
+    refresh() maps a newer generation for subsequent current() calls.
+    """
+
+    # how often refresh() re-reads the counter when publishers remove the
+    # generation it read before it could be opened
+    OPEN_ATTEMPTS = 5
+
+    def __init__(self, name, directory=None):
+        self.name = name
+        self.directory = directory or shared_model_directory()
+        self.view = None
+        self.refresh()
+
+    def refresh(self):
+        """Switch to the latest published generation, returns True if it changed."""
+        publisher = SharedModelPublisher(self.name, self.directory)
+        for attempt in range(self.OPEN_ATTEMPTS):
+            generation = read_shared_model_generation(publisher.generation_path())
+            if not generation:
+                raise Exception('No shared model "{}" has been published in {}'.format(self.name, self.directory))
+            if self.view and self.view.generation == generation:
+                return False
+            try:
+                with open(publisher.model_path(generation), 'rb') as f:
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                break
+            except IOError as e:
+                if e.errno != errno.ENOENT or attempt == self.OPEN_ATTEMPTS - 1:
+                    raise
+        self.view = SharedDocumentView(buffer)
+        return True
+
+    def current(self):
+        return self.view
+
+
+class SharedDocumentView(object):
+    """A read-only document backed by a mapped shared model, values are decoded
+    with struct.unpack_from on access and never copied into Python objects
+    up front.
+    """
+
+    string_columns = {'name': 'names', 'outline_number': 'outline_numbers', 'task_type': 'task_types', 'task_status': 'task_statuses'}
+    number_columns = {'effort': 'efforts', 'completed_effort': 'completed_efforts', 'remaining_effort': 'remaining_efforts', 'duration': 'durations', 'total_cost': 'total_costs', 'priority': 'priorities'}
+    # column, time zone of the datetimes, value for missing dates, matching the values of Task
+    date_columns = {
+        'starting_date': ('starting_dates', UTCDateValueConverter.utc, None),
+        'ending_date': ('ending_dates', UTCDateValueConverter.utc, None),
+        'starting_constraint_date': ('starting_constraint_dates', UTCDateValueConverter.utc, None),
+        'ending_constraint_date': ('ending_constraint_dates', None, ''),
+    }
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, version, self.generation, section_count = SharedModelPublisher.header.unpack_from(buffer, 0)
+        if magic != SharedModelPublisher.MAGIC or version != SharedModelPublisher.VERSION:
+            raise Exception('Unsupported shared model format {} version {}'.format(repr(magic), version))
+        self.sections = {}
+        for section_index, (name, typecode) in enumerate(SharedModelPublisher.sections):
+            offset, count = SharedModelPublisher.section_header.unpack_from(buffer, SharedModelPublisher.header.size + section_index * SharedModelPublisher.section_header.size)
+            value_struct = struct.Struct(typecode)
+            self.sections[name] = (offset, count, value_struct)
+        self.task_count = self.sections['task_ids'][1]
+
+    def __repr__(self):
+        return u'<SharedDocumentView generation {} with {} tasks>'.format(self.generation, self.task_count)
+
+    def value(self, section_name, index):
+        offset, count, value_struct = self.sections[section_name]
+        return value_struct.unpack_from(self.buffer, offset + index * value_struct.size)[0]
+
+    def row(self, offsets_section_name, index):
+        return xrange(self.value(offsets_section_name, index), self.value(offsets_section_name, index + 1))
+
+    def string(self, index):
+        offset = self.sections['string_data'][0]
+        start, end = self.value('string_offsets', index), self.value('string_offsets', index + 1)
+        return JsonTransport.plist_string(self.buffer[offset + start:offset + end].decode('utf-8'))
+
+    def task(self, index):
+        return SharedTaskView(self, index)
+
+    def all_tasks(self):
+        for index in xrange(self.task_count):
+            yield SharedTaskView(self, index)
+
+    @property
+    def tasks(self):
+        return [task for task in self.all_tasks() if task.parent_index() < 0]
+
+    def task_for_id(self, id):
+        low, high = 0, self.task_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.value('sorted_task_ids', middle) < id:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.task_count or self.value('sorted_task_ids', low) != id:
+            raise KeyError(id)
+        return SharedTaskView(self, self.value('sorted_task_indexes', low))
+
+    def resource_names(self):
+        return [self.string(self.value('resource_names', index)) for index in xrange(self.sections['resource_ids'][1])]
+
+
+class SharedTaskView(object):
+    """A read-only view of one task of a SharedDocumentView with the properties of Task."""
+
+    __slots__ = ('view', 'index')
+
+    def __init__(self, view, index):
+        self.view = view
+        self.index = index
+
+    def __getattr__(self, key):
+        view = self.view
+        if key in SharedDocumentView.string_columns:
+            return view.string(view.value(SharedDocumentView.string_columns[key], self.index))
+        if key in SharedDocumentView.number_columns:
+            value = view.value(SharedDocumentView.number_columns[key], self.index)
+            if key in ('effort', 'completed_effort'):
+                return WorkDayTimeInterval(seconds=value)
+            return value
+        if key in SharedDocumentView.date_columns:
+            column_name, tzinfo, missing_value = SharedDocumentView.date_columns[key]
+            value = view.value(column_name, self.index)
+            if math.isnan(value):
+                return missing_value
+            return datetime.datetime.utcfromtimestamp(value).replace(tzinfo=tzinfo)
+        raise AttributeError(key)
+
+    def __eq__(self, other):
+        return isinstance(other, SharedTaskView) and self.view is other.view and self.index == other.index
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.index)
+
+    @property
+    def id(self):
+        return self.view.value('task_ids', self.index)
+
+    def parent_index(self):
+        return self.view.value('parent_indexes', self.index)
+
+    def parent_task(self):
+        parent_index = self.parent_index()
+        return SharedTaskView(self.view, parent_index) if parent_index >= 0 else None
+
+    @property
+    def tasks(self):
+        return [SharedTaskView(self.view, self.view.value('children', i)) for i in self.view.row('child_offsets', self.index)]
+
+    def prerequisite_tasks(self):
+        return [SharedTaskView(self.view, self.view.value('prerequisites', i)) for i in self.view.row('prerequisite_offsets', self.index)]
+
+    def dependent_tasks(self):
+        return [SharedTaskView(self.view, self.view.value('dependents', i)) for i in self.view.row('dependent_offsets', self.index)]
+
+    @property
+    def custom_data(self):
+        view = self.view
+        return dict((view.string(view.value('custom_data_keys', i)), view.string(view.value('custom_data_values', i))) for i in view.row('custom_data_offsets', self.index))
+
+    def custom_data_value(self, key):
+        return self.custom_data.get(key)
+
+    def assigned_resource_names(self):
+        view = self.view
+        return [view.string(view.value('resource_names', view.value('assignment_resources', i))) for i in view.row('assignment_offsets', self.index)]
+
+    def export_record(self):
+        parent_task = self.parent_task()
+        record = collections.OrderedDict()
+        record['id'] = self.id
+        record['parent_id'] = parent_task.id if parent_task else None
+        for property_name in Task.export_properties:
+            record[property_name] = DocumentExporter.plain_value(getattr(self, property_name))
+        return record
+
+    def __repr__(self):
+        return u'<SharedTaskView {0}: {1}>'.format(self.id, self.name)
+
+
+class SnapshotStore(object):
+    """Keeps the history of document snapshots in a SQLite database.
+
+    Tasks, resources, assignments and dependencies are stored in normalized
+    version tables. A row is valid from first_snapshot_id to last_snapshot_id,
+    so a row that is unchanged from the previous snapshot of the same document
+    only gets its last_snapshot_id extended instead of being stored again.
+    """
+
+    tables = collections.OrderedDict([
+        ('task_versions', {
+            'records': 'all_tasks',
+            'key_columns': ['id'],
+            'value_columns': ['parent_id'] + Task.export_properties,
+        }),
+        ('resource_versions', {
+            'records': 'all_resources',
+            'key_columns': ['id'],
+            'value_columns': ['name'],
+        }),
+        ('assignment_versions', {
+            'records': 'all_resource_assignments',
+            'key_columns': ['task_id', 'resource_id'],
+            'value_columns': ['units'],
+        }),
+        ('dependency_versions', {
+            'records': 'all_dependencies',
+            'key_columns': ['prerequisite_task_id', 'dependent_task_id'],
+            'value_columns': ['dependency_type'],
+        }),
+    ])
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.create_tables()
+
+    def create_tables(self):
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, document_name TEXT NOT NULL, taken_at TEXT NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS snapshots_document_date ON snapshots (document_name, taken_at)')
+            for table_name, table in self.tables.items():
+                columns = ['document_name TEXT NOT NULL', 'first_snapshot_id INTEGER NOT NULL', 'last_snapshot_id INTEGER NOT NULL']
+                columns.extend(table['key_columns'] + table['value_columns'])
+                self.connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(table_name, ', '.join(columns)))
+                self.connection.execute('CREATE INDEX IF NOT EXISTS {0}_history ON {0} (document_name, {1}, first_snapshot_id)'.format(table_name, ', '.join(table['key_columns'])))
+                self.connection.execute('CREATE INDEX IF NOT EXISTS {0}_snapshot ON {0} (document_name, last_snapshot_id, first_snapshot_id)'.format(table_name))
+
+    @staticmethod
+    def column_value(value):
+        if isinstance(value, dict):
+            return json.dumps(value, sort_keys=True)
+        return value
+
+    def latest_snapshot_id(self, document_name):
+        row = self.connection.execute('SELECT MAX(id) FROM snapshots WHERE document_name = ?', (document_name,)).fetchone()
+        return row[0]
+
+    def append_snapshot(self, document, taken_at=None):
+        """Store the current state of the document and return the new snapshot ID."""
+        taken_at = taken_at or datetime.datetime.utcnow()
+        with self.connection:
+            previous_snapshot_id = self.latest_snapshot_id(document.name)
+            cursor = self.connection.execute('INSERT INTO snapshots (document_name, taken_at) VALUES (?, ?)', (document.name, taken_at.isoformat()))
+            snapshot_id = cursor.lastrowid
+            for table_name, table in self.tables.items():
+                self.append_table_rows(table_name, table, document, previous_snapshot_id, snapshot_id)
+        return snapshot_id
+
+    def append_table_rows(self, table_name, table, document, previous_snapshot_id, snapshot_id):
+        key_columns = table['key_columns']
+        value_columns = table['value_columns']
+        previous_rows = {}
+        if previous_snapshot_id is not None:
+            query = 'SELECT rowid, {} FROM {} WHERE document_name = ? AND last_snapshot_id = ?'.format(', '.join(key_columns + value_columns), table_name)
+            for row in self.connection.execute(query, (document.name, previous_snapshot_id)):
+                row = tuple(row)
+                previous_rows[row[1:len(key_columns) + 1]] = (row[0], row[len(key_columns) + 1:])
+
+        extended_rowids = []
+        inserted_rows = []
+        for item in getattr(document, table['records'])():
+            record = item.export_record()
+            key = tuple(record[column] for column in key_columns)
+            values = tuple(self.column_value(record[column]) for column in value_columns)
+            previous_row = previous_rows.get(key)
+            if previous_row and previous_row[1] == values:
+                extended_rowids.append((snapshot_id, previous_row[0]))
+            else:
+                inserted_rows.append((document.name, snapshot_id, snapshot_id) + key + values)
+
+        self.connection.executemany('UPDATE {} SET last_snapshot_id = ? WHERE rowid = ?'.format(table_name), extended_rowids)
+        placeholders = ', '.join('?' * (3 + len(key_columns) + len(value_columns)))
+        self.connection.executemany('INSERT INTO {} VALUES ({})'.format(table_name, placeholders), inserted_rows)
+
+    def snapshots(self, document_name):
+        return self.connection.execute('SELECT id, taken_at FROM snapshots WHERE document_name = ? ORDER BY id', (document_name,)).fetchall()
+
+    def task_history(self, document_name, task_id):
+        """Return a (snapshot ID, date, task row) tuple for each snapshot that contains the task."""
+        query = """
+            SELECT snapshots.id AS snapshot_id, snapshots.taken_at AS taken_at, task_versions.*
+            FROM task_versions JOIN snapshots
+                ON snapshots.document_name = task_versions.document_name
+                AND snapshots.id BETWEEN task_versions.first_snapshot_id AND task_versions.last_snapshot_id
+            WHERE task_versions.document_name = ? AND task_versions.id = ?
+            ORDER BY snapshots.id
+        """
+        return [(row['snapshot_id'], row['taken_at'], row) for row in self.connection.execute(query, (document_name, task_id))]
+
+    def effort_totals(self, document_name):
+        """Return the summed effort values of all non-group tasks for each snapshot, for burn-down charts."""
+        query = """
+            SELECT snapshots.id AS snapshot_id, snapshots.taken_at AS taken_at,
+                SUM(effort) AS effort, SUM(completed_effort) AS completed_effort, SUM(remaining_effort) AS remaining_effort, SUM(total_cost) AS total_cost
+            FROM snapshots JOIN task_versions
+                ON task_versions.document_name = snapshots.document_name
+                AND task_versions.last_snapshot_id >= snapshots.id
+                AND task_versions.first_snapshot_id <= snapshots.id
+            WHERE snapshots.document_name = ? AND task_versions.task_type != ?
+            GROUP BY snapshots.id
+            ORDER BY snapshots.id
+        """
+        return self.connection.execute(query, (document_name, Task.TASK_TYPE_GROUP)).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+class DocumentLoader(object):
+    """Loads documents at most once at a time per document and load options.
+
+    Concurrent load() calls for the same key wait for the one extraction in
+    flight and all get the same document, and the result is reused for ttl
+    seconds. Expired documents are dropped whenever a new one is stored, and
+    at most max_documents are kept, the ones closest to expiry are dropped
+    first. The returned documents are shared, callers that change them
+    affect each other. load_document is called with the document name and the
+    load options, it defaults to the OmniPlanDocument constructor.
+    """
+
+    class InFlightLoad(object):
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.document = None
+            self.exc_info = None
+
+    def __init__(self, ttl=10.0, load_document=None, max_documents=100):
+        self.ttl = ttl
+        self.max_documents = max_documents
+        self.load_document = load_document or OmniPlanDocument
+        self.lock = threading.Lock()
+        self.documents = collections.OrderedDict()
+        self.in_flight_loads = {}
+        self.hits = 0
+        self.shared_loads = 0
+        self.extractions = 0
+
+    def load(self, name, **options):
+        key = (name, tuple(sorted(options.items())))
+        with self.lock:
+            cached = self.documents.get(key)
+            if cached and cached[0] > time.time():
+                self.hits += 1
+                return cached[1]
+            in_flight_load = self.in_flight_loads.get(key)
+            is_leader = in_flight_load is None
+            if is_leader:
+                in_flight_load = self.in_flight_loads[key] = self.InFlightLoad()
+                self.extractions += 1
+            else:
+                self.shared_loads += 1
+
+        if is_leader:
+            try:
+                in_flight_load.document = self.load_document(name, **options)
+            except:
+                in_flight_load.exc_info = sys.exc_info()
+            with self.lock:
+                del self.in_flight_loads[key]
+                if in_flight_load.exc_info is None:
+                    self.store_document(key, in_flight_load.document)
+            in_flight_load.event.set()
+        else:
+            in_flight_load.event.wait()
+
+        if in_flight_load.exc_info:
+            raise in_flight_load.exc_info[0], in_flight_load.exc_info[1], in_flight_load.exc_info[2]
+        return in_flight_load.document
+
+    def store_document(self, key, document):
+        # called with the lock held, with one ttl insertion order is expiration order
+        now = time.time()
+        self.documents.pop(key, None)
+        while self.documents and next(self.documents.itervalues())[0] <= now:
+            self.documents.popitem(last=False)
+        self.documents[key] = (now + self.ttl, document)
+        while len(self.documents) > self.max_documents:
+            self.documents.popitem(last=False)
+
+    def invalidate(self, name=None):
+        with self.lock:
+            for key in self.documents.keys():
+                if name is None or key[0] == name:
+                    del self.documents[key]
+
+    def metrics(self):
+        with self.lock:
+            return {'hits': self.hits, 'shared_loads': self.shared_loads, 'extractions': self.extractions}
+
+
+document_loader = DocumentLoader()
+
+
+class ChunkedDocumentReader(object):
+    """Reads the data of an open OmniPlan document in chunks of top-level task subtrees.
+
+    One script fetches the ids of the top-level tasks and another one the
+    resources and the selection. The subtrees are then read in chunks of
+    chunk_size top-level tasks, each chunk in its own osascript process, with
+    at most max_in_flight processes running at a time. A failed chunk is retried
+    up to retries times before the whole read fails. The result has the same
+    structure as the data read by OmniPlanDocument.read_document().
+    """
+
+    def __init__(self, name, chunk_size=10, max_in_flight=4, retries=2, retry_delay=1.0):
+        self.name = name
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def run_script(self, script_code, arguments):
+        cmd = AppleScript(script_code)
+        cmd.run(*arguments)
+        if not cmd.stdout:
+            raise Exception('Unable to get project data for OmniPlan document "{}", make sure that it is already open in OmniPlan'.format(self.name))
+        return cmd.plist_result()
+
+    def run_script_with_retries(self, script_code, arguments):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.run_script(script_code, arguments)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                print >> sys.stderr, 'Retrying chunk {} of OmniPlan document "{}"'.format(arguments[1:], self.name)
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def top_level_task_ids(self):
+        return self.run_script(OmniPlanDocument.omniplan_top_level_task_ids_query_applescript_code(), [self.name])['task_ids']
+
+    def read_chunk(self, task_ids):
+        return self.run_script_with_retries(OmniPlanDocument.omniplan_task_subtrees_query_applescript_code(), [self.name] + list(task_ids))['child_tasks']
+
+    def read_metadata(self):
+        return self.run_script_with_retries(OmniPlanDocument.omniplan_document_metadata_query_applescript_code(), [self.name])
+
+    def chunks(self, task_ids):
+        return [task_ids[i:i + self.chunk_size] for i in range(0, len(task_ids), self.chunk_size)]
+
+    def read_document_data(self):
+        task_ids = self.top_level_task_ids()
+        pool = multiprocessing.pool.ThreadPool(self.max_in_flight)
+        try:
+            metadata_result = pool.apply_async(self.read_metadata)
+            child_tasks = []
+            for chunk_tasks in pool.imap(self.read_chunk, self.chunks(task_ids)):
+                child_tasks.extend(chunk_tasks)
+            document_data = dict(metadata_result.get())
+        finally:
+            pool.terminate()
+            pool.join()
+
+        document_data['child_tasks'] = child_tasks
+        return document_data
+
+
+def aggregate_portfolio_document(arguments):
+    # module level so that it can be sent to multiprocessing worker processes
+    path, custom_data_keys = arguments
+    try:
+        document = Portfolio.load_document(path)
+    except Exception as e:
+        return path, None, '{}: {}'.format(type(e).__name__, e)
+    return path, Portfolio.document_aggregate(document, custom_data_keys), None
+
+
+PortfolioAggregate = collections.namedtuple('PortfolioAggregate', 'task_count effort effort_by_resource_name effort_by_custom_data_value')
+
+
+class Portfolio(object):
+    """Effort totals across many documents, computed in a pool of worker processes.
+
+    Each worker loads one document from an .oplx bundle or from a pickled
+    document data cache file, as written by OmniPlanDocument.read_document(),
+    and returns only a PortfolioAggregate of counters to the parent process,
+    which merges them. Effort is counted in work days for tasks without child
+    tasks, so group efforts are not counted twice. The effort of a task is
+    split between its assigned resources in proportion to their units.
+    """
+
+    def __init__(self, paths, custom_data_keys=(), processes=None):
+        self.paths = list(paths)
+        self.custom_data_keys = tuple(custom_data_keys)
+        self.processes = processes
+
+    @staticmethod
+    def load_document(path):
+        if os.path.isdir(path):
+            return OmniPlanDocument.from_oplx_bundle(path)
+        with open(path, 'rb') as f:
+            document_data = pickle.load(f)
+        if isinstance(document_data, list):
+            document_data = document_data[0]
+        return OmniPlanDocument(os.path.basename(path), document_data=document_data)
+
+    @staticmethod
+    def document_aggregate(document, custom_data_keys):
+        task_count = 0
+        effort = 0.0
+        effort_by_resource_name = collections.Counter()
+        effort_by_custom_data_value = dict((key, collections.Counter()) for key in custom_data_keys)
+        for task in document.all_tasks():
+            task_count += 1
+            if task.tasks:
+                continue
+            workdays = float(task.effort.seconds()) / WorkDayTimeInterval.SECONDS_PER_WORKDAY
+            effort += workdays
+            total_units = sum(assignment.units for assignment in task.resource_assignments)
+            for assignment in task.resource_assignments:
+                if total_units:
+                    effort_by_resource_name[assignment.resource.name] += workdays * assignment.units / total_units
+            for key, counter in effort_by_custom_data_value.items():
+                value = task.custom_data.get(key)
+                if value is not None:
+                    counter[value] += workdays
+        return PortfolioAggregate(task_count, effort, effort_by_resource_name, effort_by_custom_data_value)
+
+    def run(self):
+        arguments = [(path, self.custom_data_keys) for path in self.paths]
+        if self.processes == 1:
+            results = map(aggregate_portfolio_document, arguments)
+        else:
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                results = list(pool.imap_unordered(aggregate_portfolio_document, arguments))
+            finally:
+                pool.close()
+                pool.join()
+
+        result = PortfolioResult(self.custom_data_keys)
+        for path, aggregate, error in results:
+            result.merge(path, aggregate, error)
+        return result
+
+
+class PortfolioResult(object):
+
+    def __init__(self, custom_data_keys):
+        self.task_count = 0
+        self.effort = 0.0
+        self.effort_by_resource_name = collections.Counter()
+        self.effort_by_custom_data_value = dict((key, collections.Counter()) for key in custom_data_keys)
+        self.aggregates = {}
+        self.errors = {}
+
+    def merge(self, path, aggregate, error):
+        if error:
+            self.errors[path] = error
+            return
+        self.aggregates[path] = aggregate
+        self.task_count += aggregate.task_count
+        self.effort += aggregate.effort
+        self.effort_by_resource_name.update(aggregate.effort_by_resource_name)
+        for key, counter in aggregate.effort_by_custom_data_value.items():
+            self.effort_by_custom_data_value[key].update(counter)
+
+    def __repr__(self):
+        return u'<PortfolioResult {} documents, {} tasks, {:.1f} work days, {} errors>'.format(len(self.aggregates), self.task_count, self.effort, len(self.errors))
+
+
+SyncCreate = collections.namedtuple('SyncCreate', 'key_value properties custom_data resource_names')
+SyncUpdate = collections.namedtuple('SyncUpdate', 'task property_name old_value new_value')
+SyncCustomDataWrite = collections.namedtuple('SyncCustomDataWrite', 'task name old_value new_value')
+SyncAssignment = collections.namedtuple('SyncAssignment', 'task resource')
+
+
+class TaskSync(object):
+    """Plans and applies the smallest set of changes that makes a document match external records.
+
+    Each record is a dict of field values. The key field, a custom data field
+    such as "custom:TicketID", matches records to tasks through the document's
+    custom data index. The other fields are mutable task properties (name,
+    effort, completed_effort), custom data fields, and "resources", a list of
+    resource names to assign. A task is only changed where its value differs
+    from the record, and assignments are only added, never removed. Records
+    without a task are created in one script, everything else is applied
+    with one batched commit.
+    """
+
+    RESOURCES_FIELD = 'resources'
+
+    def __init__(self, document, key='custom:TicketID'):
+        if not key.startswith(Task.CUSTOM_DATA_PROPERTY_PREFIX):
+            raise Exception('The sync key must be a custom data field "custom:<name>", got "{}"'.format(key))
+        self.document = document
+        self.key = key
+        self.key_name = key[len(Task.CUSTOM_DATA_PROPERTY_PREFIX):]
+
+    def plan(self, records):
+        report = SyncReport()
+        start_time = time.time()
+        resources_by_name = dict((resource.name, resource) for resource in self.document.all_resources())
+        seen_key_values = set()
+
+        for record in records:
+            key_value = record.get(self.key)
+            if key_value is None:
+                report.errors.append('Record without "{}": {}'.format(self.key, record))
+                continue
+            key_value = self.text_value(self.key, key_value)
+            if key_value in seen_key_values:
+                report.errors.append('Duplicate record for {} "{}"'.format(self.key, key_value))
+                continue
+            seen_key_values.add(key_value)
+
+            properties, custom_data, resource_names = self.record_fields(record, report)
+            resources = []
+            for resource_name in resource_names:
+                if resource_name in resources_by_name:
+                    resources.append(resources_by_name[resource_name])
+                else:
+                    report.errors.append('Unknown resource "{}" for {} "{}"'.format(resource_name, self.key, key_value))
+
+            tasks = self.document.tasks_for_custom_data_value(self.key_name, key_value)
+            if not tasks:
+                report.creates.append(SyncCreate(key_value, properties, custom_data, [resource.name for resource in resources]))
+                continue
+            if len(tasks) > 1:
+                report.errors.append('{} tasks with {} "{}", updating {}'.format(len(tasks), self.key, key_value, tasks[0]))
+            task = tasks[0]
+
+            for property_name, value in properties.items():
+                old_value = getattr(task, property_name)
+                if old_value != value:
+                    report.updates.append(SyncUpdate(task, property_name, old_value, value))
+            for name, value in custom_data.items():
+                old_value = task.custom_data_value(name)
+                if old_value != value:
+                    report.custom_data_writes.append(SyncCustomDataWrite(task, name, old_value, value))
+            assigned_resources = task.assigned_resources()
+            for resource in resources:
+                if resource not in assigned_resources:
+                    report.assignments.append(SyncAssignment(task, resource))
+
+        report.timings['plan'] = time.time() - start_time
+        return report
+
+    def record_fields(self, record, report):
+        properties = {}
+        custom_data = {}
+        resource_names = []
+        for field, value in record.items():
+            if field == self.RESOURCES_FIELD:
+                resource_names = list(value)
+            elif field.startswith(Task.CUSTOM_DATA_PROPERTY_PREFIX):
+                custom_data[field[len(Task.CUSTOM_DATA_PROPERTY_PREFIX):]] = self.text_value(field, value)
+            elif field in Task.mutable_simple_properties:
+                properties[field] = self.property_value(field, value)
+            else:
+                raise Exception('Unsupported sync field "{}", expected one of {}, "custom:<name>" or "{}"'.format(field, ', '.join(sorted(Task.mutable_simple_properties)), self.RESOURCES_FIELD))
+        return properties, custom_data, resource_names
+
+    @staticmethod
+    def text_value(field, value):
+        """Key, name and custom data values are compared as unicode, numbers are converted."""
+        if isinstance(value, unicode):
+            return value
+        if isinstance(value, str):
+            return value.decode('utf-8')
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            return unicode(value)
+        raise ValueError('Unsupported value {!r} for sync field "{}", expected a string or a number'.format(value, field))
+
+    @classmethod
+    def property_value(cls, field, value):
+        """Effort values are WorkDayTimeInterval instances or a number of seconds, like in the exporter."""
+        if Task.property_value_converter_map.get(field) is not WorkDayTimeIntervalValueConverter:
+            return cls.text_value(field, value)
+        if isinstance(value, WorkDayTimeInterval):
+            return value
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            return WorkDayTimeInterval(seconds=value)
+        raise ValueError('Unsupported value {!r} for sync field "{}", expected a WorkDayTimeInterval or a number of seconds'.format(value, field))
+
+    def apply(self, report):
+        start_time = time.time()
+        if report.creates:
+            if self.document.bundle:
+                raise Exception('Creating tasks is not supported for documents loaded from an .oplx bundle')
+            created_tasks = self.document.create_tasks([create.properties for create in report.creates])
+            for create, task in zip(report.creates, created_tasks):
+                for name, value in create.custom_data.items():
+                    report.custom_data_writes.append(SyncCustomDataWrite(task, name, None, value))
+                for resource_name in create.resource_names:
+                    report.assignments.append(SyncAssignment(task, self.document.resource_for_name(resource_name)))
+        report.timings['create'] = time.time() - start_time
+
+        start_time = time.time()
+        for update in report.updates:
+            setattr(update.task, update.property_name, update.new_value)
+        for write in report.custom_data_writes:
+            write.task.set_custom_data_value(write.name, write.new_value)
+        for assignment in report.assignments:
+            assignment.task.assign_to_resource(assignment.resource)
+        changed_tasks = set(update.task for update in report.updates)
+        changed_tasks.update(write.task for write in report.custom_data_writes)
+        changed_tasks.update(assignment.task for assignment in report.assignments)
+        self.document.commit_tasks([task for task in self.document.all_tasks() if task in changed_tasks])
+        report.timings['commit'] = time.time() - start_time
+
+    def sync(self, records, dry_run=False):
+        report = self.plan(records)
+        report.dry_run = dry_run
+        if not dry_run:
+            self.apply(report)
+        return report
+
+
+class SyncReport(object):
+
+    def __init__(self):
+        self.dry_run = False
+        self.creates = []
+        self.updates = []
+        self.custom_data_writes = []
+        self.assignments = []
+        self.errors = []
+        self.timings = collections.OrderedDict()
+
+    def is_empty(self):
+        return not any((self.creates, self.updates, self.custom_data_writes, self.assignments))
+
+    def __repr__(self):
+        timings = ', '.join('{} {:.3f}s'.format(phase, seconds) for phase, seconds in self.timings.items())
+        return u'<SyncReport{} {} creates, {} updates, {} custom data writes, {} assignments, {} errors, {}>'.format(' (dry run)' if self.dry_run else '', len(self.creates), len(self.updates), len(self.custom_data_writes), len(self.assignments), len(self.errors), timings)
+
+
+class DocumentExporter(object):
+    """Streams the tasks, resources, assignments and dependencies of a document
+    as JSON lines or CSV rows.
+
+    Records are produced by a chain of generators and written one at a time,
+    so the output never has to be assembled in memory. Fields are selected by
+    name, custom data values can be selected with "custom:<name>", and filters
+    are "field=value" or "field!=value" expressions.
+    """
+
+    record_types = collections.OrderedDict([
+        ('tasks', 'all_tasks'),
+        ('resources', 'all_resources'),
+        ('assignments', 'all_resource_assignments'),
+        ('dependencies', 'all_dependencies'),
+    ])
+
+    CUSTOM_DATA_FIELD_PREFIX = Task.CUSTOM_DATA_PROPERTY_PREFIX
+
+    def __init__(self, document, record_types=None, fields=None, filters=None):
+        self.document = document
+        self.record_types = record_types or ['tasks']
+        self.fields = fields
+        self.filters = [self.parse_filter(f) for f in filters or []]
+
+        for record_type in self.record_types:
+            if record_type not in DocumentExporter.record_types:
+                raise Exception('Unknown record type "{}", expected one of {}'.format(record_type, ', '.join(DocumentExporter.record_types)))
+
+    @staticmethod
+    def plain_value(value):
+        if isinstance(value, (WorkDayTimeInterval, TimeInterval)):
+            return value.seconds()
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        if isinstance(value, dict):
+            return dict(value)
+        return value
+
+    @staticmethod
+    def parse_filter(expression):
+        for comparison in ('!=', '='):
+            if comparison in expression:
+                field, value = expression.split(comparison, 1)
+                return field.strip(), comparison, value
+        raise Exception('Invalid filter expression "{}", expected "field=value" or "field!=value"'.format(expression))
+
+    @classmethod
+    def field_value(cls, record, field):
+        if field.startswith(cls.CUSTOM_DATA_FIELD_PREFIX):
+            return (record.get('custom_data') or {}).get(field[len(cls.CUSTOM_DATA_FIELD_PREFIX):])
+        return record.get(field)
+
+    @classmethod
+    def has_field(cls, record, field):
+        return field in record or (field.startswith(cls.CUSTOM_DATA_FIELD_PREFIX) and 'custom_data' in record)
+
+    def matches_filters(self, record):
+        for field, operator, value in self.filters:
+            if not self.has_field(record, field):
+                continue
+            actual_value = self.field_value(record, field)
+            actual_value = u'' if actual_value is None else unicode(actual_value)
+            if (actual_value == value) != (operator == '='):
+                return False
+        return True
+
+    def selected_fields(self, record):
+        if not self.fields:
+            return record
+        selected = collections.OrderedDict()
+        for field in self.fields:
+            if self.has_field(record, field):
+                selected[field] = self.field_value(record, field)
+        return selected
+
+    def records(self, record_type):
+        for item in getattr(self.document, DocumentExporter.record_types[record_type])():
+            yield item.export_record()
+
+    def filtered_records(self, record_type):
+        for record in self.records(record_type):
+            if self.matches_filters(record):
+                yield self.selected_fields(record)
+
+    def write_jsonl(self, stream):
+        for record_type in self.record_types:
+            for record in self.filtered_records(record_type):
+                if len(self.record_types) > 1:
+                    record['record_type'] = record_type
+                stream.write(json.dumps(record, separators=(',', ':')))
+                stream.write('\n')
+
+    def write_csv(self, stream):
+        if len(self.record_types) != 1:
+            raise Exception('CSV export requires exactly one record type')
+        record_type = self.record_types[0]
+        writer = csv.writer(stream)
+        column_names = self.fields
+        if column_names:
+            writer.writerow(column_names)
+        for record in self.filtered_records(record_type):
+            if not column_names:
+                column_names = list(record.keys())
+                writer.writerow(column_names)
+            writer.writerow([self.csv_value(record.get(field)) for field in column_names])
+
+    @staticmethod
+    def csv_value(value):
+        if value is None:
+            return ''
+        if isinstance(value, dict):
+            return json.dumps(value, sort_keys=True)
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    def write(self, stream, format='jsonl'):
+        if format == 'jsonl':
+            self.write_jsonl(stream)
+        elif format == 'csv':
+            self.write_csv(stream)
+        else:
+            raise Exception('Unknown export format "{}"'.format(format))
+
+
+def export_command(args):
+    document_name = args.document or OmniPlanDocument.first_open_document_name()
+    document = OmniPlanDocument(document_name, allow_cache=args.allow_cache)
+    exporter = DocumentExporter(document, record_types=args.records, fields=args.fields, filters=args.filters)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            exporter.write(f, format=args.format)
+    else:
+        exporter.write(sys.stdout, format=args.format)
+
+
+def comma_separated_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract data from OmniPlan documents')
+    subparsers = parser.add_subparsers()
+
+    export_parser = subparsers.add_parser('export', help='Stream tasks, resources, assignments and dependencies as JSONL or CSV')
+    export_parser.add_argument('--document', help='Name of the open OmniPlan document, defaults to the frontmost document')
+    export_parser.add_argument('--allow-cache', action='store_true', help='Reuse the cached document data from a previous run')
+    export_parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help='Output format, defaults to jsonl')
+    export_parser.add_argument('--records', type=comma_separated_list, default=['tasks'], help='Comma-separated record types: {}'.format(', '.join(DocumentExporter.record_types)))
+    export_parser.add_argument('--fields', type=comma_separated_list, help='Comma-separated field names, use "custom:<name>" for custom data values')
+    export_parser.add_argument('--filter', dest='filters', action='append', default=[], help='Only export records matching "field=value" or "field!=value", can be repeated')
+    export_parser.add_argument('--output', help='Output file path, defaults to stdout')
+    export_parser.set_defaults(func=export_command)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
 if __name__ == "__main__":
-    doc = OmniPlanDocument(OmniPlanDocument.first_open_document_name())
+    main()
@@ -1,9 +1,63 @@
 #!/usr/bin/env python
 
 import unittest
+import datetime
+import json
+import threading
+import time
+import os
+import sys
+import shutil
+import tempfile
+import pickle
+import calendar
+import random
+import plistlib
+import StringIO
 from omniplan import Task, FourCharacterCode, OmniPlanDocument
 import omniplan
 
+
+def make_task_data(id, name, effort_days=1, child_tasks=None, custom_data=None, prerequisite_ids=None, task_type='OPTS', starting_date=None):
+    return {
+        'id': id,
+        'name': name,
+        'outline_number': str(id),
+        'completed_effort': 0,
+        'remaining_effort': effort_days * 28800,
+        'effort': effort_days * 28800,
+        'duration': effort_days * 28800,
+        'total_cost': 0,
+        'priority': 0,
+        'starting_date': starting_date or datetime.datetime(2012, 10, 8, 16, 30),
+        'ending_date': '',
+        'starting_constraint_date': '',
+        'ending_constraint_date': '',
+        'task_status': 'OPTo',
+        'task_type': 'OPTG' if child_tasks else task_type,
+        'custom_data': [{'name': key, 'value': value} for key, value in (custom_data or {}).items()],
+        'prerequisites': [{'prerequisite_task_id': prerequisite_id, 'dependent_task_id': id, 'dependency_type': 'FS'} for prerequisite_id in prerequisite_ids or []],
+        'child_tasks': child_tasks or [],
+    }
+
+
+def make_document_data():
+    return {
+        'child_tasks': [
+            make_task_data(1, 'Task 1', custom_data={'CustomKey': 'Custom Value 3'}, prerequisite_ids=[2]),
+            make_task_data(2, 'Task 2', custom_data={'CustomKey': 'Custom Value 1'}, prerequisite_ids=[3]),
+            make_task_data(3, 'Task 3', custom_data={'CustomKey': 'Custom Value 3'}, child_tasks=[
+                make_task_data(4, 'Task 4', custom_data={'CustomKey': 'Custom Value 2'}),
+            ]),
+            make_task_data(5, 'Task 5'),
+        ],
+        'resources': [
+            {'id': 1, 'name': 'Resource 1', 'task_assignments': [{'task_id': 2, 'units': 1.0}, {'task_id': 4, 'units': 0.5}]},
+        ],
+        'selected_task_ids': [],
+        'selected_resource_ids': [],
+    }
+
 class TestFourCharacterCode(unittest.TestCase):
 
     def test_fourcc(self):
@@ -16,6 +70,25 @@ class TestWorkDayTimeInterval(unittest.TestCase):
     def test_work_day_time_interval(self):
         self.assertEquals(omniplan.WorkDayTimeInterval(workdays=1).seconds(), 28800)
 
+    def test_shared_instances(self):
+        self.assertTrue(omniplan.WorkDayTimeInterval(workdays=1) is omniplan.WorkDayTimeInterval(seconds=28800))
+        self.assertEquals(len(set([omniplan.WorkDayTimeInterval(workdays=1), omniplan.WorkDayTimeInterval(seconds=28800.0)])), 1)
+        with self.assertRaises(AttributeError):
+            omniplan.WorkDayTimeInterval(workdays=1)._seconds = 0
+        self.assertEquals(omniplan.TimeInterval(days=1).seconds(), 86400)
+
+    def test_shared_instances_keep_value_type(self):
+        for interval_class, keyword in ((omniplan.WorkDayTimeInterval, 'workdays'), (omniplan.TimeInterval, 'days')):
+            seconds = interval_class(**{keyword: 0.5}).seconds()
+            for construction_order in ((int, float), (float, int)):
+                interval_class.cache.clear()
+                intervals = dict((value_type, interval_class(seconds=value_type(seconds))) for value_type in construction_order)
+                self.assertEquals(intervals[float].days(), 0.5)
+                self.assertEquals(intervals[int].days(), 0)
+                self.assertTrue(isinstance(interval_class(**{keyword: 0.5}).seconds(), float))
+                self.assertTrue(isinstance(interval_class(seconds=int(seconds)).seconds(), int))
+                self.assertEquals(intervals[int], intervals[float])
+
 
 class TestValueConversion(unittest.TestCase):
 
@@ -23,6 +96,15 @@ class TestValueConversion(unittest.TestCase):
         self.assertEquals(omniplan.CustomDataValueConverter.decode_omniplan_value([{'name': 'a', 'value': 'b'}]), {'a': 'b'})
         self.assertEquals(omniplan.CustomDataValueConverter.encode_omniplan_value({'a': 'b'}), [{'name': 'a', 'value': 'b'}])
 
+    def test_interned_values(self):
+        document_data = make_document_data()
+        for task_data in document_data['child_tasks'][:2]:
+            task_data['custom_data'] = [{'name': ''.join(['Custom', 'Key']), 'value': ''.join(['Custom ', 'Value'])}]
+        document = OmniPlanDocument('synthetic', document_data=document_data)
+        self.assertTrue(document.task_for_id(1).custom_data.keys()[0] is document.task_for_id(2).custom_data.keys()[0])
+        self.assertTrue(document.task_for_id(1).custom_data_value('CustomKey') is document.task_for_id(2).custom_data_value('CustomKey'))
+        self.assertFalse(document.interned_values is OmniPlanDocument('synthetic', document_data=make_document_data()).interned_values)
+
     def test_fourcc_value_converter(self):
         self.assertEquals(omniplan.FourCharacterCodeValueConverter.decode_omniplan_value(1330664531), Task.TASK_TYPE_STANDARD)
         self.assertEquals(omniplan.FourCharacterCodeValueConverter.encode_omniplan_value(Task.TASK_TYPE_STANDARD), 1330664531)
@@ -150,6 +232,779 @@ class TestOmniPlanDocument(unittest.TestCase):
         task.commit_changes()
 
 
+class TestJsonTransport(unittest.TestCase):
+
+    @staticmethod
+    def local_time_text(value):
+        # the query script emits dates in local time
+        if isinstance(value, datetime.datetime):
+            return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(calendar.timegm(value.timetuple())))
+        raise TypeError(value)
+
+    def test_identical_model(self):
+        document_data = make_document_data()
+        for id in range(6, 500):
+            document_data['child_tasks'].append(make_task_data(id, u'T\xe2che "{}"'.format(id), custom_data={'CustomKey': 'Custom Value {}'.format(id % 3)}, prerequisite_ids=[id - 1], starting_date=datetime.datetime(2012, 10, 8) + datetime.timedelta(days=id)))
+        plist_text = plistlib.writePlistToString(document_data)
+        json_text = json.dumps(document_data, default=self.local_time_text, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        self.assertLess(len(json_text) * 2, len(plist_text))
+
+        plist_document = OmniPlanDocument('synthetic', document_data=plistlib.readPlistFromString(plist_text))
+        json_document = OmniPlanDocument('synthetic', document_data=omniplan.JsonTransport.decode(json_text))
+        self.assertTrue(plist_document.diff(json_document).is_empty())
+        self.assertEquals([task.export_record() for task in json_document.all_tasks()], [task.export_record() for task in plist_document.all_tasks()])
+        self.assertEquals(type(json_document.task_for_id(1).name), type(plist_document.task_for_id(1).name))
+
+    def test_control_characters(self):
+        name = u'Task ' + u''.join(unichr(code_point) for code_point in range(32)) + u' "quoted" \\'
+        document_data = make_document_data()
+        document_data['child_tasks'][0]['name'] = name
+        json_text = json.dumps(document_data, default=self.local_time_text, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        document = OmniPlanDocument('synthetic', document_data=omniplan.JsonTransport.decode(json_text))
+        self.assertEquals(document.task_for_id(1).name, name)
+
+    @unittest.skipUnless(os.path.exists('/usr/bin/osascript'), 'requires osascript')
+    def test_json_string_control_characters(self):
+        cmd = omniplan.AppleScript(OmniPlanDocument.omniplan_applescript_json_utils_code() + r"""
+on run argv
+	set value to "Task "
+	repeat with code_point from 0 to 31
+		set value to value & (character id code_point)
+	end repeat
+	return my json_string(value & " \"quoted\" \\")
+end run
+""")
+        cmd.run()
+        self.assertEquals(json.loads(cmd.stdout), u'Task ' + u''.join(unichr(code_point) for code_point in range(32)) + u' "quoted" \\')
+
+
+class TestDocumentExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.document = OmniPlanDocument('synthetic', document_data=make_document_data())
+
+    def test_jsonl_export(self):
+        stream = StringIO.StringIO()
+        exporter = omniplan.DocumentExporter(self.document, record_types=['tasks', 'assignments'], fields=['id', 'name', 'effort', 'task_id', 'units'], filters=['custom:CustomKey!=Custom Value 3'])
+        exporter.write(stream, format='jsonl')
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEquals([record['name'] for record in records if record['record_type'] == 'tasks'], ['Task 2', 'Task 4', 'Task 5'])
+        self.assertEquals(records[0]['effort'], 28800)
+        self.assertEquals(len([record for record in records if record['record_type'] == 'assignments']), 2)
+
+    def test_csv_export(self):
+        stream = StringIO.StringIO()
+        exporter = omniplan.DocumentExporter(self.document, record_types=['tasks'], fields=['id', 'parent_id', 'custom:CustomKey'], filters=['id=4'])
+        exporter.write(stream, format='csv')
+        self.assertEquals(stream.getvalue().splitlines(), ['id,parent_id,custom:CustomKey', '4,3,Custom Value 2'])
+
+
+class TestDocumentDiff(unittest.TestCase):
+
+    def test_unchanged_document(self):
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        other_document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        self.assertTrue(document.diff(other_document).is_empty())
+
+    def test_changes(self):
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        document_data = make_document_data()
+        task_5_data = document_data['child_tasks'].pop()
+        document_data['child_tasks'][2]['child_tasks'].append(task_5_data)
+        document_data['child_tasks'][1]['name'] = 'Task 2 renamed'
+        document_data['child_tasks'].append(make_task_data(6, 'Task 6', prerequisite_ids=[1]))
+        document_data['resources'][0]['task_assignments'][1]['units'] = 1.0
+        diff = document.diff(OmniPlanDocument('synthetic', document_data=document_data))
+
+        self.assertEquals([task.id for task in diff.added_tasks], [6])
+        self.assertEquals(diff.removed_tasks, [])
+        self.assertEquals([new_task.id for old_task, new_task in diff.moved_tasks], [5])
+        self.assertEquals([(modification.new_task.id, modification.changed_properties) for modification in diff.modified_tasks], [(2, {'name': ('Task 2', 'Task 2 renamed')})])
+        self.assertEquals([modification.key for modification in diff.modified_assignments], [(4, 1)])
+        self.assertEquals([(record['prerequisite_task_id'], record['dependent_task_id']) for record in diff.added_dependencies], [(1, 6)])
+        self.assertEquals(diff.changed_task_ids(), set([1, 2, 4, 5, 6]))
+
+    def test_relation_changes(self):
+        def all_records(items, key_fields):
+            return dict((tuple(record[field] for field in key_fields), record) for record in (item.export_record() for item in items))
+
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        document_data = make_document_data()
+        document_data['child_tasks'][0]['prerequisites'][0]['dependency_type'] = 'SS'
+        del document_data['child_tasks'][2]['child_tasks'][:]
+        document_data['resources'][0]['name'] = 'Resource 1 renamed'
+        document_data['resources'][0]['task_assignments'] = [{'task_id': 2, 'units': 1.0}]
+        document_data['resources'].append({'id': 2, 'name': 'Resource 2', 'task_assignments': [{'task_id': 5, 'units': 1.0}]})
+        new_document = OmniPlanDocument('synthetic', document_data=document_data)
+        diff = document.diff(new_document)
+
+        self.assertEquals([modification.key for modification in diff.modified_resources], [(1,)])
+        self.assertEquals([record['id'] for record in diff.added_resources], [2])
+        self.assertEquals([modification.key for modification in diff.modified_assignments], [(2, 1)])
+        self.assertEquals([(record['task_id'], record['resource_id']) for record in diff.removed_assignments], [(4, 1)])
+        self.assertEquals([(record['task_id'], record['resource_id']) for record in diff.added_assignments], [(5, 2)])
+        self.assertEquals([modification.key for modification in diff.modified_dependencies], [(2, 1)])
+        for key_fields, items in ((('task_id', 'resource_id'), 'all_resource_assignments'), (('prerequisite_task_id', 'dependent_task_id'), 'all_dependencies')):
+            old_records = all_records(getattr(document, items)(), key_fields)
+            new_records = all_records(getattr(new_document, items)(), key_fields)
+            name = 'assignments' if items == 'all_resource_assignments' else 'dependencies'
+            self.assertEquals(getattr(diff, 'added_' + name), [new_records[key] for key in sorted(set(new_records) - set(old_records))])
+            self.assertEquals(getattr(diff, 'removed_' + name), [old_records[key] for key in sorted(set(old_records) - set(new_records))])
+            self.assertEquals([(modification.old_record, modification.new_record) for modification in getattr(diff, 'modified_' + name)],
+                [(old_records[key], new_records[key]) for key in sorted(set(old_records) & set(new_records)) if old_records[key] != new_records[key]])
+
+
+        other_document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        self.assertTrue(document.diff(other_document).is_empty())
+        other_document.task_for_id(4).resource_assignments[0].units = 1.0
+        self.assertEquals([modification.key for modification in document.diff(other_document).modified_assignments], [(4, 1)])
+
+    def test_direct_assignment_invalidates_hashes(self):
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        other_document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        self.assertTrue(document.diff(other_document).is_empty())
+        document.task_for_id(4).starting_date = datetime.datetime(2012, 10, 9, 16, 30)
+        self.assertEquals(document.diff(other_document).changed_task_ids(), set([4]))
+
+
+class TestChangeRecordCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.document = OmniPlanDocument('synthetic', document_data=make_document_data())
+
+    def test_repeated_property_changes(self):
+        task = self.document.task_for_id(2)
+        for workdays in range(1, 11):
+            task.effort = omniplan.WorkDayTimeInterval(workdays=workdays)
+        self.assertEquals(len(task.change_records), 1)
+        self.assertEquals(task.change_records[0].old_value, omniplan.WorkDayTimeInterval(workdays=1))
+        self.assertEquals(len(task.pending_change_records()), 1)
+
+    def test_reverted_changes(self):
+        task = self.document.task_for_id(2)
+        task.effort = omniplan.WorkDayTimeInterval(workdays=0.5)
+        task.effort = omniplan.WorkDayTimeInterval(workdays=1)
+        task.set_custom_data_value('CustomKey', 'Custom Value 4')
+        task.set_custom_data_value('CustomKey', 'Custom Value 1')
+        self.assertEquals(task.pending_change_records(), [])
+
+    def test_color_changes(self):
+        task = self.document.task_for_id(2)
+        task.set_color(omniplan.Color.red)
+        task.set_color(omniplan.Color.blue)
+        self.assertEquals([record.color for record in task.pending_change_records()], [omniplan.Color.blue])
+
+
+class OplxBundleTestCase(unittest.TestCase):
+    """Copies the test.oplx bundle to a temporary directory for each test."""
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.bundle_path = os.path.join(self.temp_directory, 'test.oplx')
+        shutil.copytree('test.oplx', self.bundle_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+
+class TestOplxBundle(OplxBundleTestCase):
+
+    def test_read_bundle(self):
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        self.assertEquals(document.name, 'test.oplx')
+        self.assertEquals(document.task_for_id(4).outline_number, '3.1')
+        self.assertEquals(document.task_for_id(2).prerequisite_tasks()[0].name, 'Task 3')
+        self.assertEquals(len(document.tasks_for_custom_data_value('CustomKey', 'Custom Value 3')), 2)
+        self.assertEquals(len(document.resource_for_name('Resource 1').assigned_tasks()), 2)
+
+
+class TestOplxWriteBack(OplxBundleTestCase):
+
+    def test_write_back(self):
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        task = document.task_for_id(2)
+        task.effort = omniplan.WorkDayTimeInterval(workdays=2)
+        task.name = 'Task 2 renamed'
+        task.set_custom_data_value('CustomKey', 'Custom Value 4')
+        document.task_for_id(5).assign_to_resource(document.resource_for_id(1))
+        document.commit_changes()
+
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        task = document.task_for_id(2)
+        self.assertEquals(task.effort, omniplan.WorkDayTimeInterval(workdays=2))
+        self.assertEquals(task.name, 'Task 2 renamed')
+        self.assertEquals(task.custom_data_value('CustomKey'), 'Custom Value 4')
+        self.assertEquals(document.task_for_id(5).assigned_resources()[0].name, 'Resource 1')
+
+
+class TestOplxWriteBehind(OplxBundleTestCase):
+
+    def test_write_behind(self):
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        committer = document.enable_write_behind(batch_size=2, max_delay=10)
+        for workdays in (2, 3):
+            document.task_for_id(2).effort = omniplan.WorkDayTimeInterval(workdays=workdays)
+        document.task_for_id(4).name = 'Task 4 renamed'
+        document.task_for_id(5).name = 'Task 5 renamed'
+        document.close()
+        self.assertFalse(committer.thread.is_alive())
+
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        self.assertEquals(document.task_for_id(2).effort, omniplan.WorkDayTimeInterval(workdays=3))
+        self.assertEquals(document.task_for_id(4).name, 'Task 4 renamed')
+        self.assertEquals(document.task_for_id(5).name, 'Task 5 renamed')
+
+    def test_write_behind_failure(self):
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        committer = document.enable_write_behind(batch_size=1, max_delay=10)
+        apply_change_records = document.bundle.apply_change_records
+        def fail(change_records, dry_run=False):
+            raise IOError('disk full')
+        document.bundle.apply_change_records = fail
+        task = document.task_for_id(2)
+        task.name = 'Task 2 renamed'
+        with self.assertRaises(omniplan.WriteBehindCommitError) as context:
+            committer.flush()
+        self.assertEquals(context.exception.failed_tasks, [task])
+        self.assertEquals(len(task.pending_change_records()), 1)
+
+        document.bundle.apply_change_records = apply_change_records
+        task.name = 'Task 2 renamed again'
+        document.close()
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        self.assertEquals(document.task_for_id(2).name, 'Task 2 renamed again')
+
+    def test_write_behind_with_foreground_commits(self):
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        committer = document.enable_write_behind(batch_size=1, max_delay=10)
+        apply_change_records = document.bundle.apply_change_records
+        batch_started = threading.Event()
+        concurrent_commits = []
+        active_commits = [0]
+        def slow_apply(change_records, dry_run=False):
+            active_commits[0] += 1
+            concurrent_commits.append(active_commits[0])
+            batch_started.set()
+            time.sleep(0.2)
+            try:
+                apply_change_records(change_records, dry_run=dry_run)
+            finally:
+                active_commits[0] -= 1
+        document.bundle.apply_change_records = slow_apply
+
+        document.task_for_id(2).name = 'Task 2 in the background'
+        batch_started.wait(5)
+        document.task_for_id(2).name = 'Task 2 in the foreground'
+        document.task_for_id(4).name = 'Task 4 in the foreground'
+        document.commit_changes()
+        self.assertEquals(max(concurrent_commits), 1)
+        self.assertFalse(document.task_for_id(2).pending_change_records())
+
+        document.close()
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        self.assertEquals(document.task_for_id(2).name, 'Task 2 in the foreground')
+        self.assertEquals(document.task_for_id(4).name, 'Task 4 in the foreground')
+
+
+class TestOplxWatch(OplxBundleTestCase):
+
+    def test_watch(self):
+        for use_inotify in (True, False):
+            shutil.rmtree(self.bundle_path)
+            shutil.copytree('test.oplx', self.bundle_path)
+            document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+            notifications = []
+            notified = threading.Event()
+            watcher = document.watch(lambda task_ids: (notifications.append(task_ids), notified.set()), debounce=0.1, poll_interval=0.05, use_inotify=use_inotify)
+            self.assertEquals(isinstance(watcher.change_source, omniplan.InotifyChangeSource), use_inotify and sys.platform.startswith('linux'))
+            task = document.task_for_id(2)
+
+            other_document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+            other_document.task_for_id(2).name = 'Task 2 renamed'
+            other_document.commit_changes()
+            self.assertTrue(notified.wait(5))
+            self.assertEquals(notifications, [set([2])])
+            self.assertTrue(document.task_for_id(2) is task)
+            self.assertEquals(task.name, 'Task 2 renamed')
+            self.assertEquals(task.pending_change_records(), [])
+
+            notified.clear()
+            other_document.task_for_id(5).assign_to_resource(other_document.resource_for_id(1))
+            other_document.commit_changes()
+            self.assertTrue(notified.wait(5))
+            self.assertEquals(notifications[1], set([5]))
+            self.assertEquals(document.task_for_id(5).assigned_resources()[0].name, 'Resource 1')
+            document.close()
+
+    def test_rebuild(self):
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        engine = document.rollup_engine()
+        search_index = document.search_index()
+        def failing_observer(task, property_name, old_value, new_value):
+            raise Exception('Observer failed')
+        document.add_task_observer(failing_observer)
+
+        document_data = make_document_data()
+        document_data['child_tasks'].pop()
+        document_data['child_tasks'].append(make_task_data(6, 'Task 6', child_tasks=[make_task_data(7, 'Task 7', effort_days=2)]))
+        with self.assertRaises(Exception):
+            document.apply_external_document_data(document_data)
+        self.assertEquals(sorted(task.id for task in document.all_tasks()), [1, 2, 3, 4, 6, 7])
+        self.assertEquals(sorted(document.task_map), [1, 2, 3, 4, 6, 7])
+        self.assertTrue(document.task_for_id(7).document() is document)
+        self.assertEquals(engine.rollup()['effort'], 5 * 28800)
+        self.assertEquals(engine.totals, omniplan.RollupEngine(document).totals)
+        self.assertEquals(search_index.search('Task 7')[0][1].id, 7)
+        self.assertNotIn(5, [task.id for score, task in search_index.search('Task 5')])
+
+
+class TestOplxScenarioVariance(OplxBundleTestCase):
+
+    def test_scenario_variance(self):
+        shutil.copy(os.path.join(self.bundle_path, 'Actual.xml'), os.path.join(self.bundle_path, 'Baseline.xml'))
+        toc_path = os.path.join(self.bundle_path, '__TOC.xml')
+        with open(toc_path) as f:
+            toc = f.read()
+        with open(toc_path, 'w') as f:
+            f.write(toc.replace('filename="Actual.xml"/>', 'filename="Actual.xml"/>\n    <scenario id="b1" name="Baseline" filename="Baseline.xml"/>'))
+        actual_path = os.path.join(self.bundle_path, 'Actual.xml')
+        with open(actual_path) as f:
+            actual = f.read()
+        with open(actual_path, 'w') as f:
+            f.write(actual.replace('2013-01-01T23:00:00.000Z', '2013-01-03T23:00:00.000Z'))
+
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        document.task_for_id(2).effort = omniplan.WorkDayTimeInterval(workdays=2)
+        document.commit_changes()
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+
+        self.assertEquals(document.scenario_names(), ['Actual', 'Baseline'])
+        baseline = document.scenario('Baseline')
+        self.assertTrue(document.scenario('b1') is baseline)
+        self.assertTrue(baseline.task_for_id(4).name is document.task_for_id(4).name)
+
+        variance = document.variance('Baseline')
+        self.assertEquals(list(variance.task_ids), [1, 2, 3, 4, 5])
+        self.assertEquals(variance.task_variance(2), {'start': 0.0, 'finish': 1.0, 'effort': 1.0, 'cost': 0.0})
+        self.assertEquals(variance.task_variance(5), {'start': 2.0, 'finish': 2.0, 'effort': 0.0, 'cost': 0.0})
+        self.assertEquals(variance.slipped_task_ids(), [2, 5])
+
+
+class TestOplxSync(OplxBundleTestCase):
+
+    def test_sync(self):
+        records = [
+            {'custom:CustomKey': 'Custom Value 1', 'name': 'Task 2 synced', 'resources': ['Resource 1']},
+            {'custom:CustomKey': 'Custom Value 2', 'name': 'Task 4', 'effort': omniplan.WorkDayTimeInterval(workdays=3), 'custom:Team': 'Blue'},
+            {'custom:CustomKey': 'Custom Value 3', 'resources': ['Resource 1']},
+        ]
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        report = document.sync(records + [{'custom:CustomKey': 'Custom Value 9', 'name': 'New task'}], key='custom:CustomKey', dry_run=True)
+        self.assertEquals(report.creates, [omniplan.SyncCreate('Custom Value 9', {'name': 'New task'}, {'CustomKey': 'Custom Value 9'}, [])])
+        self.assertEquals([(update.task.id, update.property_name) for update in report.updates], [(2, 'name'), (4, 'effort')])
+        self.assertEquals([(write.task.id, write.name) for write in report.custom_data_writes], [(4, 'Team')])
+        self.assertEquals([assignment.task.id for assignment in report.assignments], [1])
+        self.assertEquals(len(report.errors), 1)
+        self.assertEquals(document.task_for_id(2).name, 'Task 2')
+
+        document.sync(records, key='custom:CustomKey')
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        self.assertEquals(document.task_for_id(2).name, 'Task 2 synced')
+        self.assertEquals(document.task_for_id(4).effort, omniplan.WorkDayTimeInterval(workdays=3))
+        self.assertEquals(document.task_for_id(4).custom_data_value('Team'), 'Blue')
+        self.assertEquals(document.task_for_id(1).assigned_resources()[0].name, 'Resource 1')
+        self.assertTrue(document.sync(records, key='custom:CustomKey').is_empty())
+
+    def test_sync_value_coercion(self):
+        document = OmniPlanDocument.from_oplx_bundle(self.bundle_path)
+        effort_seconds = document.task_for_id(4).effort.seconds()
+        records = [{'custom:CustomKey': 'Custom Value 2', 'name': 'Task 4', 'effort': effort_seconds}]
+        self.assertTrue(document.sync(records, key='custom:CustomKey', dry_run=True).is_empty())
+
+        report = document.sync([{'custom:CustomKey': 'Custom Value 2', 'effort': float(effort_seconds * 2)}], key='custom:CustomKey', dry_run=True)
+        self.assertEquals([update.new_value for update in report.updates], [omniplan.WorkDayTimeInterval(seconds=effort_seconds * 2)])
+        report = document.sync([{'custom:CustomKey': 'Custom Value 2', 'custom:Team': 7}], key='custom:CustomKey', dry_run=True)
+        self.assertEquals([write.new_value for write in report.custom_data_writes], [u'7'])
+
+        self.assertRaises(ValueError, document.sync, [{'custom:CustomKey': 'Custom Value 2', 'effort': '3d'}], key='custom:CustomKey')
+        self.assertRaises(ValueError, document.sync, [{'custom:CustomKey': ['Custom Value 2']}], key='custom:CustomKey')
+        self.assertRaises(ValueError, document.sync, [{'custom:CustomKey': 'Custom Value 2', 'custom:Team': None}], key='custom:CustomKey')
+
+
+class TestOplxScenarioRewriter(unittest.TestCase):
+
+    class SetTitleChangeRecord(omniplan.TaskChangeRecord):
+
+        def __init__(self, title):
+            self.title = title
+
+        def apply_to_oplx_task_element(self, element):
+            omniplan.OplxBundle.set_child_element_text(element, 'title', self.title)
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.scenario_path = os.path.join(self.temp_directory, 'Actual.xml')
+        with open(self.scenario_path, 'wb') as f:
+            f.write('<scenario><task id="t1"/><task id="t2"><title>Two</title></task><task id="t3"/></scenario>')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def rewrite(self, change_records_by_element_id):
+        output = StringIO.StringIO()
+        omniplan.OplxScenarioRewriter(self.scenario_path, change_records_by_element_id).rewrite(output)
+        return output.getvalue()
+
+    def test_empty_element_tags(self):
+        self.assertEquals(self.rewrite({'t1': [self.SetTitleChangeRecord('One')], 't3': [self.SetTitleChangeRecord('Three')]}),
+            '<scenario><task id="t1"><title>One</title></task><task id="t2"><title>Two</title></task><task id="t3"><title>Three</title></task></scenario>')
+
+    def test_missing_task_elements(self):
+        with self.assertRaises(Exception):
+            self.rewrite({'t1': [self.SetTitleChangeRecord('One')], 't9': [self.SetTitleChangeRecord('Nine')]})
+
+
+class TestChangelogReader(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.changelog_path = os.path.join(self.temp_directory, '__changelog.xml')
+        with open(self.changelog_path, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<changelog xmlns="http://www.omnigroup.com/namespace/OmniPlan/v2">\n  <version>2.1</version>\n')
+            for day in range(1, 29):
+                date = datetime.datetime(2017, 10, 1) + datetime.timedelta(days=day)
+                f.write('  <task-change-set user="User {}" date="{}.000Z" timestamp="{}.000Z">\n'.format(day % 2, date.isoformat(), date.isoformat()))
+                f.write('    <change idref="t{}" attribute="resourceLeveledDate" type="date" to="{}.000Z"/>\n'.format(day % 3 + 1, (date + datetime.timedelta(days=10)).isoformat()))
+                f.write('    <change idref="t1" attribute="title" type="string" to="Task {}"/>\n'.format(day))
+                f.write('  </task-change-set>\n')
+            f.write('</changelog>\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_change_sets(self):
+        change_sets = list(omniplan.OplxBundle('test.oplx').changelog_reader().change_sets())
+        self.assertEquals(len(change_sets), 1)
+        self.assertEquals(change_sets[0].user, 'Marc Liyanage')
+        self.assertEquals(change_sets[0].changes[1], omniplan.ChangelogChange('t5', 5, 'resourceLeveledDate', 'date', datetime.datetime(2013, 1, 1, 23, 0)))
+
+        reader = omniplan.ChangelogReader(self.changelog_path)
+        change_sets = list(reader.change_sets(since=datetime.datetime(2017, 10, 10, 12), until=datetime.datetime(2017, 10, 20)))
+        self.assertEquals([change_set.date.day for change_set in change_sets], range(11, 21))
+
+    def test_statistics(self):
+        statistics = omniplan.ChangelogReader(self.changelog_path).statistics(since=datetime.datetime(2017, 10, 2), until=datetime.datetime(2017, 10, 8))
+        self.assertEquals(statistics.change_set_count, 7)
+        self.assertEquals(statistics.edits_per_user_week[('User 0', datetime.date(2017, 10, 2))], 6)
+        self.assertEquals(statistics.most_churned_tasks(1), [(1, 9)])
+        self.assertEquals(statistics.slip_days(2, 'resourceLeveledDate'), 6.0)
+        self.assertEquals(statistics.slipped_tasks('resourceLeveledDate', days=4), [(2, 6.0)])
+
+
+class TestSharedModel(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_publish_and_attach(self):
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        document.task_for_id(5).name = u'T\xe2che 5'
+        publisher = omniplan.SharedModelPublisher('synthetic', directory=self.temp_directory)
+        self.assertEquals(publisher.publish(document), 1)
+
+        reader = omniplan.SharedModelReader('synthetic', directory=self.temp_directory)
+        view = reader.current()
+        self.assertEquals([task.export_record() for task in view.all_tasks()], [task.export_record() for task in document.all_tasks()])
+        self.assertEquals([task.id for task in view.tasks], [1, 2, 3, 5])
+        self.assertEquals(view.task_for_id(4).parent_task().id, 3)
+        self.assertEquals([task.id for task in view.task_for_id(2).prerequisite_tasks()], [3])
+        self.assertEquals([task.id for task in view.task_for_id(2).dependent_tasks()], [1])
+        self.assertEquals(view.task_for_id(4).assigned_resource_names(), ['Resource 1'])
+        self.assertEquals(view.task_for_id(1).custom_data_value('CustomKey'), 'Custom Value 3')
+        self.assertFalse(reader.refresh())
+
+        document.task_for_id(1).name = 'Task 1 renamed'
+        self.assertEquals(publisher.publish(document), 2)
+        self.assertEquals(view.task_for_id(1).name, 'Task 1')
+        self.assertTrue(reader.refresh())
+        self.assertEquals(reader.current().task_for_id(1).name, 'Task 1 renamed')
+        self.assertEquals(sorted(os.listdir(self.temp_directory)), ['synthetic.1.model', 'synthetic.2.model', 'synthetic.generation'])
+        publisher.publish(document)
+        self.assertEquals(sorted(os.listdir(self.temp_directory)), ['synthetic.2.model', 'synthetic.3.model', 'synthetic.generation'])
+
+    def test_publish_during_refresh(self):
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        publisher = omniplan.SharedModelPublisher('synthetic', directory=self.temp_directory)
+        publisher.publish(document)
+        reader = omniplan.SharedModelReader('synthetic', directory=self.temp_directory)
+        publisher.publish(document)
+
+        # publish between the reader's counter read and its open, first once
+        # so the generation it read is still there, then twice so it is gone
+        read_shared_model_generation = omniplan.read_shared_model_generation
+        publish_counts = [1, 2]
+        def read_and_publish(path):
+            generation = read_shared_model_generation(path)
+            if publish_counts:
+                omniplan.read_shared_model_generation = read_shared_model_generation
+                for i in range(publish_counts.pop(0)):
+                    publisher.publish(document)
+                omniplan.read_shared_model_generation = read_and_publish
+            return generation
+        omniplan.read_shared_model_generation = read_and_publish
+        try:
+            self.assertTrue(reader.refresh())
+            self.assertEquals(reader.current().generation, 2)
+            self.assertTrue(reader.refresh())
+            self.assertEquals(reader.current().generation, 5)
+        finally:
+            omniplan.read_shared_model_generation = read_shared_model_generation
+
+
+class TestSnapshotStore(unittest.TestCase):
+
+    def test_snapshot_history(self):
+        store = omniplan.SnapshotStore(':memory:')
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        store.append_snapshot(document, taken_at=datetime.datetime(2017, 10, 1))
+        document.task_for_id(2).completed_effort = omniplan.WorkDayTimeInterval(workdays=0.5)
+        store.append_snapshot(document, taken_at=datetime.datetime(2017, 10, 8))
+
+        self.assertEquals(store.connection.execute('SELECT COUNT(*) FROM task_versions').fetchone()[0], 6)
+        self.assertEquals(store.connection.execute('SELECT COUNT(*) FROM assignment_versions').fetchone()[0], 2)
+        history = store.task_history('synthetic', 2)
+        self.assertEquals([row['completed_effort'] for snapshot_id, taken_at, row in history], [0, 14400])
+        self.assertEquals([row['completed_effort'] for row in store.effort_totals('synthetic')], [0, 14400])
+
+
+class TestRollupEngine(unittest.TestCase):
+
+    def test_rollups(self):
+        document_data = make_document_data()
+        document_data['child_tasks'][2]['child_tasks'][0]['custom_data'].append({'name': 'Budget', 'value': '100'})
+        document = OmniPlanDocument('synthetic', document_data=document_data)
+        engine = document.rollup_engine(custom_aggregates={'budget': omniplan.RollupEngine.custom_data_sum('Budget')})
+        self.assertEquals(engine.rollup()['effort'], 4 * 28800)
+        self.assertEquals(engine.rollup(document.task_for_id(3))['budget'], 100)
+
+        document.task_for_id(4).completed_effort = omniplan.WorkDayTimeInterval(workdays=0.5)
+        document.task_for_id(4).set_custom_data_value('Budget', '150')
+        rollup = engine.rollup(document.task_for_id(3))
+        self.assertEquals(rollup['remaining_effort'], 14400)
+        self.assertEquals(rollup['percent_done'], 50.0)
+        self.assertEquals(rollup['budget'], 150)
+        self.assertEquals(engine.rollup()['completed_effort'], 14400)
+
+    def test_added_subtrees(self):
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        engine = document.rollup_engine()
+        document.add_tasks_for_task_data_list([make_task_data(6, 'Task 6', child_tasks=[
+            make_task_data(7, 'Task 7', effort_days=2, child_tasks=[make_task_data(8, 'Task 8', effort_days=3)]),
+            make_task_data(9, 'Task 9'),
+        ])])
+        document.task_for_id(5).add_tasks_for_task_data_list([make_task_data(10, 'Task 10', effort_days=2)])
+        self.assertEquals(engine.rollup(document.task_for_id(7))['effort'], 3 * 28800)
+        self.assertEquals(engine.rollup(document.task_for_id(6))['effort'], 4 * 28800)
+        self.assertEquals(engine.rollup(document.task_for_id(5))['effort'], 2 * 28800)
+        self.assertEquals(engine.rollup()['effort'], 9 * 28800)
+        self.assertEquals(engine.totals, document.rollup_engine().totals)
+
+
+class TestScheduleSimulation(unittest.TestCase):
+
+    def test_simulation(self):
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        network = omniplan.ScheduleNetwork(document)
+        self.assertEquals([task.id for task in network.tasks], [4, 5, 2, 1])
+
+        result = omniplan.ScheduleSimulation(document).run(trials=200, processes=1, seed=1)
+        self.assertEquals(result.trials, 200)
+        self.assertTrue(2.4 <= result.finish_offset_percentile(50) <= result.finish_offset_percentile(95) <= 4.5)
+        self.assertEquals(result.criticality[1], 1.0)
+        self.assertEquals(result.criticality[5], 0.0)
+        self.assertTrue(result.finish_date_percentile(80) > network.start_date)
+
+    def test_triangular_samples(self):
+        samples = omniplan.triangular_samples(random.Random(1), 1.0, 2.0, 4.0, 20000)
+        self.assertEquals(len(samples), 20000)
+        self.assertTrue(1.0 <= min(samples) and max(samples) <= 4.0)
+        self.assertAlmostEquals(sum(samples) / len(samples), 7.0 / 3, places=1)
+        self.assertAlmostEquals(len([sample for sample in samples if sample < 2.0]) / 20000.0, 1.0 / 3, places=1)
+        self.assertEquals(list(omniplan.triangular_samples(random.Random(1), 2.0, 2.0, 2.0, 3)), [2.0, 2.0, 2.0])
+
+    def test_work_calendar(self):
+        friday = datetime.datetime(2017, 10, 20, 9)
+        self.assertEquals(omniplan.WorkCalendar.add_workdays(friday, 1), datetime.datetime(2017, 10, 23, 9))
+        self.assertEquals(omniplan.WorkCalendar.add_workdays(friday, 5.5), datetime.datetime(2017, 10, 27, 13))
+        self.assertEquals(omniplan.WorkCalendar.workdays_between(friday, datetime.datetime(2017, 10, 30)), 6)
+
+
+class TestResourceLoad(unittest.TestCase):
+
+    def test_resource_load(self):
+        document_data = make_document_data()
+        document_data['child_tasks'][2]['child_tasks'][0]['effort'] = 3 * 28800
+        document_data['child_tasks'][2]['child_tasks'][0]['duration'] = 3 * 28800
+        document_data['resources'][0]['task_assignments'][1]['units'] = 1.0
+        document = OmniPlanDocument('synthetic', document_data=document_data)
+
+        load = document.resource_load(datetime.date(2012, 10, 8), datetime.date(2012, 10, 15))
+        self.assertEquals(load.matrix[0], [2.0, 1.0, 1.0, 0.0, 0.0, 0.0, 0.0])
+        self.assertEquals(load.over_allocations(), [(document.resource_for_id(1), datetime.date(2012, 10, 8), datetime.date(2012, 10, 9), 2.0)])
+
+        load = document.resource_load(datetime.date(2012, 10, 8), datetime.date(2012, 10, 22), bucket='week')
+        self.assertEquals(load.matrix[0], [2.0, 0.0])
+
+
+class TestResourceLeveler(unittest.TestCase):
+
+    def test_leveling(self):
+        document_data = make_document_data()
+        document_data['child_tasks'][3]['priority'] = 10
+        document_data['child_tasks'][3]['starting_date'] = datetime.datetime(2012, 10, 8, 9)
+        document_data['resources'][0]['task_assignments'] = [{'task_id': 4, 'units': 1.0}, {'task_id': 5, 'units': 1.0}]
+        document = OmniPlanDocument('synthetic', document_data=document_data)
+
+        result = document.level_resources()
+        self.assertEquals(result.proposed_start_dates().keys(), [4, 2, 1])
+        self.assertEquals(result.proposed_start_dates()[4].replace(tzinfo=None), datetime.datetime(2012, 10, 9, 16, 30))
+        change_records = result.change_records()
+        self.assertEquals(change_records[0].task.id, 4)
+        self.assertEquals(change_records[0].property_name, 'starting_constraint_date')
+
+        result.apply()
+        self.assertEquals(document.task_for_id(4).starting_date.date(), datetime.date(2012, 10, 9))
+        self.assertEquals(len(document.task_for_id(4).pending_change_records()), 1)
+
+
+class TestDocumentSnapshot(unittest.TestCase):
+
+    def test_copy_on_write(self):
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        holder = omniplan.DocumentSnapshotHolder.for_document(document)
+        snapshot = holder.current()
+        self.assertEquals([task.id for task in snapshot.all_tasks()], [1, 2, 3, 4, 5])
+        self.assertEquals(snapshot.task_for_id(2).prerequisite_ids, (3,))
+
+        new_snapshot = holder.update({2: {'name': 'Task 2 renamed', 'custom_data': {'CustomKey': 'Custom Value 3'}}})
+        self.assertTrue(holder.current() is new_snapshot)
+        self.assertEquals(new_snapshot.generation, 1)
+        self.assertEquals(new_snapshot.task_for_id(2).name, 'Task 2 renamed')
+        self.assertEquals([task.id for task in new_snapshot.tasks_for_custom_data_value('CustomKey', 'Custom Value 3')], [1, 3, 2])
+        self.assertEquals(new_snapshot.tasks_for_custom_data_value('CustomKey', 'Custom Value 1'), [])
+        self.assertTrue(new_snapshot.task_for_id(4) is snapshot.task_for_id(4))
+
+        self.assertEquals(snapshot.task_for_id(2).name, 'Task 2')
+        self.assertEquals(snapshot.task_for_id(2).custom_data_value('CustomKey'), 'Custom Value 1')
+        self.assertEquals(len(snapshot.tasks_for_custom_data_value('CustomKey', 'Custom Value 3')), 2)
+
+
+class TestDocumentLoader(unittest.TestCase):
+
+    def test_single_flight(self):
+        def load_document(name):
+            time.sleep(0.1)
+            return OmniPlanDocument(name, document_data=make_document_data())
+
+        loader = omniplan.DocumentLoader(ttl=60, load_document=load_document)
+        documents = []
+        threads = [threading.Thread(target=lambda: documents.append(loader.load('synthetic'))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        documents.append(loader.load('synthetic'))
+
+        self.assertEquals(len(set(id(document) for document in documents)), 1)
+        self.assertEquals(loader.metrics(), {'hits': 1, 'shared_loads': 4, 'extractions': 1})
+
+    def test_eviction(self):
+        load_document = lambda name: OmniPlanDocument(name, document_data=make_document_data())
+        loader = omniplan.DocumentLoader(ttl=0, load_document=load_document)
+        loader.load('a')
+        loader.load('b')
+        self.assertEquals([key[0] for key in loader.documents], ['b'])
+
+        loader = omniplan.DocumentLoader(ttl=60, load_document=load_document, max_documents=2)
+        for name in 'abc':
+            loader.load(name)
+        self.assertEquals([key[0] for key in loader.documents], ['b', 'c'])
+
+
+class TestChunkedDocumentReader(unittest.TestCase):
+
+    class SyntheticReader(omniplan.ChunkedDocumentReader):
+
+        def __init__(self, *args, **kwargs):
+            super(TestChunkedDocumentReader.SyntheticReader, self).__init__(*args, **kwargs)
+            self.document_data = make_document_data()
+            self.failed_chunks = set()
+
+        def run_script(self, script_code, arguments):
+            if 'task_ids:task_ids' in script_code:
+                return {'task_ids': [task_data['id'] for task_data in self.document_data['child_tasks']]}
+            if 'child_tasks:task_list' in script_code:
+                task_ids = tuple(arguments[1:])
+                if task_ids not in self.failed_chunks:
+                    self.failed_chunks.add(task_ids)
+                    raise Exception('AppleEvent timed out')
+                return {'child_tasks': [task_data for task_data in self.document_data['child_tasks'] if task_data['id'] in task_ids]}
+            return {key: value for key, value in self.document_data.items() if key != 'child_tasks'}
+
+    def test_chunked_read(self):
+        reader = self.SyntheticReader('synthetic', chunk_size=1, max_in_flight=2, retry_delay=0)
+        document = OmniPlanDocument('synthetic', document_data=reader.read_document_data())
+
+        self.assertEquals(len(reader.failed_chunks), 4)
+        self.assertEquals([task.id for task in document.all_tasks()], [1, 2, 3, 4, 5])
+        self.assertEquals(document.task_for_id(4).parent_task().id, 3)
+        self.assertEquals(len(document.task_for_id(2).resource_assignments), 1)
+
+
+class TestPortfolio(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_directory, 'synthetic.dat')
+        with open(self.cache_path, 'wb') as f:
+            pickle.dump([make_document_data(), None], f)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_portfolio(self):
+        missing_path = os.path.join(self.temp_directory, 'missing.oplx')
+        portfolio = omniplan.Portfolio(['test.oplx', self.cache_path, missing_path], custom_data_keys=['CustomKey'], processes=2)
+        result = portfolio.run()
+
+        self.assertEquals(result.errors.keys(), [missing_path])
+        self.assertEquals(result.task_count, 10)
+        self.assertEquals(result.effort, 8.0)
+        self.assertEquals(result.effort_by_resource_name, {'Resource 1': 4.0})
+        self.assertEquals(result.effort_by_custom_data_value['CustomKey'], {'Custom Value 3': 2.0, 'Custom Value 1': 2.0, 'Custom Value 2': 2.0})
+
+
+class TestTaskSearchIndex(unittest.TestCase):
+
+    def test_search(self):
+        document = OmniPlanDocument('synthetic', document_data=make_document_data())
+        search_index = document.search_index(['CustomKey'])
+        self.assertTrue(document.search_index(['CustomKey']) is search_index)
+
+        self.assertEquals(search_index.search('task 4')[0][1].id, 4)
+        self.assertEquals(search_index.search('Tsak 2')[0][1].id, 2)
+        self.assertEquals([task.id for score, task in search_index.search('value 3', limit=2)], [1, 3])
+        self.assertEquals(document.search_index().search('value 3'), [])
+
+        document.task_for_id(5).name = 'Login page redesign'
+        document.task_for_id(2).set_custom_data_value('CustomKey', 'Login form')
+        self.assertEquals([task.id for score, task in search_index.search('login redesgn', limit=2)], [5, 2])
+        self.assertNotIn(5, [task.id for score, task in search_index.search('task 5')])
+
+
 #     def test_example(self):
 #         document = self.document
 #         for task in document.all_tasks():